@@ -150,8 +150,14 @@ rowcrop                 rmd     1
 *   storeBytes        7        2   Number of bytes to reserve for storing background pixels
 *     drawLeft        9        2   Pointer to ASM function for storing/drawing
 *    drawRight       11        2   Pointer to ASM function for storing/drawing or NULL
-*        erase       13        2   Pointer to ASM function for erasing sprite
-*         res1       15        1   Reserved
+*        erase       13        2   Pointer to ASM function for erasing sprite, or NULL to redraw background
+*   redrawOffX       15        1   Signed offset in pixels from global X coordinate to left edge of redraw rectangle
+*                                  (for a Delta sprite: index of the old sprite which it changes, plus one)
+*
+* A Delta sprite (made with the AnimateTo parameter) changes an old sprite which is already drawn at
+* the same position into a new sprite, and it is erased by the new sprite's Erase function.  In the
+* file, its erase element is $8000 plus the index of the new sprite, and the loader copies the new
+* sprite's cpErase and erase elements into it.
 
 SDT         STRUCT
 width                   rmb     1
@@ -165,7 +171,7 @@ storeBytes              rmd     1
 drawLeft                rmd     1
 drawRight               rmd     1
 erase                   rmd     1
-res1                    rmb     1
+redrawOffX              rmb     1
             ENDSTRUCT
 
 * -----------------------------------------------------------------------------
@@ -203,7 +209,8 @@ res1                    rmd     2
 * Element Name | Offset | Length | Meaning
 *-----------------------------------------
 *     dataSize        0        1   Number of bytes required to store state data for this object
-*     drawType        1        1   0=Custom func, 1=standard sprite no rowcrop, 2=sprite w/ rowcrop
+*     drawType        1        1   0=Custom func, 1=standard sprite no rowcrop, 2=sprite w/ rowcrop,
+*                                  3=persistent sprite (see Persistent Sprite Record below)
 *     initSize        2        1   Number of bytes in object stream to reserve for initializing this object
 *         res1        3        1   N/A
 *         init        4        2   Pointer to ASM function for initializing object
@@ -256,6 +263,35 @@ sprPtr                  rmd     1
 rowPtr                  rmd     1
             ENDSTRUCT
 
+* -----------------------------------------------------------------------------
+* -- Persistent Sprite Record
+* -----------------------------------------------------------------------------
+* Objects with drawType=3 stay on the screen when they are not moving.  The first byte of the state
+* data for such an object is the index of the sprite to draw, and it is followed by one 8-byte
+* record for each buffer pair, which describes the sprite left on the screen in that pair:
+*
+* Element Name | Offset | Length | Meaning
+*-----------------------------------------
+*    spriteIdx        0        1   Index of the sprite drawn in this buffer pair, or $FF if none
+*       drawLR        1        1   SDT.drawLeft or SDT.drawRight, for the function which drew it
+*         page        2        1   8k page number for screen background pixels
+*       offset        3        2   Start offset for screen background pixels (graphics window $6000-$BFFF)
+*       bufPtr        5        2   Pointer to buffer for background pixel bytes (set by object's init function)
+*         res1        7        1   N/A
+*
+* The buffers must be large enough for the storeBytes of every sprite (including Delta sprites)
+* which the object draws.  Persistent sprites are drawn before all of the other sprites, and they
+* must not overlap each other, or any sprite which is erased by redrawing the background.
+
+PSR         STRUCT
+spriteIdx               rmb     1
+drawLR                  rmb     1
+page                    rmb     1
+offset                  rmd     1
+bufPtr                  rmd     1
+res1                    rmb     1
+            ENDSTRUCT
+
 * -----------------------------------------------------------------------------
 * -- Sprite Erase Data Heap
 * -----------------------------------------------------------------------------
@@ -275,6 +311,16 @@ rowPtr                  rmd     1
 *                   N+6        2   Start offset for screen background pixels (graphics window $8000-$BFFF)
 *                   N+8        1   Mode number (0 for no rowcrop, or 1 for rowcrop)
 *
+* Layout for Mode 2 (Redraw background):
+*
+* Element Name | Offset | Length | Meaning
+*-----------------------------------------
+*                     0        2   Starting X block index of background rectangle to redraw
+*                     2        2   Starting Y row of background rectangle to redraw
+*                     4        1   Number of blocks to redraw in X
+*                     5        1   Number of rows to redraw in Y
+*                     6        1   Mode number (2 for redraw background)
+*
 
 * -----------------------------------------------------------------------------
 * -- Game Data Directories
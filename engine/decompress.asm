@@ -772,18 +772,23 @@ BitLinkDone@
             bne         BitLoopTail@
             cmpx        #256                    * yes.  did we just decode a STOP code?
             bne         >
-            ldd         #256                    * we did, so don't update the bit pointers, just return 256
+            tst         Decomp_BFINAL           * in the final block, there may be no more data to load
+            beq         >
+            ldd         #256                    * so don't update the bit pointers, just return 256
             rts
-!           jsr         Decomp_ReloadInputBuffer    * no STOP code, so load more input data
+!           jsr         Decomp_ReloadInputBuffer    * otherwise load more input data
             ldy         #$4000+DecompData.InBuffer
 BitLoopTail@                                    * if new pointer is a decision node, then loop again
             cmpx        #512                    * theoretically 285 is the max possible huffman code value
             bhs         BitLoop@
             cmpx        #256
-            beq         >                       * if we get a STOP code, don't update the bit pointers
-            sta         Decomp_InBitMask        * so if a bug in client calls us multiple times, we
-            sty         Decomp_InCurPtr         * will keep returning STOP
-!           tfr         x,d                     * put return value into D
+            bne         >
+            tst         Decomp_BFINAL           * if we get a STOP code in the final block, don't update the bit
+            bne         GetHuffDone@            * pointers, so if a bug in client calls us multiple times, we will
+!           sta         Decomp_InBitMask        * keep returning STOP.  In earlier blocks, the next block header
+            sty         Decomp_InCurPtr         * starts right after the STOP code
+GetHuffDone@
+            tfr         x,d                     * put return value into D
             rts
 
 
@@ -60,7 +60,9 @@ Gfx_SpriteUninit
 ***********************************************************
 * Gfx_SpriteEraseOffscreen:
 *   This function erases all sprites which were previously drawn into the
-*   frame buffer pair which is currently offscreen
+*   frame buffer pair which is currently offscreen.  The persistent sprites
+*   (drawType=3) in this buffer pair are only erased if it will be scrolled,
+*   or if their objects will not be drawn again
 *
 * - IN:      N/A
 * - OUT:     N/A
@@ -86,11 +88,13 @@ EraseLoop@
             beq         >
             swi                                 * error: we are not at the exact start of the heap
  ENDC
-!           rts
+!           bra         ErasePersistent@
 EraseOne@
             lda         -1,u                    * A = sprite erase mode
             beq         >
-            swi                                 * error: only No Rowcrop mode is currently supported
+            cmpa        #2
+            beq         EraseRedraw@
+            swi                                 * error: only No Rowcrop and Redraw modes are currently supported
 !           ldy         -3,u                    * Y = starting offset to restore bytes in graphics memory
             lda         -4,u                    * A = starting physical page # for graphics memory
             sta         $FFA3
@@ -109,6 +113,82 @@ EraseOne@
             leau        -2,x
             jsr         [,u]                    * call Erase function
             bra         EraseLoop@
+EraseRedraw@
+            ldd         -7,u                    * copy the background rectangle for this sprite into the RR_* globals
+            std         <RR_StartBlkX
+            ldd         -5,u
+            std         <RR_StartRowY
+            ldd         -3,u
+            std         <RR_RectBlocksX         * also sets RR_RectRowsY
+            leau        -7,u
+            pshs        u
+            jsr         Gfx_RedrawRect          * redraw the background tiles underneath the sprite
+            puls        u
+            lda         <MemMgr_VirtualTable+VH_BASIC0  * Gfx_RedrawRect maps the tilemap to $0000 and the screen to $C000
+            sta         $FFA0                   * so re-map the object tables
+            lda         <MemMgr_VirtualTable+VH_SPRERASE
+            sta         $FFA6                   * and the sprite erase data
+            bra         EraseLoop@
+ErasePersistent@
+            * B is non-zero if the background in this buffer pair will be scrolled
+            clrb
+            ldx         <Gfx_BkgrndNewX
+            cmpx        <Gfx_BkgrndRedrawOldX
+            bne         WillScroll@
+            ldx         <Gfx_BkgrndNewY
+            cmpx        <Gfx_BkgrndRedrawOldY
+            beq         ScrollTested@
+WillScroll@
+            decb
+ScrollTested@
+            ldx         <Obj_CurrentTablePtr
+            lda         <Obj_NumCurrent
+            beq         PersistentDone@
+PersistentLoop@
+            pshs        a,b,x
+            ldu         COB.odtPtr,x
+            lda         ODT.drawType,u
+            cmpa        #3
+            bne         PersistentNext@
+            ldy         COB.statePtr,x
+            ldb         <Gfx_RenderingFrameX4
+            lslb
+            incb
+            leay        b,y                     * Y is pointer to Persistent Sprite Record for this buffer pair
+            lda         PSR.spriteIdx,y
+            cmpa        #$FF
+            beq         PersistentNext@         * nothing was left on the screen in this buffer pair
+            tst         1,s
+            bne         >                       * the background will be scrolled, so the sprite must be erased
+            ldb         COB.active,x
+            andb        #2
+            bne         PersistentNext@         * the object will be drawn again, so it can change the sprite in place
+!           ldb         #sizeof{SDT}
+            mul
+            addd        COB.sprPtr,x
+            tfr         d,u                     * U points to SDT entry for the sprite left on the screen
+            ldb         #$FF
+            stb         PSR.spriteIdx,y         * nothing is left on the screen in this buffer pair after erasing it
+            lda         PSR.page,y              * A = starting physical page # for graphics memory
+            sta         $FFA3
+            inca
+            sta         $FFA4
+            inca
+            sta         $FFA5                   * screen window is mapped to $6000-$BFFF
+            lda         SDT.cpErase,u           * A = Code page (virtual handle) for erase function for this sprite
+            ldx         #MemMgr_VirtualTable
+            lda         a,x
+            sta         $FFA2                   * code is at logical page starting at $4000
+            ldx         PSR.bufPtr,y            * X is start of saved background pixel data
+            ldy         PSR.offset,y            * Y = starting offset to restore bytes in graphics memory
+            jsr         [SDT.erase,u]           * call Erase function
+PersistentNext@
+            puls        a,b,x
+            leax        sizeof{COB},x
+            deca
+            bne         PersistentLoop@
+PersistentDone@
+            rts
 
 
 ***********************************************************
@@ -161,6 +241,54 @@ SpriteIdxOkay@
             mul
             addd        COB.sprPtr,x
             tfr         d,u                     * now U points to SDT entry for sprite to draw
+            * if this sprite is erased by redrawing the background, then store the rectangle of blocks that it covers
+            ldd         SDT.erase,u
+            bne         RedrawRectDone@
+            ldy         <Gfx_SpriteErasePtrPtr
+            ldy         2,y                     * Y is pointer to end of sprite erase heap
+            ldb         SDT.redrawOffX,u
+            sex
+            addd        COB.globalX,x           * D is global X coordinate of left edge of sprite
+            pshs        d
+            bpl         >
+            clra                                * clip left edge to start of tilemap
+            clrb
+!           lsra                                * divide by 16 to get starting X block index
+            rorb
+            lsra
+            rorb
+            lsra
+            rorb
+            lsra
+            rorb
+            std         ,y
+            puls        d
+            addb        SDT.width,u
+            adca        #0                      * D is global X coordinate of right edge of sprite
+            lsra                                * divide by 16 to get ending X block index
+            rorb
+            lsra
+            rorb
+            lsra
+            rorb
+            lsra
+            rorb
+            cmpd        <Gfx_BkgrndMapWidth
+            blo         >
+            ldd         <Gfx_BkgrndMapWidth     * clip right edge to end of tilemap
+            subd        #1
+!           subd        ,y
+            incb
+            stb         4,y                     * store number of blocks to redraw
+            ldb         SDT.offsetY,u
+            sex
+            addd        COB.globalY,x
+            std         2,y                     * store starting Y row
+            lda         SDT.height,u
+            sta         5,y                     * store number of rows to redraw
+            lda         #2
+            sta         6,y                     * mode is 2 (redraw background)
+RedrawRectDone@
             * decide which function (left or right) to use (DrawLRParity = SpriteGlobalX & 1)
             tst         SDT.cpRight,u
             beq         DrawLeft@               * if there is no single pixel positioning, we must use the DrawLeft function
@@ -221,6 +349,14 @@ lda_ScreenOffset@
             ldy         <Gfx_SpriteErasePtrPtr
             ldy         2,y
             ldd         SDT.erase,u
+            bne         DrawSaveBkgrnd@
+            leay        7,y                     * background rectangle to redraw was already stored above
+            pshs        y
+            lda         <gfx_DrawLeftOrRight
+            jsr         [a,u]                   * draw this sprite
+            puls        y
+            bra         EraseHeapDone@
+DrawSaveBkgrnd@
             std         ,y++                    * store pointer to erase function before the background pixels
             pshs        u,y
             lda         <gfx_DrawLeftOrRight
@@ -238,6 +374,7 @@ lda_ScreenOffset@
             std         4,y
             clr         6,y                     * mode is 0 (no rowcrop)
             leay        7,y                     * now Y is pointer to end of sprite erase heap
+EraseHeapDone@
             ldx         <Gfx_SpriteErasePtrPtr
             sty         2,x
  IFDEF DEBUG
@@ -250,6 +387,177 @@ lda_ScreenOffset@
 !           rts
 
 
+***********************************************************
+* Gfx_SpriteDrawPersistent:
+*   This function draws a sprite for an object which stays on the screen while it is not moving (drawType=3)
+*   The sprite index to draw must be in the first byte of the object's state buffer, followed by a
+*   Persistent Sprite Record for each buffer pair.  If the sprite left in this buffer pair is at the same
+*   position, then it is kept, or changed into the new sprite by a Delta sprite if there is one.
+*   Otherwise it is erased, and the new sprite is drawn
+*
+* - IN:      X = pointer to Current Object Table entry for object being drawn
+*            U = pointer to Object Descriptor Table entry for object type being drawn
+* - OUT:     N/A
+* - Trashed: A,B,X,Y,U
+***********************************************************
+Gfx_SpriteDrawPersistent
+            * get pointer to Persistent Sprite Record for the buffer pair being drawn
+            ldy         COB.statePtr,x
+            ldb         <Gfx_RenderingFrameX4
+            lslb
+            incb
+            leay        b,y                     * Y is pointer to PSR (the sprite index is the first byte in state data)
+            lda         [COB.statePtr,x]        * A is index of sprite to draw
+            pshs        a,x,y                   * stack: sprite index, COT entry pointer, PSR pointer
+            ldb         #sizeof{SDT}
+            mul
+            addd        COB.sprPtr,x
+            tfr         d,u                     * now U points to SDT entry for sprite to draw
+            * decide which function (left or right) to use (DrawLRParity = SpriteGlobalX & 1)
+            ldb         #SDT.drawLeft
+            tst         SDT.cpRight,u
+            beq         >                       * if there is no single pixel positioning, we must use the DrawLeft function
+            lda         COB.globalX+1,x
+            anda        #1
+            beq         >
+            ldb         #SDT.drawRight
+!           stb         <gfx_DrawLeftOrRight
+            * calculate screen pointer offset to start drawing, in the same way as Gfx_SpriteDrawSimple
+            ldd         COB.globalY,x
+            subd        <Gfx_BkgrndNewY
+            stb         <gfx_DrawOffsetY
+            ldd         COB.globalX,x
+            lsra
+            rorb
+            subd        <Gfx_BkgrndNewX
+            addb        SDT.offsetX,u
+            lda         <gfx_DrawOffsetY
+            adda        SDT.offsetY,u
+            addd        <Gfx_DrawScreenOffset    * must be between 0 and $1FFF
+            pshs        a
+            anda        #$1F
+            tfr         d,x                     * offset is in X
+            leax        $6000,x                 * X is now pointer where we will write pixel data
+            puls        a
+            lsra
+            lsra
+            lsra
+            lsra
+            lsra
+            adda        <Gfx_DrawScreenPage     * page is in A
+            * corner case: map the prior page if the starting offset is really close to the beginning of a page
+            cmpx        #$6020
+            bhs         >
+            leax        $2000,x
+            deca
+!           sta         <gfx_DrawSpritePage
+            stx         <gfx_DrawSpriteOffset
+            * decide what to do with the sprite left on the screen in this buffer pair
+            ldy         3,s                     * Y is pointer to PSR
+            ldb         PSR.spriteIdx,y
+            cmpb        #$FF
+            beq         DrawNew@                * nothing was left on the screen
+            cmpa        PSR.page,y
+            bne         EraseOld@               * the old sprite is at a different position, so it must be erased
+            cmpx        PSR.offset,y
+            bne         EraseOld@
+            lda         <gfx_DrawLeftOrRight
+            cmpa        PSR.drawLR,y
+            bne         EraseOld@               * or it was drawn at the other pixel phase
+            cmpb        ,s
+            beq         SpriteKept@             * the same sprite is already on the screen
+            * search this group's Sprite Descriptor Table for a Delta sprite which changes the old sprite into the new
+            * one.  It uses the new sprite's Erase function, and its redrawOffX is the old sprite's index plus one
+            incb
+            pshs        b
+            ldx         2,s                     * X is pointer to COT entry
+            lda         COB.groupIdx,x
+            ldy         <Gfx_SpriteGroupsPtr
+!           cmpa        SGT.groupIdx,y
+            beq         >
+            leay        sizeof{SGT},y
+            bra         <
+!           lda         SGT.spCount,y           * A is number of sprites in this group
+            ldy         SGT.sprites,y           * Y is pointer to first SDT entry in this group
+DeltaSearch@
+            ldb         SDT.redrawOffX,y
+            cmpb        ,s
+            bne         DeltaNext@
+            ldx         SDT.erase,y
+            cmpx        SDT.erase,u
+            beq         DeltaFound@
+DeltaNext@
+            leay        sizeof{SDT},y
+            deca
+            bne         DeltaSearch@
+            leas        1,s                     * there is no Delta sprite, so the old sprite must be erased
+            bra         EraseOld@
+DeltaFound@
+            leas        1,s
+            leau        ,y                      * U points to SDT entry for the Delta sprite
+            bra         DrawSprite@
+SpriteKept@
+            leas        5,s
+            rts
+EraseOld@
+            * erase the old sprite in this buffer pair
+            pshs        u
+            ldx         3,s                     * X is pointer to COT entry
+            ldy         5,s                     * Y is pointer to PSR
+            lda         PSR.spriteIdx,y
+            ldb         #sizeof{SDT}
+            mul
+            addd        COB.sprPtr,x
+            tfr         d,u                     * U points to SDT entry for old sprite
+            lda         PSR.page,y
+            sta         $FFA3
+            inca
+            sta         $FFA4
+            inca
+            sta         $FFA5                   * screen window is mapped to $6000-$BFFF
+            lda         SDT.cpErase,u
+            ldx         #MemMgr_VirtualTable
+            lda         a,x
+            sta         $FFA2                   * code is at logical page starting at $4000
+            ldx         PSR.bufPtr,y            * X is start of saved background pixel data
+            ldy         PSR.offset,y            * Y = starting offset to restore bytes in graphics memory
+            jsr         [SDT.erase,u]           * call Erase function
+            puls        u
+DrawNew@
+DrawSprite@
+            * map the code page which contains the drawing function (U points to its SDT entry)
+            lda         SDT.cpLeft,u
+            ldb         <gfx_DrawLeftOrRight
+            cmpb        #SDT.drawLeft
+            beq         >
+            lda         SDT.cpRight,u
+!           ldx         #MemMgr_VirtualTable
+            lda         a,x
+            sta         $FFA2
+            * screen window is mapped to $6000-$BFFF
+            lda         <gfx_DrawSpritePage
+            sta         $FFA3
+            inca
+            sta         $FFA4
+            inca
+            sta         $FFA5
+            ldy         3,s
+            ldy         PSR.bufPtr,y            * Y is pointer to buffer for background pixel data
+            ldx         <gfx_DrawSpriteOffset   * X is pointer where we will write pixel data
+            lda         <gfx_DrawLeftOrRight
+            jsr         [a,u]                   * draw this sprite, or change the old sprite into it
+            * update the Persistent Sprite Record for this buffer pair
+            puls        a,x,y
+            sta         PSR.spriteIdx,y
+            lda         <gfx_DrawLeftOrRight
+            sta         PSR.drawLR,y
+            lda         <gfx_DrawSpritePage
+            sta         PSR.page,y
+            ldd         <gfx_DrawSpriteOffset
+            std         PSR.offset,y
+            rts
+
+
 ***********************************************************
 * Gfx_SpriteDrawRowcrop:
 *   This function draws a sprite for an object which uses a single sprite with the rowcrop option
@@ -870,6 +870,21 @@ SpriteLoop@
             jsr         Decomp_Read_Stream      * load Sprite DrawRight machine code from disk file
             ldu         1,s
 !           ldd         SDT.erase,u             * number of bytes in Erase
+            beq         SpriteDone@             * sprites which are erased by redrawing the background have no Erase function
+            bpl         LoadErase@
+            * a Delta sprite uses the Erase function of the sprite which it changes into, whose index is in B.  That sprite
+            * comes before all of the Delta sprites in the table, so its Erase function is already loaded
+            lda         #sizeof{SDT}
+            mul
+            ldx         3,s                     * X is pointer to this group's SGT entry
+            ldx         SGT.sprites,x
+            ADD_D_TO_X                          * X is pointer to SDT entry of the new sprite
+            lda         SDT.cpErase,x
+            sta         SDT.cpErase,u
+            ldd         SDT.erase,x
+            std         SDT.erase,u
+            bra         SpriteDone@
+LoadErase@
             jsr         Ldr_AllocateSpriteCode
             ldu         1,s
             sta         SDT.cpErase,u
@@ -880,6 +895,7 @@ SpriteLoop@
             jsr         MemMgr_MapBlock
             puls        u
             jsr         Decomp_Read_Stream      * load Sprite Erase machine code from disk file
+SpriteDone@
             puls        a,x
             leax        sizeof{SDT},x
             deca
@@ -131,6 +131,24 @@ beginframe
             ldx         <Obj_CurrentTablePtr
             lda         <Obj_NumCurrent
             beq         DrawObjDone@
+            * persistent sprites (drawType=3) are drawn first, because they stay under all of the other sprites
+DrawPersistLoop@
+            ldb         COB.active,x
+            andb        #2
+            beq         SkipPersist@
+            ldu         COB.odtPtr,x
+            ldb         ODT.drawType,u
+            cmpb        #3
+            bne         SkipPersist@
+            pshs        a,x
+            jsr         Gfx_SpriteDrawPersistent
+            puls        a,x
+SkipPersist@
+            leax        sizeof{COB},x
+            deca
+            bne         DrawPersistLoop@
+            ldx         <Obj_CurrentTablePtr
+            lda         <Obj_NumCurrent
 DrawObjLoop@
             ldb         COB.active,x
             andb        #2
@@ -153,8 +171,10 @@ DrawObjLoop@
             * standard sprite with no rowcrop
             jsr         Gfx_SpriteDrawSimple
             bra         ThisObjDrawn@
+!           cmpb        #3
+            beq         ThisObjDrawn@           * persistent sprites were drawn above
             * standard sprite with rowcrop
-!           jsr         Gfx_SpriteDrawRowcrop
+            jsr         Gfx_SpriteDrawRowcrop
 ThisObjDrawn@
             puls        a,x
 SkipDraw@
@@ -50,6 +50,14 @@ velY                    rmd     1
 odometer                rmd     1
             ENDSTRUCT
 
+G2OB1       STRUCT
+spriteIdx               rmb     1           * the sprite index should always come first with drawType=3
+pair0                   rmb     sizeof{PSR} * followed by a Persistent Sprite Record for each buffer pair
+pair1                   rmb     sizeof{PSR}
+buffer0                 rmb     112         * the largest storeBytes of the spinning ball sprites is 105
+buffer1                 rmb     112
+            ENDSTRUCT
+
  IFDEF SPEEDTEST
 SpdTestPtr              fdb     0
 SpdTestPosTable         fcb     17,0,5,16,-13,9,-13,-9,5,-16
@@ -631,6 +639,72 @@ Ball0ParVelY@           zmd     1
 Ball1ParVelX@           zmd     1
 Ball1ParVelY@           zmd     1
 
+* -----------------------------------------------------------------------------
+* -- Object 1 (Spinning Ball) handling functions
+* -----------------------------------------------------------------------------
+
+* Object Initialization Function:
+* - IN:      X = pointer to Current Object Table for this object instance
+*            Y = pointer to Object Descriptor Table for this object type
+*            U = pointer to initialization data in object init stream
+* - OUT:     none
+* - Trashed: all
+*
+Demo_Grp2Object1_Init
+            ldy         COB.statePtr,x
+            lda         ,u                      * starting animation step (0-3)
+            anda        #3
+            adda        #2                      * offset by sprite # for first spinning ball sprite (Cycle_1)
+            sta         G2OB1.spriteIdx,y
+            lda         #$FF                    * no sprite has been left on the screen in either buffer pair
+            sta         G2OB1.pair0+PSR.spriteIdx,y
+            sta         G2OB1.pair1+PSR.spriteIdx,y
+            leau        G2OB1.buffer0,y         * each buffer pair has its own buffer for the background pixels
+            stu         G2OB1.pair0+PSR.bufPtr,y
+            leau        G2OB1.buffer1,y
+            stu         G2OB1.pair1+PSR.bufPtr,y
+            rts
+
+Demo_Grp2Object1_Reactivate
+            rts
+
+* Object Update Function:
+* - IN:      X = pointer to Current Object Table for this object instance
+*            U = pointer to Object Descriptor Table for this object type
+* - OUT:     none
+* - Trashed: all
+*
+Demo_Grp2Object1_Update
+            * advance to the next spinning ball sprite in every frame.  Each buffer pair is drawn in every other
+            * frame, so the Delta sprites made by AnimateTo change each sprite into the one 2 steps later
+            ldy         COB.statePtr,x
+            lda         G2OB1.spriteIdx,y
+            deca                                * A = (spriteIdx - 2 + 1)
+            anda        #3
+            adda        #2
+            sta         G2OB1.spriteIdx,y
+            * the ball stays at the same place in the tilemap, so only draw it while it is inside the screen
+            lda         COB.active,x
+            anda        #$FD
+            sta         COB.active,x
+            ldd         COB.globalX,x
+            subd        <Gfx_BkgrndNewX2
+            cmpd        #8
+            blt         UpdateDone@
+            cmpd        #320-9
+            bgt         UpdateDone@
+            ldd         COB.globalY,x
+            subd        <Gfx_BkgrndNewY
+            cmpd        #8
+            blt         UpdateDone@
+            cmpd        #200-9
+            bgt         UpdateDone@
+            lda         COB.active,x
+            ora         #2
+            sta         COB.active,x
+UpdateDone@
+            rts
+
 * -----------------------------------------------------------------------------
 * -- Data tables
 * -----------------------------------------------------------------------------
@@ -660,7 +734,7 @@ InvSqRoot17             fcb     $00,$80,$5b,$4a,$40,$39,$34,$30,$2d,$2b,$28,$27,
 * -- Object Descriptor Table must come after the code block
 * -----------------------------------------------------------------------------
 
-NumberOfObjects         fcb     1
+NumberOfObjects         fcb     2
 ObjectDescriptorTable
                         fcb     sizeof{G2OB0}   * dataSize
                         fcb     1               * drawType == 1: standard sprite w/ no rowcrop
@@ -673,4 +747,15 @@ ObjectDescriptorTable
                         fdb     0               * vpageAddr
                         fdb     0,0             * res2
 
+                        fcb     sizeof{G2OB1}   * dataSize
+                        fcb     3               * drawType == 3: persistent sprite
+                        fcb     1               * initSize
+                        fcb     0               * res1
+                        fdb     Demo_Grp2Object1_Init
+                        fdb     Demo_Grp2Object1_Reactivate
+                        fdb     Demo_Grp2Object1_Update
+                        fdb     0               * custom draw function
+                        fdb     0               * vpageAddr
+                        fdb     0,0             * res2
+
 
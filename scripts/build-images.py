@@ -256,12 +256,20 @@ if __name__ == "__main__":
     global CocoLuvByRGB, CocoLuvByCMP
     print("DynoSprite Splash Image Builder script")
     # get input paths
-    if len(sys.argv) != 4:
-        print(f"****Usage: {sys.argv[0]} <in_png_folder> <out_cc3_folder> <out_asm_folder>")
+    if len(sys.argv) != 4 and len(sys.argv) != 5:
+        print(f"****Usage: {sys.argv[0]} <in_png_folder> <out_cc3_folder> <out_asm_folder> [compress_mode]")
         sys.exit(1)
     imgdir = sys.argv[1]
     cc3dir = sys.argv[2]
     asmdir = sys.argv[3]
+    zipMode = "best"
+    if len(sys.argv) == 5:
+        zipMode = sys.argv[4]
+        if zipMode not in CompressionModes:
+            print(f"****Error: invalid compression mode '{zipMode}'; must be one of: {', '.join(CompressionModes)}")
+            sys.exit(1)
+    # every compressed stream is checked by decompressing it
+    verifier = StreamVerifier()
     # parse description file
     ImageColorDict = parseDescription(os.path.join(imgdir, "images.txt"))
 
@@ -329,7 +337,8 @@ if __name__ == "__main__":
             CocoImgData += bytes(((lpix << 4) + rpix,))
         # compress the Coco pixel data
         comp = Compressor(CocoImgData)
-        compImgData = comp.Deflate(bPrintInfo=False, bUseGzip=True)
+        compImgData = comp.Deflate(bPrintInfo=False, mode=zipMode)
+        verifier.Verify(CocoImgData, compImgData, f"image '{imgPngFiles[idx]}'")
         allImageSizes.append((width, height, len(compImgData)))
         # put the palettes, special color indices, and compressed image data into our output stream
         for i in range(16):
@@ -375,4 +384,5 @@ if __name__ == "__main__":
         f.write((" " * 24) + "fcb     " + s + (" " * (16-len(s))) + "* Progress bar color index\n")
         """
     f.close()
+    verifier.PrintSummary()
 
@@ -241,8 +241,8 @@ def StringOut(inString):
 if __name__ == "__main__":
     print("DynoSprite Level Builder script")
     # get input paths
-    if len(sys.argv) != 8:
-        print(f"****Usage: {sys.argv[0]} <in_level_folder> <dynosprite-pass1.lst> <in_gfx_folder> <in_raw_folder> <in_list_folder> <out_cc3_folder> <out_asm_folder>")
+    if len(sys.argv) != 8 and len(sys.argv) != 9:
+        print(f"****Usage: {sys.argv[0]} <in_level_folder> <dynosprite-pass1.lst> <in_gfx_folder> <in_raw_folder> <in_list_folder> <out_cc3_folder> <out_asm_folder> [compress_mode]")
         sys.exit(1)
     leveldir = sys.argv[1]
     dynolist = sys.argv[2]
@@ -251,6 +251,14 @@ if __name__ == "__main__":
     listdir = sys.argv[5]
     cc3dir = sys.argv[6]
     asmdir = sys.argv[7]
+    zipMode = "best"
+    if len(sys.argv) == 9:
+        zipMode = sys.argv[8]
+        if zipMode not in CompressionModes:
+            print(f"****Error: invalid compression mode '{zipMode}'; must be one of: {', '.join(CompressionModes)}")
+            sys.exit(1)
+    # every compressed stream is checked by decompressing it
+    verifier = StreamVerifier()
     # make lists of level files (description, raw/list from asm source, tilemap) found
     filelist = os.listdir(leveldir)
     lvlDescFiles = [name for name in filelist if len(name) >= 6 and name[:2].isdigit() and name[-4:].lower() == ".txt"]
@@ -287,13 +295,15 @@ if __name__ == "__main__":
         lvl.Symbols = SymbolExtract(os.path.join(listdir, lvlListFiles[i]))
         lvl.RawCode = open(os.path.join(rawdir, lvlRawFiles[i]), "rb").read()
         comp = Compressor(lvl.RawCode)
-        lvl.CompCode = comp.Deflate(bPrintInfo=False, bUseGzip=True)
+        lvl.CompCode = comp.Deflate(bPrintInfo=False, mode=zipMode)
+        verifier.Verify(lvl.RawCode, lvl.CompCode, f"level {int(lvl.LvlNumber)} code")
         lvl.validateCode(lvlListFiles[i])
         lvl.parseDescription(os.path.join(leveldir, lvlDescFiles[i]), dynosymbols)
         lvl.validateParameters(lvlDescFiles[i])
         lvl.parseMap(os.path.join(gfxdir, lvlMapFiles[i]))
         comp = Compressor(lvl.tilemap)
-        lvl.CompMap = comp.Deflate(bPrintInfo=False, bUseGzip=True)
+        lvl.CompMap = comp.Deflate(bPrintInfo=False, mode=zipMode)
+        verifier.Verify(lvl.tilemap, lvl.CompMap, f"level {int(lvl.LvlNumber)} tilemap")
         lvl.generateData()
         allLevels.append(lvl)
     # write out the data file
@@ -339,5 +349,6 @@ if __name__ == "__main__":
         f.write(f"Level{int(lvl.LvlNumber):02}Desc             fcn     " + StringOut(lvl.ParamDict["description"]) + "\n")
         f.write(f"Level{int(lvl.LvlNumber):02}Groups           fcb     " + ",".join([str(og) for og in lvl.ObjectGroups]) + "\n")
     f.close()
+    verifier.PrintSummary()
 
 
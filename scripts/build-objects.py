@@ -42,6 +42,9 @@ class Group:
         self.numObjects = 0
         self.objCodeLength = 0
         self.rawData = None
+        self.spriteZipMode = "best"
+        self.objectZipMode = "best"
+        self.verifier = None
     def parseInputs(self):
         # validate symbol tables
         if not 'NumberOfSprites' in self.SprSymbols:
@@ -78,9 +81,11 @@ class Group:
             sys.exit(1)
         # compress the sprite and object code, and generate output data for this group
         comp = Compressor(self.SprRaw[:sdtStart-1])
-        self.compSpriteCode = comp.Deflate(bPrintInfo=False, bUseGzip=False)
+        self.compSpriteCode = comp.Deflate(bPrintInfo=False, mode=self.spriteZipMode)
+        self.verifier.Verify(self.SprRaw[:sdtStart-1], self.compSpriteCode, f"group {int(self.GrpNumber)} sprite code")
         comp = Compressor(self.ObjRaw[:odtStart-1])
-        self.compObjectCode = comp.Deflate(bPrintInfo=False, bUseGzip=True)
+        self.compObjectCode = comp.Deflate(bPrintInfo=False, mode=self.objectZipMode)
+        self.verifier.Verify(self.ObjRaw[:odtStart-1], self.compObjectCode, f"group {int(self.GrpNumber)} object code")
         self.rawData = self.SprRaw[sdtStart:] + self.ObjRaw[odtStart:] + self.compSpriteCode + self.compObjectCode
         # this is here to test/debug decompressor problems in 6809 code
         #open("Group%i-Sprite-Raw.dat" % self.GrpNumber, "wb").write(self.SprRaw[:sdtStart-1])
@@ -133,13 +138,21 @@ def SymbolExtract(listName):
 if __name__ == "__main__":
     print("DynoSprite Object Builder script")
     # get input paths
-    if len(sys.argv) != 5:
-        print(f"****Usage: {sys.argv[0]} <in_raw_folder> <in_list_folder> <out_cc3_folder> <out_asm_folder>")
+    if len(sys.argv) != 5 and len(sys.argv) != 6:
+        print(f"****Usage: {sys.argv[0]} <in_raw_folder> <in_list_folder> <out_cc3_folder> <out_asm_folder> [compress_mode]")
         sys.exit(1)
     rawdir = sys.argv[1]
     listdir = sys.argv[2]
     cc3dir = sys.argv[3]
     asmdir = sys.argv[4]
+    zipMode = None
+    if len(sys.argv) == 6:
+        zipMode = sys.argv[5]
+        if zipMode not in CompressionModes:
+            print(f"****Error: invalid compression mode '{zipMode}'; must be one of: {', '.join(CompressionModes)}")
+            sys.exit(1)
+    # every compressed stream is checked by decompressing it
+    verifier = StreamVerifier()
     # make list of sprite and object description files found
     rawlist = os.listdir(rawdir)
     listlist = os.listdir(listdir)
@@ -172,6 +185,10 @@ if __name__ == "__main__":
         grp.ObjSymbols = SymbolExtract(os.path.join(listdir, objectListFiles[i]))
         grp.SprRaw = open(os.path.join(rawdir, spriteRawFiles[i]), "rb").read()
         grp.ObjRaw = open(os.path.join(rawdir, objectRawFiles[i]), "rb").read()
+        if zipMode is not None:
+            grp.spriteZipMode = zipMode
+            grp.objectZipMode = zipMode
+        grp.verifier = verifier
         grp.parseInputs()
         allGroups.append(grp)
     # write out the data file
@@ -202,4 +219,5 @@ if __name__ == "__main__":
         s = str(grp.numObjects)
         f.write((" " * 24) + "fcb     " + s + (" " * (16-len(s))) + "* number of objects in group\n")
     f.close()
+    verifier.PrintSummary()
 
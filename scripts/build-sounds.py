@@ -37,12 +37,20 @@ from compression import *
 if __name__ == "__main__":
     print("DynoSprite Sound Builder script")
     # get input paths
-    if len(sys.argv) != 4:
-        print(f"****Usage: {sys.argv[0]} <in_raw_folder> <out_cc3_folder> <out_asm_folder>")
+    if len(sys.argv) != 4 and len(sys.argv) != 5:
+        print(f"****Usage: {sys.argv[0]} <in_raw_folder> <out_cc3_folder> <out_asm_folder> [compress_mode]")
         sys.exit(1)
     rawdir = sys.argv[1]
     cc3dir = sys.argv[2]
     asmdir = sys.argv[3]
+    zipMode = "best"
+    if len(sys.argv) == 5:
+        zipMode = sys.argv[4]
+        if zipMode not in CompressionModes:
+            print(f"****Error: invalid compression mode '{zipMode}'; must be one of: {', '.join(CompressionModes)}")
+            sys.exit(1)
+    # every compressed stream is checked by decompressing it
+    verifier = StreamVerifier()
     # make list of raw sound data files found
     filelist = os.listdir(rawdir)
     soundRawFiles = [name for name in filelist if len(name) >= 11 and name[:5] == "sound" and name[5:7].isdigit() and name[-4:].lower() == ".raw"]
@@ -67,7 +75,8 @@ if __name__ == "__main__":
             rawPadding = 256 - rawPadding
         rawSoundData += bytes((0x80,)) * rawPadding
         comp = Compressor(rawSoundData)
-        compSoundData = comp.Deflate(bPrintInfo=False, bUseGzip=True)
+        compSoundData = comp.Deflate(bPrintInfo=False, mode=zipMode)
+        verifier.Verify(rawSoundData, compSoundData, f"sound '{soundRawFiles[idx]}'")
         allCompSoundData += compSoundData
         allSoundSizes.append((len(rawSoundData), len(compSoundData)))
     # write out the data file
@@ -91,4 +100,5 @@ if __name__ == "__main__":
         s = str(allSoundSizes[i][1])
         f.write((" " * 24) + "fdb     " + s + (" " * (16-len(s))) + "* Compressed size / Starting address\n")
     f.close()
+    verifier.PrintSummary()
 
@@ -105,13 +105,21 @@ def SaveMatrix(tileset, section, matrix):
 if __name__ == "__main__":
     print('DynoSprite Tile Builder script')
     # get input paths
-    if len(sys.argv) != 5:
-        print(f'****Usage: {sys.argv[0]} <in_gfx_folder> <in_buildobj_folder> <out_cc3_folder> <out_asm_folder>')
+    if len(sys.argv) != 5 and len(sys.argv) != 6:
+        print(f'****Usage: {sys.argv[0]} <in_gfx_folder> <in_buildobj_folder> <out_cc3_folder> <out_asm_folder> [compress_mode]')
         sys.exit(1)
     gfxdir = sys.argv[1]
     buildobjdir = sys.argv[2]
     cc3dir = sys.argv[3]
     asmdir = sys.argv[4]
+    zipMode = 'best'
+    if len(sys.argv) == 6:
+        zipMode = sys.argv[5]
+        if zipMode not in CompressionModes:
+            print(f"****Error: invalid compression mode '{zipMode}'; must be one of: {', '.join(CompressionModes)}")
+            sys.exit(1)
+    # every compressed stream is checked by decompressing it
+    verifier = StreamVerifier()
     # make list of tileset and palette files found
     filelist = os.listdir(gfxdir)
     setnames = [name[7:-4] for name in filelist if len(name) >= 15 and name[:7] == 'tileset' and name[7:9].isdigit() and name[-4:].lower() == ".txt"]
@@ -231,7 +239,8 @@ if __name__ == "__main__":
             for i in range(128):
                 rawData += bytes([mask[i]])
         comp = Compressor(rawData)
-        zipData = comp.Deflate(bPrintInfo=False, bUseGzip=True)
+        zipData = comp.Deflate(bPrintInfo=False, mode=zipMode)
+        verifier.Verify(rawData, zipData, f"tileset {int(curSet.number)}")
         compressedTilesetLength.append(len(zipData))
         f.write(zipData)
     f.close()
@@ -251,5 +260,6 @@ if __name__ == "__main__":
         s = str(compressedTilesetLength[i])
         f.write((' ' * 24) + 'fdb     ' + s + (' ' * (16-len(s))) + '* compressed tileset size on disk in bytes\n')
     f.close()
+    verifier.PrintSummary()
 
 
@@ -28,7 +28,126 @@
 
 import os
 import sys
-import subprocess
+import math
+import time
+import zlib
+import heapq
+import hashlib
+import concurrent.futures
+
+# LZ77 window and match limits imposed by the DEFLATE format (and by the 5 history pages in decompress.asm)
+WindowSize = 32768
+WindowMask = WindowSize - 1
+MinMatch = 3
+MaxMatch = 258
+
+# match finder tuning for each compression mode, following zlib's configuration table:
+#   (goodLength, maxLazy, niceLength, maxChain)
+# goodLength: reduce the chain search by 4x if the previous match is at least this long
+# maxLazy:    don't look for a better match at the next byte if the current one is this long (0 == greedy)
+# niceLength: stop searching as soon as a match of this length is found
+# maxChain:   maximum number of hash chain links to follow when searching for a match
+MatchParams = { "greedy": (32, 0, 258, 4096),
+                "lazy":   (32, 258, 258, 4096) }
+
+# optimal parsing searches deeper hash chains, and refines its symbol cost model for up to this many passes
+OptimalMaxChain = 1024
+OptimalIterations = 15
+OptimalGoodLength = 32
+
+# modes which may be given to Compressor.Deflate()
+CompressionModes = ("best", "gzip", "greedy", "lazy", "optimal", "speed")
+
+# compressed streams are cached in the folder given by the DYNO_CACHE_DIR environment variable (if it is set).
+# The compressor version is part of every cache key, so it must be increased whenever the output of any mode
+# changes.  When the cache grows past CacheMaxBytes, the least recently used streams are deleted
+CompressorVersion = 1
+CacheMaxBytes = 64 * 1048576
+
+# the 'best' mode tries each of these encoders, and keeps the smallest stream which decompress.asm can decode.
+# Each candidate is ("native", mode) or ("zlib", (level, strategy))
+BestCandidates = ( ("native", "greedy"),
+                   ("native", "lazy"),
+                   ("native", "optimal"),
+                   ("zlib", (1, zlib.Z_DEFAULT_STRATEGY)),
+                   ("zlib", (6, zlib.Z_DEFAULT_STRATEGY)),
+                   ("zlib", (9, zlib.Z_DEFAULT_STRATEGY)),
+                   ("zlib", (9, zlib.Z_FILTERED)),
+                   ("zlib", (9, zlib.Z_RLE)),
+                   ("zlib", (9, zlib.Z_HUFFMAN_ONLY)),
+                   ("zlib", (9, zlib.Z_FIXED)) )
+
+# block splitting: the symbol stream is cut into at most BlockSplitMaxBlocks blocks, no smaller than
+# BlockSplitMinSymbols symbols each.  The best split point within a block is found by sampling
+# BlockSplitSamples evenly spaced points and then narrowing the search range around the best one
+BlockSplitMaxBlocks = 15
+BlockSplitMinSymbols = 64
+BlockSplitSamples = 9
+
+# stored blocks may hold at most this many bytes
+StoredBlockMaxLen = 65535
+
+# the 'speed' mode looks for the stream which loads fastest on the CoCo, instead of the smallest one.  Its
+# cost model gives the approximate number of 6809 cycles spent on each part of the stream by decompress.asm
+OutputPageSize = 8192           # decompress.asm writes its output in 8k pages, aligned to the start of the stream
+SpeedCyclesPerBit = 16          # disk read time for each bit of compressed data
+SpeedCyclesPerSymbol = 70       # Decomp_GetHuffmanValue call and DecodeLoop@ overhead for each literal/length code
+SpeedCyclesPerCodeBit = 26      # each bit of a Huffman code is one step down the tree in Decomp_GetHuffmanValue
+SpeedCyclesPerExtraBit = 30     # extra length and distance bits are read by Decomp_GetBits
+SpeedCyclesPerCopy = 200        # distance code decoding, length/distance calculation and history page mapping
+SpeedCyclesPerCopyByte = 35     # one pass through CopyLoop@
+SpeedCyclesPageCross = 150      # string copy with a source or destination which crosses an 8k page boundary
+SpeedCyclesTreeScan = 19        # Decomp_CreateHuffmanTree scans all of the code lengths once for each tree level
+SpeedCyclesPerLengthCode = 150  # decoding one RLE code length symbol in the header of a dynamic block
+SpeedCyclesFixedTables = (288 * 9 + 32 * 5) * SpeedCyclesTreeScan + 320 * 12
+# shorter code length limits give trees with fewer levels, which are faster to build
+SpeedCodeBitLimits = (15, 12, 10)
+
+def CalcLengthCode(copylen):
+    # calculate a length code (symbol number, # of extra bits, value of extra bits)
+    if copylen <= 10:
+        return (254 + copylen, 0, 0)
+    if copylen == 258:  # special case
+        return (285, 0, 0)
+    lengthBitsNum = 1
+    levelEnd = 18
+    while copylen > levelEnd:
+        lengthBitsNum += 1
+        levelEnd = (levelEnd * 2) - 2
+    valBase = copylen - (1 << (lengthBitsNum + 2)) - 3
+    lengthCode = 261 + (lengthBitsNum * 4) + (valBase >> lengthBitsNum)
+    lengthBitsVal = valBase & ((1 << lengthBitsNum) - 1)
+    return (lengthCode, lengthBitsNum, lengthBitsVal)
+
+def CalcDistanceCode(copydist):
+    # calculate a distance code (symbol number, # of extra bits, value of extra bits)
+    if copydist <= 4:
+        return (copydist - 1, 0, 0)
+    distBitsNum = 1
+    levelEnd = 8
+    while copydist > levelEnd:
+        distBitsNum += 1
+        levelEnd *= 2
+    valBase = copydist - (1 << (distBitsNum + 1)) - 1
+    distCode = (distBitsNum + 1) * 2 + (valBase >> distBitsNum)
+    distBitsVal = valBase & ((1 << distBitsNum) - 1)
+    return (distCode, distBitsNum, distBitsVal)
+
+# the symbol coding is called for every string copy, so pre-calculate it
+LengthCodeTable = [ None ] * MinMatch + [ CalcLengthCode(copylen) for copylen in range(MinMatch, MaxMatch+1) ]
+
+# smallest copy length for each length code, so that we can find the number of bytes covered by a symbol
+LengthCodeBase = [ 0 ] * 286
+for copylen in range(MaxMatch, MinMatch-1, -1):
+    LengthCodeBase[LengthCodeTable[copylen][0]] = copylen
+
+# smallest copy distance for each distance code
+DistCodeBase = [ code + 1 if code < 4 else (2 << ((code - 2) >> 1)) + ((code - 2) & 1) * (1 << ((code - 2) >> 1)) + 1
+                 for code in range(30) ]
+
+# code lengths for the fixed Huffman trees (BTYPE=1)
+FixedLenCodeLengths = ([8] * 144) + ([9] * 112) + ([7] * 24) + ([8] * 8)
+FixedDistCodeLengths = [5] * 30
 
 class HuffNode:
     def __init__(self):
@@ -37,227 +156,284 @@ class HuffNode:
         self.child0 = None
         self.child1 = None
 
+class HuffmanTables:
+    def __init__(self):
+        # each code list element is: (codeBits, codeValue)
+        self.lenHuffCodes = None
+        self.distHuffCodes = None
+        self.rleHuffCodes = None
+        self.numLenCodes = 0
+        self.numDistCodes = 0
+        self.numRleCodes = 0
+        self.rleCodeLengthsReorder = None
+        # RLE-compressed code lengths, each element is (rleCode, extraBits)
+        self.lenHistRLE = None
+        self.distHistRLE = None
+
+# Huffman decoding tables: the primary table is indexed by the next 9 bits of input.  Each entry is
+# (symbol, codeLen, None), or (None, 0, (subBits, subTable)) for codes longer than 9 bits, where the
+# secondary table is indexed by the next subBits bits after the first 9.  Unused codes are None
+PrimaryTableBits = 9
+PrimaryTableMask = (1 << PrimaryTableBits) - 1
+
 class BitReader:
     def __init__(self, inputData):
-        self.inBuffer = inputData
-        self.curByteIdx = 0
-        self.nextBitIdx = 0
-        self.curByte = inputData[0]
+        self.inBuffer = bytes(inputData)
+        self.curByteIdx = 0         # index of next byte to load into the accumulator
+        # bits are consumed from the LSB end of bitAccum, which holds numAccumBits valid bits
+        self.bitAccum = 0
+        self.numAccumBits = 0
+
+    def FillAccum(self, numBits):
+        # load whole bytes (8 at a time) until the accumulator holds at least numBits, or the input runs out
+        while self.numAccumBits < numBits and self.curByteIdx < len(self.inBuffer):
+            newBytes = self.inBuffer[self.curByteIdx:self.curByteIdx+8]
+            self.bitAccum |= int.from_bytes(newBytes, "little") << self.numAccumBits
+            self.numAccumBits += len(newBytes) * 8
+            self.curByteIdx += len(newBytes)
 
     def GetBits(self, numBits):
-        value = 0
-        for i in range(numBits):
-            value |= ((self.curByte >> self.nextBitIdx) & 1) << i
-            self.nextBitIdx += 1
-            if self.nextBitIdx == 8:
-                self.nextBitIdx = 0
-                self.curByteIdx += 1
-                if self.curByteIdx < len(self.inBuffer):
-                    self.curByte = self.inBuffer[self.curByteIdx]
-                else:
-                    self.curByte = None # throw an exception if we try to read one more bit
+        if self.numAccumBits < numBits:
+            self.FillAccum(numBits)
+            if self.numAccumBits < numBits:
+                raise Exception("BitReader::GetBits error: read past the end of the input data")
+        value = self.bitAccum & ((1 << numBits) - 1)
+        self.bitAccum >>= numBits
+        self.numAccumBits -= numBits
         return value
 
-    def GetSymbol(self, huffRoot):
-        # loop until we get a symbol value
-        while True:
-            # get 1 bit
-            newBit = ((self.curByte >> self.nextBitIdx) & 1)
-            self.nextBitIdx += 1
-            if self.nextBitIdx == 8:
-                self.nextBitIdx = 0
-                self.curByteIdx += 1
-                if self.curByteIdx < len(self.inBuffer):
-                    self.curByte = self.inBuffer[self.curByteIdx]
-                else:
-                    self.curByte = None # throw an exception if we try to read one more bit
-            # traverse one level down in the tree
-            if newBit == 0:
-                huffRoot = huffRoot.child0
-            else:
-                huffRoot = huffRoot.child1
-            # break out if we have arrived at a leaf
-            if huffRoot.value is not None:
-                return huffRoot.value
-            # otherwise we will get another bit
+    def GetSymbol(self, decodeTable):
+        # make sure that we have enough bits for the longest possible code
+        if self.numAccumBits < 15:
+            self.FillAccum(15)
+        # look up the next 9 bits in the primary table, and the following bits in a secondary table if necessary
+        entry = decodeTable[self.bitAccum & PrimaryTableMask]
+        if entry is not None and entry[2] is not None:
+            (subBits, subTable) = entry[2]
+            entry = subTable[(self.bitAccum >> PrimaryTableBits) & ((1 << subBits) - 1)]
+        if entry is None:
+            raise Exception("BitReader::GetSymbol error: invalid Huffman code in input data")
+        (symbol, codeLen, subTableInfo) = entry
+        if codeLen > self.numAccumBits:
+            raise Exception("BitReader::GetSymbol error: read past the end of the input data")
+        self.bitAccum >>= codeLen
+        self.numAccumBits -= codeLen
+        return symbol
+
+    def AlignToByte(self):
+        # skip the bits up to the next byte boundary, for stored blocks
+        self.GetBits(self.numAccumBits & 7)
+
+    def GetBytes(self, numBytes):
+        # read raw bytes; the input must already be aligned to a byte boundary
+        numAccumBytes = min(numBytes, self.numAccumBits >> 3)
+        outBytes = self.GetBits(numAccumBytes * 8).to_bytes(numAccumBytes, "little")
+        if numBytes > numAccumBytes:
+            numBufBytes = numBytes - numAccumBytes
+            if self.curByteIdx + numBufBytes > len(self.inBuffer):
+                raise Exception("BitReader::GetBytes error: read past the end of the input data")
+            outBytes += self.inBuffer[self.curByteIdx:self.curByteIdx+numBufBytes]
+            self.curByteIdx += numBufBytes
+        return outBytes
+
+# table to reverse the order of the bits in a byte, for writing Huffman codes MSB-first
+ReverseByteTable = [ int(f"{i:08b}"[::-1], 2) for i in range(256) ]
 
 class BitWriter:
-    def __init__(self):
-        self.outBuffer = b''
-        self.curByte = 0
-        self.nextBitIdx = 0
+    def __init__(self, bufferSize=4096):
+        # the output buffer is preallocated, and doubled in size whenever it fills up
+        self.outBuffer = bytearray(max(bufferSize, 16))
+        self.outLen = 0
+        # bits are added at the MSB end of bitAccum, which holds numAccumBits valid bits
+        self.bitAccum = 0
+        self.numAccumBits = 0
 
     def AddBits(self, numBits, value, bIsCode):
         # check to make sure input is valid
         if (value >> numBits) != 0:
             raise Exception(f"BitWriter::AddBits error: the value {int(value)} doesn't fit within {int(numBits)} bits")
-        # pack the bits in our accumulator
+        # huffman codes are written starting with the MSB, so reverse them (all codes are 15 bits or less)
         if bIsCode:
-            for bitIdxIn in range(numBits-1,-1,-1):
-                self.curByte |= ((value >> bitIdxIn) & 1) << self.nextBitIdx
-                self.nextBitIdx += 1
-                if self.nextBitIdx == 8:
-                    self.outBuffer += bytes((self.curByte,))
-                    self.curByte = 0
-                    self.nextBitIdx = 0
-        else:
-            for i in range(numBits):
-                self.curByte |= (value & 1) << self.nextBitIdx
-                value >>= 1
-                self.nextBitIdx += 1
-                if self.nextBitIdx == 8:
-                    self.outBuffer += bytes((self.curByte,))
-                    self.curByte = 0
-                    self.nextBitIdx = 0
+            value = ((ReverseByteTable[value & 0xff] << 8) | ReverseByteTable[value >> 8]) >> (16 - numBits)
+        # pack the bits in our accumulator, and write them out 8 bytes at a time
+        self.bitAccum |= value << self.numAccumBits
+        self.numAccumBits += numBits
+        if self.numAccumBits >= 64:
+            self.FlushBytes(8)
+
+    def FlushBytes(self, numBytes):
+        if self.outLen + numBytes > len(self.outBuffer):
+            self.outBuffer.extend(bytes(max(len(self.outBuffer), numBytes)))
+        self.outBuffer[self.outLen:self.outLen+numBytes] = (self.bitAccum & ((1 << (numBytes * 8)) - 1)).to_bytes(numBytes, "little")
+        self.outLen += numBytes
+        self.bitAccum >>= numBytes * 8
+        self.numAccumBits -= numBytes * 8
+
+    def GetBitPosition(self):
+        return self.outLen * 8 + self.numAccumBits
+
+    def AlignToByte(self):
+        # pad with zeros up to the next byte boundary, for stored blocks
+        self.numAccumBits = (self.numAccumBits + 7) & ~7
+
+    def AddBytes(self, newBytes):
+        # write raw bytes; the output must already be aligned to a byte boundary
+        self.FlushBytes(self.numAccumBits >> 3)
+        if self.outLen + len(newBytes) > len(self.outBuffer):
+            self.outBuffer.extend(bytes(max(len(self.outBuffer), len(newBytes))))
+        self.outBuffer[self.outLen:self.outLen+len(newBytes)] = newBytes
+        self.outLen += len(newBytes)
 
     def Finalize(self):
-        if self.nextBitIdx > 0:
-            self.outBuffer += bytes((self.curByte,))
-        self.curByte = None
-        self.nextBitIdx = None
+        self.AlignToByte()
+        self.FlushBytes(self.numAccumBits >> 3)
 
     def GetData(self):
-        return self.outBuffer
+        return bytes(self.outBuffer[:self.outLen])
 
 class Compressor:
     def __init__(self, inputdata):
-        self.inputdata = inputdata
-        self.outputbitstream = BitWriter()
+        self.inputdata = bytes(inputdata)
+        self.outputbitstream = BitWriter(len(self.inputdata) + 1024)
         # each symbol in lz77SymbolList is (LenCode, LenBits, DistCode, DistBits), where:
         #   LenCode is between 0 and 285
         #   LenBits is a tuple (NumExtraBits, ValExtraBits) or None
         #   DistCode is between 0 and 29, or None
         #   DistBits in a tuple (NumExtraBits, ValExtraBits) or None
         self.lz77SymbolList = []
+        # in 'speed' mode, all of the costs are estimated load times instead of sizes in bits
+        self.bSpeed = False
+        # the fixed Huffman codes are used for blocks which are too small to pay for their own trees
+        self.fixedLenHuffCodes = self.GenHuffmanCodesFromLengths(FixedLenCodeLengths)
+        self.fixedDistHuffCodes = self.GenHuffmanCodesFromLengths(FixedDistCodeLengths)
+
+    def FindLongestMatch(self, inIdx, prevPos, bestLen, maxChain, niceLen):
+        # follow the hash chain (newest to oldest) looking for the longest string copy which starts at inIdx
+        data = self.inputdata
+        maxLen = min(MaxMatch, len(data) - inIdx)
+        niceLen = min(niceLen, maxLen)
+        bestDist = 0
+        limit = inIdx - WindowSize
+        origIdx = self.hashHead.get(data[inIdx:inIdx+MinMatch], -1)
+        while origIdx >= 0 and origIdx >= limit and maxChain > 0:
+            maxChain -= 1
+            # quick reject: a longer copy must also match at the byte which ends our current best copy
+            if bestLen < maxLen and data[origIdx+bestLen] == data[inIdx+bestLen]:
+                # every string on this chain shares the same 3-byte key, so start comparing after it
+                copylen = MinMatch
+                while copylen + 8 <= maxLen and data[origIdx+copylen:origIdx+copylen+8] == data[inIdx+copylen:inIdx+copylen+8]:
+                    copylen += 8
+                while copylen < maxLen and data[origIdx+copylen] == data[inIdx+copylen]:
+                    copylen += 1
+                if copylen > bestLen:
+                    bestLen = copylen
+                    bestDist = inIdx - origIdx
+                    if copylen >= niceLen:
+                        break
+            origIdx = prevPos[origIdx & WindowMask]
+        if bestDist == 0:
+            return (0, 0)
+        return (bestLen, bestDist)
+
+    def InsertHash(self, inIdx, prevPos):
+        key = self.inputdata[inIdx:inIdx+MinMatch]
+        prevPos[inIdx & WindowMask] = self.hashHead.get(key, -1)
+        self.hashHead[key] = inIdx
+
+    def AddCopySymbol(self, copylen, copydist):
+        (lengthCode, lengthBitsNum, lengthBitsVal) = LengthCodeTable[copylen]
+        (distCode, distBitsNum, distBitsVal) = CalcDistanceCode(copydist)
+        self.lz77SymbolList.append((lengthCode, (lengthBitsNum, lengthBitsVal), distCode, (distBitsNum, distBitsVal)))
 
-    def GenerateSymbolList(self):
-        inDataLen = len(self.inputdata)
-        # this is an expensive operation, so use a hash table
-        matchHash = { }
-        # first symbol is always a byte value
-        self.lz77SymbolList.append(((self.inputdata[0]), None, None, None))
-        inIdx = 1
-        if inDataLen >= 3:
-            matchHash[self.inputdata[0:3]] = [ 0 ]
+    def GenerateSymbolList(self, mode):
+        (goodLength, maxLazy, niceLength, maxChain) = MatchParams[mode]
+        data = self.inputdata
+        inDataLen = len(data)
+        # hash chains: hashHead gives the newest position for each 3-byte string, and prevPos is a ring buffer
+        # over the 32k window which links each position to the previous one with the same 3-byte string
+        self.hashHead = { }
+        prevPos = [ -1 ] * WindowSize
+        lastHashIdx = inDataLen - MinMatch      # last position which has 3 bytes for a hash key
+        # with lazy matching, a copy found at inIdx-1 is held back until we know that inIdx doesn't have a better one
+        prevLen = 0
+        prevDist = 0
+        bPendingLiteral = False
+        inIdx = 0
         while inIdx < inDataLen:
-            # if fewer than 3 bytes remaining, then we will write literals
-            if (inDataLen - inIdx) < 3:
-                self.lz77SymbolList.append(((self.inputdata[inIdx]), None, None, None))
-                inIdx += 1
+            # search for the best string copy starting here, then add this position to the hash chains
+            curLen = 0
+            curDist = 0
+            if inIdx <= lastHashIdx:
+                if maxLazy == 0 or prevLen < maxLazy:
+                    chainLen = maxChain if prevLen < goodLength else (maxChain >> 2)
+                    (curLen, curDist) = self.FindLongestMatch(inIdx, prevPos, max(prevLen, MinMatch - 1), chainLen, niceLength)
+                    # a 3-byte copy from far away costs more bits than just writing the literals
+                    if curLen == MinMatch and curDist > 4096:
+                        curLen = 0
+                self.InsertHash(inIdx, prevPos)
+            # greedy mode: take any copy right away
+            if maxLazy == 0:
+                if curLen < MinMatch:
+                    self.lz77SymbolList.append((data[inIdx], None, None, None))
+                    inIdx += 1
+                    continue
+                self.AddCopySymbol(curLen, curDist)
+                for i in range(inIdx+1, min(inIdx+curLen, lastHashIdx+1)):
+                    self.InsertHash(i, prevPos)
+                inIdx += curLen
                 continue
-            # search for the best string copy
-            bestCopy = (0, 0)  # length, distance
-            matchKey = self.inputdata[inIdx:inIdx+3]
-            if matchKey in matchHash:
-                matchList = matchHash[matchKey]
-                for origIdx in matchList[:]:
-                    if (inIdx - origIdx) > 32768:
-                        matchList.remove(origIdx)
-                        continue
-                    i1 = origIdx
-                    i2 = inIdx
-                    copylen = 0
-                    while i2 < inDataLen and self.inputdata[i1] == self.inputdata[i2] and copylen < 258:
-                        i1 += 1
-                        i2 += 1
-                        copylen += 1
-                    if copylen >= bestCopy[0]:
-                        bestCopy = (copylen, inIdx - origIdx)
-            # output a byte value if there is no good copy from here
-            copylen = bestCopy[0]
-            if copylen < 3:
-                self.lz77SymbolList.append(((self.inputdata[inIdx]), None, None, None))
-                if matchKey in matchHash:
-                    matchHash[matchKey].append(inIdx)
-                else:
-                    matchHash[matchKey] = [ inIdx ]
-                inIdx += 1
+            # lazy mode: if the copy from the previous position is at least as good as this one, then use it
+            if prevLen >= MinMatch and curLen <= prevLen:
+                self.AddCopySymbol(prevLen, prevDist)
+                # update our match hash table for all the intermediate bytes
+                copyEnd = inIdx - 1 + prevLen
+                for i in range(inIdx+1, min(copyEnd, lastHashIdx+1)):
+                    self.InsertHash(i, prevPos)
+                inIdx = copyEnd
+                prevLen = 0
+                bPendingLiteral = False
                 continue
-            # update our match hash table for all the intermediate bytes
-            for i in range(copylen):
-                if (inDataLen - inIdx - i) >= 3:
-                    newKey = self.inputdata[inIdx+i:inIdx+i+3]
-                    if newKey in matchHash:
-                        matchHash[newKey].append(inIdx+i)
-                    else:
-                        matchHash[newKey] = [ inIdx+i ]
-            # calculate a length code (symbol number, # of extra bits, value of extra bits)
-            if copylen <= 10:
-                lengthCode = 254 + copylen
-                lengthBitsNum = 0
-                lengthBitsVal = 0
-            elif copylen == 258:  # special case
-                lengthCode = 285
-                lengthBitsNum = 0
-                lengthBitsVal = 0
-            else:
-                lengthBitsNum = 1
-                levelEnd = 18
-                while copylen > levelEnd:
-                    lengthBitsNum += 1
-                    levelEnd = (levelEnd * 2) - 2
-                valBase = copylen - (1 << (lengthBitsNum + 2)) - 3
-                lengthCode = 261 + (lengthBitsNum * 4) + (valBase >> lengthBitsNum)
-                lengthBitsVal = valBase & ((1 << lengthBitsNum) - 1)
-            # calculate a distance code (symbol number, # of extra bits, value of extra bits)
-            copydist = bestCopy[1]
-            if copydist <= 4:
-                distCode = copydist - 1
-                distBitsNum = 0
-                distBitsVal = 0
-            else:
-                distBitsNum = 1
-                levelEnd = 8
-                while copydist > levelEnd:
-                    distBitsNum += 1
-                    levelEnd *= 2
-                valBase = copydist - (1 << (distBitsNum + 1)) - 1
-                distCode = (distBitsNum + 1) * 2 + (valBase >> distBitsNum)
-                distBitsVal = valBase & ((1 << distBitsNum) - 1)
-            # output a (length, distance) string copy symbol
-            self.lz77SymbolList.append((lengthCode, (lengthBitsNum, lengthBitsVal), distCode, (distBitsNum, distBitsVal)))
-            # advance our current index value
-            inIdx += copylen
+            # otherwise the previous byte becomes a literal and we hold onto the copy from here
+            if bPendingLiteral:
+                self.lz77SymbolList.append((data[inIdx-1], None, None, None))
+            prevLen = curLen
+            prevDist = curDist
+            bPendingLiteral = True
+            inIdx += 1
+        if bPendingLiteral:
+            self.lz77SymbolList.append((data[inDataLen-1], None, None, None))
         # output the termination code
-        self.lz77SymbolList.append((256, None, None, None))   
+        self.lz77SymbolList.append((256, None, None, None))
 
     def GenerateHuffmanTree(self, histogram):
-        # make list of 'loose' huffman nodes
-        nodeList = []
+        # make a heap of 'loose' huffman nodes, ordered by weight.  The node counter breaks ties
+        # between equal weights, so that the heap never has to compare two HuffNode objects
+        nodeHeap = []
         for idx in range(len(histogram)):
             if histogram[idx] > 0:
                 n = HuffNode()
                 n.weight = histogram[idx]
                 n.value = idx
-                nodeList.append(n)
+                nodeHeap.append((n.weight, len(nodeHeap), n))
         # if tree is empty (histogram is all zeros), then return a special case
-        if len(nodeList) == 0:
+        if len(nodeHeap) == 0:
             n = HuffNode()
             n.value = 0
             return n
+        heapq.heapify(nodeHeap)
+        nodeCount = len(nodeHeap)
         # assemble the tree
         # loop until there is only 1 node, the root
-        while len(nodeList) > 1:
-            if nodeList[1].weight < nodeList[0].weight:
-                small = 0
-                smallest = 1
-            else:
-                small = 1
-                smallest = 0
-            for idx in range(2,len(nodeList)):
-                if nodeList[idx].weight < nodeList[smallest].weight:
-                    small = smallest
-                    smallest = idx
-                elif nodeList[idx].weight < nodeList[small].weight:
-                    small = idx
+        while len(nodeHeap) > 1:
+            smallest = heapq.heappop(nodeHeap)[2]
+            small = heapq.heappop(nodeHeap)[2]
             n = HuffNode()
-            n.weight = nodeList[smallest].weight + nodeList[small].weight
-            n.child0 = nodeList[smallest]
-            n.child1 = nodeList[small]
-            nodeList.remove(n.child0)
-            nodeList.remove(n.child1)
-            nodeList.append(n)
-        return nodeList[0]
+            n.weight = smallest.weight + small.weight
+            n.child0 = smallest
+            n.child1 = small
+            heapq.heappush(nodeHeap, (n.weight, nodeCount, n))
+            nodeCount += 1
+        return nodeHeap[0][2]
 
     def InvertHuffNode(self, huffCodes, node, preBits, preVal):
         if node.value != None:
@@ -266,7 +442,7 @@ class Compressor:
         self.InvertHuffNode(huffCodes, node.child0, preBits+1, preVal*2 + 0)
         self.InvertHuffNode(huffCodes, node.child1, preBits+1, preVal*2 + 1)
 
-    def InvertHuffmanTree(self, huffTree, maxSymbol, maxBits):
+    def InvertHuffmanTree(self, huffTree, maxSymbol):
         huffCodes = [ (0,0) for i in range(maxSymbol) ]
         # handle special case
         if huffTree.value != None:
@@ -274,12 +450,44 @@ class Compressor:
         else:
             # let somebody else do the work
             self.InvertHuffNode(huffCodes, huffTree, 0, 0)
-        # check to make sure it's legal
-        for (bits,codeval) in huffCodes:
-            if bits is not None and bits > maxBits:
-                raise Exception(f"Huffman tree contains codes longer than maximum allowed ({int(maxBits)})")
         return huffCodes
 
+    def LimitHuffmanLengths(self, histogram, maxBits):
+        # package-merge algorithm: find the optimal code lengths which are no longer than maxBits.  Each
+        # item is (weight, symbol, child0, child1); leaves have a symbol, and packages have two children
+        leafList = sorted([ (histogram[idx], idx, None, None) for idx in range(len(histogram)) if histogram[idx] > 0 ],
+                          key=lambda item: item[0])
+        numLeaves = len(leafList)
+        if (1 << maxBits) < numLeaves:
+            raise Exception(f"Can't encode {int(numLeaves)} symbols with codes of {int(maxBits)} bits or less")
+        # start with the leaves at the deepest level, and then at each level above, merge the leaves with
+        # packages made by pairing up the items in the level below
+        itemList = leafList
+        for level in range(1, maxBits):
+            packageList = [ (itemList[i][0] + itemList[i+1][0], None, itemList[i], itemList[i+1])
+                            for i in range(0, len(itemList) - 1, 2) ]
+            itemList = sorted(leafList + packageList, key=lambda item: item[0])
+        # the code length of each symbol is the number of times that its leaf appears in the first 2n-2 items
+        huffLengths = [ 0 ] * len(histogram)
+        itemStack = itemList[:2*numLeaves-2]
+        while len(itemStack) > 0:
+            (weight, symbol, child0, child1) = itemStack.pop()
+            if symbol is not None:
+                huffLengths[symbol] += 1
+            else:
+                itemStack.append(child0)
+                itemStack.append(child1)
+        return huffLengths
+
+    def GenerateHuffmanLengths(self, histogram, maxBits):
+        # get the optimal code lengths from a Huffman tree, and fall back to the slower package-merge
+        # algorithm only if the tree is too deep for DEFLATE
+        huffTree = self.GenerateHuffmanTree(histogram)
+        huffLengths = [ bits for (bits, codeval) in self.InvertHuffmanTree(huffTree, len(histogram)) ]
+        if max(huffLengths) > maxBits:
+            huffLengths = self.LimitHuffmanLengths(histogram, maxBits)
+        return huffLengths
+
     def GenHuffmanCodesFromLengths(self, huffLengths):
         numCodes = len(huffLengths)
         maxLength = max(huffLengths)
@@ -340,108 +548,326 @@ class Compressor:
         # all done
         return histRLE
 
-    def DeflateWithGzip(self, bPrintInfo):
-        # call 'gzip' to compress the input data
-        args = [ b"gzip", b"-9", b"-" ]
-        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        (compData, errData) = p.communicate(self.inputdata)
-        # strip the gzip headers/footer
-        rawData = Decompressor.StripGZ(compData, bPrintInfo)
-        return rawData
+    def DeflateWithZlib(self, level, strategy):
+        # use the zlib module to make a raw DEFLATE stream (negative window bits means no zlib header)
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15, 9, strategy)
+        return comp.compress(self.inputdata) + comp.flush()
 
-    def Deflate(self, bPrintInfo, bUseGzip):
-        if bPrintInfo:
-            print(f"{int(len(self.inputdata))} bytes in input file.")
-        # call separate function to use GZIP if necessary
-        if bUseGzip:
-            outputData = self.DeflateWithGzip(bPrintInfo)
-            return outputData
-        # start by eliminating string redundancies converting uncompressed data to LZ77 symbol list
-        self.GenerateSymbolList()
-        if bPrintInfo:
-            print(f"{int(len(self.lz77SymbolList))} LZ77 symbols generated")
-        # now generate histograms of value/length codes and distance codes
+    def DeflateBest(self, bPrintInfo):
+        # compress with every candidate encoder in parallel, and keep the smallest valid stream
+        pool = GetWorkerPool()
+        if pool is None:
+            results = [ DeflateCandidate(self.inputdata, candidate) for candidate in BestCandidates ]
+        else:
+            futures = [ pool.submit(DeflateCandidate, self.inputdata, candidate) for candidate in BestCandidates ]
+            results = [ future.result() for future in futures ]
+        bestData = None
+        for (candidate, compData) in zip(BestCandidates, results):
+            if bPrintInfo:
+                resultText = "rejected" if compData is None else f"{int(len(compData))} bytes"
+                print(f"    {candidate[0]} {candidate[1]}: {resultText}")
+            if compData is not None and (bestData is None or len(compData) < len(bestData)):
+                bestData = compData
+        if bestData is None:
+            raise Exception("No compression strategy produced a valid stream")
+        return bestData
+
+    def FindAllMatches(self, maxChain):
+        # for every position, make a list of (length, distance, distCode, distExtraBits) string copies, in order
+        # of increasing length.  Each one gives the shortest distance for all lengths from the previous entry's
+        # length + 1 up to its own length
+        data = self.inputdata
+        inDataLen = len(data)
+        self.hashHead = { }
+        prevPos = [ -1 ] * WindowSize
+        matchList = [ ]
+        for inIdx in range(inDataLen):
+            matches = [ ]
+            if inIdx + MinMatch <= inDataLen:
+                maxLen = min(MaxMatch, inDataLen - inIdx)
+                bestLen = MinMatch - 1
+                limit = inIdx - WindowSize
+                origIdx = self.hashHead.get(data[inIdx:inIdx+MinMatch], -1)
+                chainLeft = maxChain
+                bChainShortened = False
+                while origIdx >= 0 and origIdx >= limit and chainLeft > 0:
+                    chainLeft -= 1
+                    if data[origIdx+bestLen] == data[inIdx+bestLen]:
+                        copylen = MinMatch
+                        while copylen + 8 <= maxLen and data[origIdx+copylen:origIdx+copylen+8] == data[inIdx+copylen:inIdx+copylen+8]:
+                            copylen += 8
+                        while copylen < maxLen and data[origIdx+copylen] == data[inIdx+copylen]:
+                            copylen += 1
+                        if copylen > bestLen:
+                            bestLen = copylen
+                            copydist = inIdx - origIdx
+                            (distCode, distBitsNum, distBitsVal) = CalcDistanceCode(copydist)
+                            matches.append((copylen, copydist, distCode, distBitsNum))
+                            if copylen == maxLen:
+                                break
+                            # once we have a good copy, longer ones are less likely, so shorten the search
+                            if copylen >= OptimalGoodLength and not bChainShortened:
+                                chainLeft >>= 2
+                                bChainShortened = True
+                    origIdx = prevPos[origIdx & WindowMask]
+                self.InsertHash(inIdx, prevPos)
+            matchList.append(matches)
+        return matchList
+
+    def CalcSymbolCosts(self, lenCodeHist, distCodeHist):
+        # estimate the cost in bits of each literal/length and distance symbol from its probability
+        costs = [ ]
+        for hist in (lenCodeHist, distCodeHist):
+            total = sum(hist)
+            if total == 0:
+                costs.append([ 0.0 ] * len(hist))
+                continue
+            log2sum = math.log2(total)
+            # symbols which are not in the histogram get the cost of the rarest possible symbol
+            costs.append([ log2sum - math.log2(count) if count > 0 else log2sum for count in hist ])
+        return costs
+
+    def OptimalParse(self, matchList, lenSymCost, distSymCost):
+        # find the cheapest path through the graph of all literals and string copies, with dynamic programming
+        data = self.inputdata
+        inDataLen = len(data)
+        # in 'speed' mode, copies also pay for their decoding time, and for crossing output page boundaries
+        extraBitCost = 1
+        copyCost = 0
+        copyByteCost = 0
+        pageCrossCost = 0
+        if self.bSpeed:
+            extraBitCost = SpeedCyclesPerExtraBit + SpeedCyclesPerBit
+            copyCost = SpeedCyclesPerCopy
+            copyByteCost = SpeedCyclesPerCopyByte
+            pageCrossCost = SpeedCyclesPageCross
+        # the cost of each copy length, and each distance code, including their extra bits
+        lengthCost = [ 0.0 ] * (MaxMatch + 1)
+        for copylen in range(MinMatch, MaxMatch + 1):
+            (lengthCode, lengthBitsNum, lengthBitsVal) = LengthCodeTable[copylen]
+            lengthCost[copylen] = lenSymCost[lengthCode] + lengthBitsNum * extraBitCost + copyCost + copylen * copyByteCost
+        literalCost = lenSymCost[:256]
+        inf = float("inf")
+        pathCost = [ inf ] * (inDataLen + 1)
+        pathCost[0] = 0.0
+        pathLen = [ 1 ] * (inDataLen + 1)
+        pathDist = [ 0 ] * (inDataLen + 1)
+        runLength = self.sameByteRun
+        inIdx = 0
+        while inIdx < inDataLen:
+            curCost = pathCost[inIdx]
+            # in the middle of a long run of the same byte value, just take the longest copy (like zopfli)
+            if inIdx > MaxMatch and runLength[inIdx] > MaxMatch * 2 and runLength[inIdx - MaxMatch] > MaxMatch:
+                newIdx = inIdx + MaxMatch
+                newCost = curCost + lengthCost[MaxMatch] + distSymCost[0]
+                if newCost < pathCost[newIdx]:
+                    pathCost[newIdx] = newCost
+                    pathLen[newIdx] = MaxMatch
+                    pathDist[newIdx] = 1
+                inIdx = newIdx
+                continue
+            # literal
+            newCost = curCost + literalCost[data[inIdx]]
+            if newCost < pathCost[inIdx+1]:
+                pathCost[inIdx+1] = newCost
+                pathLen[inIdx+1] = 1
+                pathDist[inIdx+1] = 0
+            # string copies
+            copylen = MinMatch
+            for (matchLen, copydist, distCode, distBitsNum) in matchList[inIdx]:
+                baseCost = curCost + distSymCost[distCode] + distBitsNum * extraBitCost
+                # longest copy which doesn't cross a page boundary at its source or destination
+                crossLen = MaxMatch
+                if pageCrossCost > 0:
+                    crossLen = OutputPageSize - max(inIdx % OutputPageSize, (inIdx - copydist) % OutputPageSize)
+                while copylen <= matchLen:
+                    newCost = baseCost + lengthCost[copylen]
+                    if copylen > crossLen:
+                        newCost += pageCrossCost
+                    if newCost < pathCost[inIdx+copylen]:
+                        pathCost[inIdx+copylen] = newCost
+                        pathLen[inIdx+copylen] = copylen
+                        pathDist[inIdx+copylen] = copydist
+                    copylen += 1
+            inIdx += 1
+        # trace the path backwards from the end
+        steps = [ ]
+        inIdx = inDataLen
+        while inIdx > 0:
+            steps.append((pathLen[inIdx], pathDist[inIdx]))
+            inIdx -= pathLen[inIdx]
+        steps.reverse()
+        # then convert it to a symbol list
+        symbolList = [ ]
+        inIdx = 0
+        for (copylen, copydist) in steps:
+            if copydist == 0:
+                symbolList.append((data[inIdx], None, None, None))
+            else:
+                (lengthCode, lengthBitsNum, lengthBitsVal) = LengthCodeTable[copylen]
+                (distCode, distBitsNum, distBitsVal) = CalcDistanceCode(copydist)
+                symbolList.append((lengthCode, (lengthBitsNum, lengthBitsVal), distCode, (distBitsNum, distBitsVal)))
+            inIdx += copylen
+        symbolList.append((256, None, None, None))
+        return symbolList
+
+    def GenerateOptimalSymbolList(self, bPrintInfo):
+        # zopfli-style optimal parsing: start with the lazy parse, and then iteratively find the shortest path
+        # through the LZ77 symbol graph using the symbol costs given by the statistics of the previous iteration
+        self.GenerateSymbolList("lazy")
+        bestSymbolList = self.lz77SymbolList
+        bestCost = self.CalcParseCost(bestSymbolList)
+        data = self.inputdata
+        inDataLen = len(data)
+        if inDataLen < MinMatch:
+            return
+        # count the number of identical bytes starting at each position
+        self.sameByteRun = [ 1 ] * (inDataLen + 1)
+        self.sameByteRun[inDataLen] = 0
+        for inIdx in range(inDataLen-2, -1, -1):
+            if data[inIdx] == data[inIdx+1]:
+                self.sameByteRun[inIdx] = self.sameByteRun[inIdx+1] + 1
+        matchList = self.FindAllMatches(OptimalMaxChain)
+        symbolList = bestSymbolList
+        lastCost = None
+        for iteration in range(OptimalIterations):
+            (lenCodeHist, distCodeHist) = self.GenerateHistograms(symbolList)
+            (lenSymCost, distSymCost) = self.CalcSymbolCosts(lenCodeHist, distCodeHist)
+            if self.bSpeed:
+                # convert the sizes to load times; the distance code decoding time is part of SpeedCyclesPerCopy
+                lenSymCost = [ SpeedCyclesPerSymbol + bits * (SpeedCyclesPerCodeBit + SpeedCyclesPerBit) for bits in lenSymCost ]
+                distSymCost = [ bits * (SpeedCyclesPerCodeBit + SpeedCyclesPerBit) for bits in distSymCost ]
+            symbolList = self.OptimalParse(matchList, lenSymCost, distSymCost)
+            parseCost = self.CalcParseCost(symbolList)
+            if bPrintInfo:
+                print(f"    Optimal parse iteration {int(iteration)}: {int(parseCost)} {'cycles' if self.bSpeed else 'bits'}")
+            if parseCost < bestCost:
+                bestCost = parseCost
+                bestSymbolList = symbolList
+            # stop when the parse has converged
+            if parseCost == lastCost:
+                break
+            lastCost = parseCost
+        self.lz77SymbolList = bestSymbolList
+
+    def CalcParseCost(self, symbolList):
+        # cost of a symbol list, as a single dynamic block
+        if not self.bSpeed:
+            return self.CalcDynamicBlockBits(symbolList)
+        (lenCodeHist, distCodeHist) = self.GenerateHistograms(symbolList)
+        symbolCycles = sum(self.CalcSymbolCycles(symbolList))
+        return self.CalcDynamicBlockSpeedCost(symbolList, lenCodeHist, distCodeHist, symbolCycles, 15)
+
+    def GenerateHistograms(self, symbolList):
+        # generate histograms of value/length codes and distance codes
         lenCodeHist = [ 0 for i in range(286) ]
         distCodeHist = [ 0 for i in range(30) ]
-        for (lengthCode, lengthBits, distCode, distBits) in self.lz77SymbolList:
+        for (lengthCode, lengthBits, distCode, distBits) in symbolList:
             lenCodeHist[lengthCode] += 1
             if distCode is not None:
                 distCodeHist[distCode] += 1
-        # generate Huffman binary trees for each of these histograms
-        lenHuffTree = self.GenerateHuffmanTree(lenCodeHist)
-        distHuffTree = self.GenerateHuffmanTree(distCodeHist)
-        # invert the Huffman trees to get the codes by their symbols
+        return (lenCodeHist, distCodeHist)
+
+    def GenerateDynamicTables(self, lenCodeHist, distCodeHist, maxCodeBits=15):
+        tables = HuffmanTables()
+        # calculate the Huffman code lengths (limited to 15 bits by DEFLATE) for each of these histograms
+        lenHuffLengths = self.GenerateHuffmanLengths(lenCodeHist, maxCodeBits)
+        distHuffLengths = self.GenerateHuffmanLengths(distCodeHist, maxCodeBits)
+        # now assign the canonical codes, so that the tree can be exactly re-generated with only the lengths
         # each element is: (codeBits, codeValue)
-        lenHuffCodes = self.InvertHuffmanTree(lenHuffTree, 286, 15)
-        distHuffCodes = self.InvertHuffmanTree(distHuffTree, 30, 15)
-        # now re-order the codes so that the tree can be exactly re-generated with only the lengths
-        lenHuffCodes = self.GenHuffmanCodesFromLengths([lenHuffCodes[i][0] for i in range(286)])
-        distHuffCodes = self.GenHuffmanCodesFromLengths([distHuffCodes[i][0] for i in range(30)])
-        del lenHuffTree  # the tree is no longer correct
-        del distHuffTree
+        tables.lenHuffCodes = self.GenHuffmanCodesFromLengths(lenHuffLengths)
+        tables.distHuffCodes = self.GenHuffmanCodesFromLengths(distHuffLengths)
         # calculate number of non-zero literal/length codes and distance codes
-        numLenCodes = 286
-        while lenHuffCodes[numLenCodes-1][0] == 0:
-            numLenCodes -= 1
+        tables.numLenCodes = 286
+        while tables.lenHuffCodes[tables.numLenCodes-1][0] == 0:
+            tables.numLenCodes -= 1
         if sum(distCodeHist) == 0:
-            numDistCodes = 1
+            tables.numDistCodes = 1
         else:
-            numDistCodes = 30
-            while distHuffCodes[numDistCodes-1][0] == 0:
-                numDistCodes -= 1
+            tables.numDistCodes = 30
+            while tables.distHuffCodes[tables.numDistCodes-1][0] == 0:
+                tables.numDistCodes -= 1
         # now RLE compress the huffman code lengths
-        lenCodeLengths = [ lenHuffCodes[i][0] for i in range(286) ]
-        lenHistRLE = self.CompressHistogramRLE(lenCodeLengths, numLenCodes)
-        distCodeLengths = [ distHuffCodes[i][0] for i in range(30) ]
-        distHistRLE = self.CompressHistogramRLE(distCodeLengths, numDistCodes)
+        lenCodeLengths = [ tables.lenHuffCodes[i][0] for i in range(286) ]
+        tables.lenHistRLE = self.CompressHistogramRLE(lenCodeLengths, tables.numLenCodes)
+        distCodeLengths = [ tables.distHuffCodes[i][0] for i in range(30) ]
+        tables.distHistRLE = self.CompressHistogramRLE(distCodeLengths, tables.numDistCodes)
         # generate a histogram of the RLE codes
         rleCodeHist = [ 0 for i in range(19) ]
-        for (code, extraBits) in lenHistRLE:
+        for (code, extraBits) in tables.lenHistRLE:
             rleCodeHist[code] += 1
-        for (code, extraBits) in distHistRLE:
+        for (code, extraBits) in tables.distHistRLE:
             rleCodeHist[code] += 1
-        # generate a Huffman binary tree for this histogram
-        rleHuffTree = self.GenerateHuffmanTree(rleCodeHist)
-        # invert the Huffman trees to get the codes by their symbols
-        rleHuffCodes = self.InvertHuffmanTree(rleHuffTree, 19, 7)
-        # now re-order the codes so that the tree can be exactly re-generated with only the lengths
-        rleHuffCodes = self.GenHuffmanCodesFromLengths([rleHuffCodes[i][0] for i in range(19)])
-        del rleHuffTree
+        # calculate the Huffman code lengths for this histogram; they are sent as 3-bit values, so the limit is 7 bits
+        rleHuffLengths = self.GenerateHuffmanLengths(rleCodeHist, 7)
+        tables.rleHuffCodes = self.GenHuffmanCodesFromLengths(rleHuffLengths)
         # reorder the RLE histogram and calculate number of non-zero codes
         newOrder = [16,17,18,0,8,7,9,6,10,5,11,4,12,3,13,2,14,1,15]
-        rleCodeLengths = [ rleHuffCodes[i][0] for i in range(19) ]
-        rleCodeLengthsReorder = [ rleCodeLengths[newOrder[i]] for i in range(19) ]
-        numRleCodes = 19
-        while rleCodeLengths[numRleCodes-1] == 0:
-            numRleCodes -= 1
-        if numRleCodes < 4:
-            numRleCodes = 4
-        # finally, we can start writing the compressed bitstream
+        rleCodeLengths = [ tables.rleHuffCodes[i][0] for i in range(19) ]
+        tables.rleCodeLengthsReorder = [ rleCodeLengths[newOrder[i]] for i in range(19) ]
+        tables.numRleCodes = 19
+        while tables.rleCodeLengthsReorder[tables.numRleCodes-1] == 0:
+            tables.numRleCodes -= 1
+        if tables.numRleCodes < 4:
+            tables.numRleCodes = 4
+        return tables
+
+    def CalcDynamicBlockBits(self, symbolList, maxCodeBits=15):
+        # calculate the size of a dynamic Huffman block holding these symbols, without writing it
+        (lenCodeHist, distCodeHist) = self.GenerateHistograms(symbolList)
+        tables = self.GenerateDynamicTables(lenCodeHist, distCodeHist, maxCodeBits)
+        return self.CalcDynamicTablesBits(tables, lenCodeHist, distCodeHist, symbolList)
+
+    def CalcDynamicTablesBits(self, tables, lenCodeHist, distCodeHist, symbolList):
+        numBits = 3 + 5 + 5 + 4 + 3 * tables.numRleCodes
+        numExtraBits = [2, 3, 7]
+        for (rleCode, extraBits) in tables.lenHistRLE + tables.distHistRLE:
+            numBits += tables.rleHuffCodes[rleCode][0]
+            if rleCode >= 16:
+                numBits += numExtraBits[rleCode-16]
+        for code in range(286):
+            numBits += lenCodeHist[code] * tables.lenHuffCodes[code][0]
+        for code in range(30):
+            numBits += distCodeHist[code] * tables.distHuffCodes[code][0]
+        for (lengthCode, lengthBits, distCode, distBits) in symbolList:
+            if distCode is not None:
+                numBits += lengthBits[0] + distBits[0]
+        return numBits
+
+    def WriteDynamicBlock(self, symbolList, bFinalBlock, maxCodeBits=15):
+        (lenCodeHist, distCodeHist) = self.GenerateHistograms(symbolList)
+        tables = self.GenerateDynamicTables(lenCodeHist, distCodeHist, maxCodeBits)
+        lenHuffCodes = tables.lenHuffCodes
+        distHuffCodes = tables.distHuffCodes
+        rleHuffCodes = tables.rleHuffCodes
         # start with the 3-bit block header
-        self.outputbitstream.AddBits(1, 1, False) # we only write 1 compressed block
-        self.outputbitstream.AddBits(2, 2, False) # always dynamic huffman tables
+        self.outputbitstream.AddBits(1, int(bFinalBlock), False)
+        self.outputbitstream.AddBits(2, 2, False) # dynamic huffman tables
         # write the number of huffman codes in each tree
-        self.outputbitstream.AddBits(5, numLenCodes-257, False)
-        self.outputbitstream.AddBits(5, numDistCodes-1, False)
-        self.outputbitstream.AddBits(4, numRleCodes-4, False)
+        self.outputbitstream.AddBits(5, tables.numLenCodes-257, False)
+        self.outputbitstream.AddBits(5, tables.numDistCodes-1, False)
+        self.outputbitstream.AddBits(4, tables.numRleCodes-4, False)
         # next, give 3-bit code length for each RLE huffman code, in the special ordering
-        for i in range(numRleCodes):
-            self.outputbitstream.AddBits(3, rleCodeLengthsReorder[i], False)
+        for i in range(tables.numRleCodes):
+            self.outputbitstream.AddBits(3, tables.rleCodeLengthsReorder[i], False)
         # now give the literal/length huffman code lengths, given via RLE symbols encoded with RLE huffman tree
         numExtraBits = [2, 3, 7]
-        for (rleCode, extraBits) in lenHistRLE:
+        for (rleCode, extraBits) in tables.lenHistRLE:
             huffCode = rleHuffCodes[rleCode]
             self.outputbitstream.AddBits(huffCode[0], huffCode[1], True)
             if rleCode >= 16:
                 self.outputbitstream.AddBits(numExtraBits[rleCode-16], extraBits, False)
         # next, do the Distance huffman code lengths, via RLE symbols encoded with RLE huffman tree
-        for (rleCode, extraBits) in distHistRLE:
+        for (rleCode, extraBits) in tables.distHistRLE:
             huffCode = rleHuffCodes[rleCode]
             self.outputbitstream.AddBits(huffCode[0], huffCode[1], True)
             if rleCode >= 16:
                 self.outputbitstream.AddBits(numExtraBits[rleCode-16], extraBits, False)
         # finally, encode the LZ77 symbols
-        for (lengthCode, lengthBits, distCode, distBits) in self.lz77SymbolList:
+        self.WriteSymbols(symbolList, lenHuffCodes, distHuffCodes)
+
+    def WriteSymbols(self, symbolList, lenHuffCodes, distHuffCodes):
+        for (lengthCode, lengthBits, distCode, distBits) in symbolList:
             huffCode = lenHuffCodes[lengthCode]
             self.outputbitstream.AddBits(huffCode[0], huffCode[1], True)
             if lengthBits is not None and lengthBits[0] > 0:
@@ -451,6 +877,244 @@ class Compressor:
                 self.outputbitstream.AddBits(huffCode[0], huffCode[1], True)
                 if distBits[0] > 0:
                     self.outputbitstream.AddBits(distBits[0], distBits[1], False) # raw bits to give distance for codes 4-29
+
+    def CalcFixedBlockBits(self, symbolList):
+        numBits = 3
+        for (lengthCode, lengthBits, distCode, distBits) in symbolList:
+            numBits += FixedLenCodeLengths[lengthCode]
+            if distCode is not None:
+                numBits += lengthBits[0] + 5 + distBits[0]
+        return numBits
+
+    def WriteFixedBlock(self, symbolList, bFinalBlock):
+        self.outputbitstream.AddBits(1, int(bFinalBlock), False)
+        self.outputbitstream.AddBits(2, 1, False) # fixed huffman tables
+        self.WriteSymbols(symbolList, self.fixedLenHuffCodes, self.fixedDistHuffCodes)
+
+    def CalcStoredBlockBits(self, byteLen, padBits):
+        # each stored block has a 3-bit header, padding to the byte boundary, and 16-bit LEN and NLEN fields
+        numBlocks = max(1, (byteLen + StoredBlockMaxLen - 1) // StoredBlockMaxLen)
+        return numBlocks * (3 + padBits + 32) + byteLen * 8
+
+    def WriteStoredBlock(self, byteStart, byteEnd, bFinalBlock):
+        while True:
+            chunkEnd = min(byteEnd, byteStart + StoredBlockMaxLen)
+            chunkLen = chunkEnd - byteStart
+            self.outputbitstream.AddBits(1, int(bFinalBlock and chunkEnd == byteEnd), False)
+            self.outputbitstream.AddBits(2, 0, False) # stored (uncompressed) data
+            self.outputbitstream.AlignToByte()
+            self.outputbitstream.AddBits(16, chunkLen, False)
+            self.outputbitstream.AddBits(16, chunkLen ^ 0xffff, False)
+            self.outputbitstream.AddBytes(self.inputdata[byteStart:chunkEnd])
+            byteStart = chunkEnd
+            if byteStart == byteEnd:
+                break
+
+    def GetBlockSymbols(self, symStart, symEnd):
+        # each block holds a slice of the LZ77 symbol list, followed by its own end-of-block code
+        return self.lz77SymbolList[symStart:symEnd] + [ (256, None, None, None) ]
+
+    def CalcSymbolCycles(self, symbolList):
+        # estimate the decoding time of each symbol, except for its Huffman code bits, which depend upon the trees
+        symbolCycles = [ ]
+        bytePos = 0
+        for (lengthCode, lengthBits, distCode, distBits) in symbolList:
+            if distCode is None:
+                symbolCycles.append(SpeedCyclesPerSymbol)
+                bytePos += 1
+                continue
+            copylen = LengthCodeBase[lengthCode] + lengthBits[1]
+            copydist = DistCodeBase[distCode] + distBits[1]
+            cycles = SpeedCyclesPerSymbol + SpeedCyclesPerCopy + copylen * SpeedCyclesPerCopyByte + \
+                     (lengthBits[0] + distBits[0]) * SpeedCyclesPerExtraBit
+            if bytePos % OutputPageSize + copylen > OutputPageSize or (bytePos - copydist) % OutputPageSize + copylen > OutputPageSize:
+                cycles += SpeedCyclesPageCross
+            symbolCycles.append(cycles)
+            bytePos += copylen
+        return symbolCycles
+
+    def CalcDynamicBlockSpeedCost(self, symbolList, lenCodeHist, distCodeHist, symbolCycles, maxCodeBits):
+        # estimate the load time of a dynamic block: disk read time, reading the code lengths and building the
+        # trees in Decomp_Init_Deflate_Block, and decoding the symbols
+        tables = self.GenerateDynamicTables(lenCodeHist, distCodeHist, maxCodeBits)
+        numBits = self.CalcDynamicTablesBits(tables, lenCodeHist, distCodeHist, symbolList)
+        codeBits = sum([ lenCodeHist[code] * tables.lenHuffCodes[code][0] for code in range(286) ]) + \
+                   sum([ distCodeHist[code] * tables.distHuffCodes[code][0] for code in range(30) ])
+        lenMaxBits = max([ tables.lenHuffCodes[code][0] for code in range(286) ])
+        distMaxBits = max([ tables.distHuffCodes[code][0] for code in range(30) ])
+        rleMaxBits = max([ tables.rleHuffCodes[code][0] for code in range(19) ])
+        treeCycles = (tables.numLenCodes * lenMaxBits + tables.numDistCodes * distMaxBits + 19 * rleMaxBits) * SpeedCyclesTreeScan + \
+                     (len(tables.lenHistRLE) + len(tables.distHistRLE)) * SpeedCyclesPerLengthCode
+        return numBits * SpeedCyclesPerBit + treeCycles + symbolCycles + codeBits * SpeedCyclesPerCodeBit
+
+    def CalcStoredBlockCost(self, byteLen, padBits):
+        numBits = self.CalcStoredBlockBits(byteLen, padBits)
+        if not self.bSpeed:
+            return numBits
+        return numBits * SpeedCyclesPerBit + byteLen * SpeedCyclesPerCopyByte
+
+    def CalcBlockCost(self, symStart, symEnd, bAllowStored):
+        # return the cost (size in bits, or load time in 'speed' mode), type, and code length limit of the
+        # best encoding for a block
+        symbolList = self.GetBlockSymbols(symStart, symEnd)
+        if not self.bSpeed:
+            blockCost = self.CalcDynamicBlockBits(symbolList)
+            blockType = 2
+            fixedBits = self.CalcFixedBlockBits(symbolList)
+            if fixedBits < blockCost:
+                blockCost = fixedBits
+                blockType = 1
+            maxCodeBits = 15
+        else:
+            (lenCodeHist, distCodeHist) = self.GenerateHistograms(symbolList)
+            symbolCycles = self.symbolCyclesSum[symEnd] - self.symbolCyclesSum[symStart] + SpeedCyclesPerSymbol
+            fixedCodeBits = sum([ lenCodeHist[code] * FixedLenCodeLengths[code] for code in range(286) ]) + 5 * sum(distCodeHist)
+            blockCost = self.CalcFixedBlockBits(symbolList) * SpeedCyclesPerBit + SpeedCyclesFixedTables + \
+                        symbolCycles + fixedCodeBits * SpeedCyclesPerCodeBit
+            blockType = 1
+            maxCodeBits = 15
+            for codeBits in SpeedCodeBitLimits:
+                dynamicCost = self.CalcDynamicBlockSpeedCost(symbolList, lenCodeHist, distCodeHist, symbolCycles, codeBits)
+                if dynamicCost < blockCost:
+                    blockCost = dynamicCost
+                    blockType = 2
+                    maxCodeBits = codeBits
+        if bAllowStored:
+            # assume the worst case of 7 bits of padding; the real choice is made when the block is written
+            storedCost = self.CalcStoredBlockCost(self.symbolBytePos[symEnd] - self.symbolBytePos[symStart], 7)
+            if storedCost < blockCost:
+                blockCost = storedCost
+                blockType = 0
+        return (blockCost, blockType, maxCodeBits)
+
+    def FindBestSplit(self, symStart, symEnd, bAllowStored):
+        # search for the split point which minimizes the total cost of the two resulting blocks
+        splitCosts = { }
+        def SplitCost(splitIdx):
+            if splitIdx not in splitCosts:
+                splitCosts[splitIdx] = self.CalcBlockCost(symStart, splitIdx, bAllowStored)[0] + \
+                                       self.CalcBlockCost(splitIdx, symEnd, bAllowStored)[0]
+            return splitCosts[splitIdx]
+        lowIdx = symStart + BlockSplitMinSymbols
+        highIdx = symEnd - BlockSplitMinSymbols
+        while highIdx - lowIdx > BlockSplitSamples:
+            # sample evenly spaced points, then narrow the range down to the neighbors of the best one
+            step = (highIdx - lowIdx) / (BlockSplitSamples + 1)
+            points = [ lowIdx + int(step * (i+1)) for i in range(BlockSplitSamples) ]
+            bestIdx = min(range(BlockSplitSamples), key=lambda i: SplitCost(points[i]))
+            if bestIdx > 0:
+                lowIdx = points[bestIdx-1]
+            if bestIdx < BlockSplitSamples - 1:
+                highIdx = points[bestIdx+1]
+        for splitIdx in range(lowIdx, highIdx+1):
+            SplitCost(splitIdx)
+        bestSplit = min(splitCosts, key=lambda idx: (splitCosts[idx], idx))
+        return (bestSplit, splitCosts[bestSplit])
+
+    def SplitBlocks(self, bAllowStored, bPrintInfo):
+        # split the LZ77 symbol list (without the final end-of-block code) into blocks which can each use
+        # Huffman trees fitted to their own part of the data.  The largest block which has not yet been
+        # searched is split at its best point until no split reduces the total cost any further
+        numSymbols = len(self.lz77SymbolList) - 1
+        self.symbolBytePos = [ 0 ] * (numSymbols + 1)
+        bytePos = 0
+        for symIdx in range(numSymbols):
+            (lengthCode, lengthBits, distCode, distBits) = self.lz77SymbolList[symIdx]
+            if distCode is None:
+                bytePos += 1
+            else:
+                bytePos += LengthCodeBase[lengthCode] + lengthBits[1]
+            self.symbolBytePos[symIdx+1] = bytePos
+        if self.bSpeed:
+            self.symbolCyclesSum = [ 0 ]
+            for cycles in self.CalcSymbolCycles(self.lz77SymbolList[:numSymbols]):
+                self.symbolCyclesSum.append(self.symbolCyclesSum[-1] + cycles)
+        # each block is (symStart, symEnd, cost, type, bSearched)
+        (blockCost, blockType, maxCodeBits) = self.CalcBlockCost(0, numSymbols, bAllowStored)
+        blockList = [ (0, numSymbols, blockCost, blockType, False) ]
+        while len(blockList) < BlockSplitMaxBlocks:
+            candidates = [ i for i in range(len(blockList)) if not blockList[i][4] and
+                           blockList[i][1] - blockList[i][0] >= BlockSplitMinSymbols * 2 ]
+            if len(candidates) == 0:
+                break
+            blockIdx = max(candidates, key=lambda i: blockList[i][1] - blockList[i][0])
+            (symStart, symEnd, blockCost, blockType, bSearched) = blockList[blockIdx]
+            (splitIdx, splitCost) = self.FindBestSplit(symStart, symEnd, bAllowStored)
+            if splitCost >= blockCost:
+                blockList[blockIdx] = (symStart, symEnd, blockCost, blockType, True)
+                continue
+            (leftCost, leftType, leftCodeBits) = self.CalcBlockCost(symStart, splitIdx, bAllowStored)
+            (rightCost, rightType, rightCodeBits) = self.CalcBlockCost(splitIdx, symEnd, bAllowStored)
+            blockList[blockIdx:blockIdx+1] = [ (symStart, splitIdx, leftCost, leftType, False),
+                                               (splitIdx, symEnd, rightCost, rightType, False) ]
+        if bPrintInfo:
+            typeNames = ("stored", "fixed", "dynamic")
+            costUnits = "cycles" if self.bSpeed else "bits"
+            print(f"Symbol stream split into {int(len(blockList))} block(s)")
+            for (symStart, symEnd, blockCost, blockType, bSearched) in blockList:
+                print(f"    symbols {int(symStart)}-{int(symEnd)}: {typeNames[blockType]}, {int(blockCost)} {costUnits}")
+        return [ (symStart, symEnd) for (symStart, symEnd, blockCost, blockType, bSearched) in blockList ]
+
+    def WriteBlock(self, symStart, symEnd, bFinalBlock, bAllowStored):
+        # write a block with whichever encoding is smallest (or fastest to load, in 'speed' mode)
+        (blockCost, blockType, maxCodeBits) = self.CalcBlockCost(symStart, symEnd, False)
+        if bAllowStored:
+            # now that we know the bit position, we can calculate the exact size of a stored block
+            padBits = (8 - ((self.outputbitstream.GetBitPosition() + 3) & 7)) & 7
+            byteStart = self.symbolBytePos[symStart]
+            byteEnd = self.symbolBytePos[symEnd]
+            if self.CalcStoredBlockCost(byteEnd - byteStart, padBits) < blockCost:
+                self.WriteStoredBlock(byteStart, byteEnd, bFinalBlock)
+                return
+        symbolList = self.GetBlockSymbols(symStart, symEnd)
+        if blockType == 1:
+            self.WriteFixedBlock(symbolList, bFinalBlock)
+        else:
+            self.WriteDynamicBlock(symbolList, bFinalBlock, maxCodeBits)
+
+    # bAllowStored enables stored (BTYPE=0) blocks, which decompress.asm can't decode, so they are only
+    # useful for streams which will be inflated by other decoders
+    def Deflate(self, bPrintInfo, bUseGzip=False, mode="lazy", bAllowStored=False):
+        if bPrintInfo:
+            print(f"{int(len(self.inputdata))} bytes in input file.")
+        if mode not in CompressionModes:
+            raise Exception(f"Invalid compression mode '{mode}'")
+        if bUseGzip:
+            mode = "gzip"
+        # return the stream from the cache if we have already compressed this data in the same way
+        cache = None
+        if os.environ.get("DYNO_CACHE_DIR"):
+            cache = CompressionCache(os.environ["DYNO_CACHE_DIR"], CacheMaxBytes)
+            cacheKey = cache.MakeKey(self.inputdata, mode + ("+stored" if bAllowStored else ""))
+            outputData = cache.Get(cacheKey)
+            if outputData is not None:
+                if bPrintInfo:
+                    print(f"Using cached stream {cacheKey}")
+                return outputData
+        outputData = self.DeflateStream(bPrintInfo, mode, bAllowStored)
+        if cache is not None:
+            cache.Put(cacheKey, outputData)
+        return outputData
+
+    def DeflateStream(self, bPrintInfo, mode, bAllowStored):
+        # the 'gzip' mode gives the same result as 'gzip -9', using the zlib module
+        if mode == "gzip":
+            return self.DeflateWithZlib(9, zlib.Z_DEFAULT_STRATEGY)
+        if mode == "best":
+            return self.DeflateBest(bPrintInfo)
+        # start by eliminating string redundancies converting uncompressed data to LZ77 symbol list
+        self.bSpeed = (mode == "speed")
+        if mode == "optimal" or mode == "speed":
+            self.GenerateOptimalSymbolList(bPrintInfo)
+        else:
+            self.GenerateSymbolList(mode)
+        if bPrintInfo:
+            print(f"{int(len(self.lz77SymbolList))} LZ77 symbols generated")
+        # split the symbols into blocks, and write each one with the smallest block type
+        blockList = self.SplitBlocks(bAllowStored, bPrintInfo)
+        for blockIdx in range(len(blockList)):
+            (symStart, symEnd) = blockList[blockIdx]
+            self.WriteBlock(symStart, symEnd, blockIdx == len(blockList) - 1, bAllowStored)
         # finalize the bitstream and return the binary data
         self.outputbitstream.Finalize()
         return self.outputbitstream.GetData()
@@ -458,7 +1122,9 @@ class Compressor:
 class Decompressor:
     def __init__(self, inputdata):
         self.inputBitstream = BitReader(inputdata)
-        self.outputData = b''
+        self.outputData = bytearray()
+        # type of each block which was inflated
+        self.blockTypes = [ ]
 
     @staticmethod
     def StripGZ(inputdata, bPrintInfo):
@@ -490,36 +1156,47 @@ class Decompressor:
         # return just the DEFLATE stream
         return inputdata[zipIdx:-8]  # CRC32 and ISIZE are on the end
 
-    def GenerateHuffmanTreeFromLengths(self, huffLengths):
-        numCodes = len(huffLengths)
+    @staticmethod
+    def ReverseBits(value, numBits):
+        return ((ReverseByteTable[value & 0xff] << 8) | ReverseByteTable[value >> 8]) >> (16 - numBits)
+
+    def GenerateDecodeTable(self, huffLengths):
         maxLength = max(huffLengths)
         # count number of codes with each given length
         popByLength = [0] * (maxLength+1)
         for codeLength in huffLengths:
             if codeLength > 0:
                 popByLength[codeLength] += 1
-        # create tree root and populate first node, which is special case
-        huffRoot = HuffNode()
-        huffRoot.child0 = HuffNode()
-        huffRoot.child1 = HuffNode()
-        levelList = [huffRoot.child0, huffRoot.child1]
-        # now iterate through each level, creating the tree
-        for level in range(1,maxLength+1):
-            # codes which are on this level go on the left side of the tree
-            for codeVal in range(numCodes):
-                if huffLengths[codeVal] == level:
-                    thisNode = levelList.pop(0)
-                    thisNode.value = codeVal
-            # all remaining nodes are decision nodes and have 2 children, which go to the next level
-            nextLevelList = [ ]
-            for node in levelList:
-                node.child0 = HuffNode()
-                node.child1 = HuffNode()
-                nextLevelList.append(node.child0)
-                nextLevelList.append(node.child1)
-            levelList = nextLevelList
-        # return the root of the tree
-        return huffRoot
+        # calculate the starting value for each code length
+        nextVal = [0] * (maxLength+1)
+        curVal = 0
+        for codeLength in range(1,maxLength+1):
+            curVal = (curVal + popByLength[codeLength-1]) << 1
+            nextVal[codeLength] = curVal
+        # the input bits come LSB-first, so the tables are indexed by the bit-reversed codes
+        decodeTable = [ None ] * (1 << PrimaryTableBits)
+        longCodes = { }
+        for symbol in range(len(huffLengths)):
+            codeLength = huffLengths[symbol]
+            if codeLength == 0:
+                continue
+            revCode = Decompressor.ReverseBits(nextVal[codeLength], codeLength)
+            nextVal[codeLength] += 1
+            if codeLength <= PrimaryTableBits:
+                # fill every entry which starts with this code
+                for tableIdx in range(revCode, 1 << PrimaryTableBits, 1 << codeLength):
+                    decodeTable[tableIdx] = (symbol, codeLength, None)
+            else:
+                longCodes.setdefault(revCode & PrimaryTableMask, []).append((symbol, codeLength, revCode >> PrimaryTableBits))
+        # build a secondary table for each 9-bit prefix of the long codes
+        for (prefix, codeList) in longCodes.items():
+            subBits = max([ codeLength for (symbol, codeLength, subCode) in codeList ]) - PrimaryTableBits
+            subTable = [ None ] * (1 << subBits)
+            for (symbol, codeLength, subCode) in codeList:
+                for tableIdx in range(subCode, 1 << subBits, 1 << (codeLength - PrimaryTableBits)):
+                    subTable[tableIdx] = (symbol, codeLength, None)
+            decodeTable[prefix] = (None, 0, (subBits, subTable))
+        return decodeTable
 
     def Inflate(self):
         # read consecutive blocks until we complete the final one
@@ -527,6 +1204,17 @@ class Decompressor:
             # 3-bit block header
             bFinalBlock = (self.inputBitstream.GetBits(1) == 1)
             blockType = self.inputBitstream.GetBits(2)
+            self.blockTypes.append(blockType)
+            if blockType == 0:
+                # stored block: copy the raw bytes which follow the LEN and NLEN fields
+                self.inputBitstream.AlignToByte()
+                storedLen = self.inputBitstream.GetBits(16)
+                if self.inputBitstream.GetBits(16) != storedLen ^ 0xffff:
+                    raise Exception("Stored block length doesn't match its complement")
+                self.outputData += self.inputBitstream.GetBytes(storedLen)
+                if bFinalBlock:
+                    break
+                continue
             if blockType == 1:
                 numLenCodes = 288
                 numDistCodes = 32
@@ -541,13 +1229,13 @@ class Decompressor:
                 rleCodeLengths = [0] * 19
                 for i in range(numRleCodes):
                     rleCodeLengths[rleCodeOrder[i]] = self.inputBitstream.GetBits(3)
-                # generate the RLE code huffman tree
-                rleHuffTree = self.GenerateHuffmanTreeFromLengths(rleCodeLengths)
+                # generate the RLE code huffman decoding table
+                rleDecodeTable = self.GenerateDecodeTable(rleCodeLengths)
                 # decompress the huffman code lengths for Literal/Length and Distance trees
                 totalCodeLengths = numLenCodes + numDistCodes
                 codeLengths = [ ]
                 while len(codeLengths) < totalCodeLengths:
-                    rleSymbol = self.inputBitstream.GetSymbol(rleHuffTree)
+                    rleSymbol = self.inputBitstream.GetSymbol(rleDecodeTable)
                     if rleSymbol < 16:
                         codeLengths.append(rleSymbol)
                     elif rleSymbol == 16:
@@ -566,15 +1254,15 @@ class Decompressor:
                     raise Exception("Unexpected number of literal/distance huffman code lengths extracted from compressed RLE symbols")
             else:
                 raise Exception(f"Unsupported DEFLATE block type {int(blockType)}")
-            # generate the literal/length and distance huffman trees
-            lenHuffTree = self.GenerateHuffmanTreeFromLengths(codeLengths[:numLenCodes])
-            distHuffTree = self.GenerateHuffmanTreeFromLengths(codeLengths[numLenCodes:])
+            # generate the literal/length and distance huffman decoding tables
+            lenDecodeTable = self.GenerateDecodeTable(codeLengths[:numLenCodes])
+            distDecodeTable = self.GenerateDecodeTable(codeLengths[numLenCodes:])
             # now decompress the LZ77 symbols and reconstruct the uncompressed data
             while True:
-                lenSymbol = self.inputBitstream.GetSymbol(lenHuffTree)
+                lenSymbol = self.inputBitstream.GetSymbol(lenDecodeTable)
                 # if it's a literal, add it to the output data and get next symbol
                 if lenSymbol < 256:
-                    self.outputData += bytes((lenSymbol,))
+                    self.outputData.append(lenSymbol)
                     continue
                 # if it's the end code, then we are done
                 if lenSymbol == 256:
@@ -584,28 +1272,163 @@ class Decompressor:
                     copylen = lenSymbol - 254
                 elif lenSymbol == 285:
                     copylen = 258
+                elif lenSymbol > 285:
+                    raise Exception(f"Invalid length code {int(lenSymbol)}")
                 else:
                     extrabits = (lenSymbol - 261) >> 2
                     quadrant = (lenSymbol - 261) & 3
                     copylen = (4 << extrabits) + (quadrant * (1 << extrabits)) + 3 + self.inputBitstream.GetBits(extrabits)
                 # then get the distance code and calculate the distance backwards to start copying
-                distSymbol = self.inputBitstream.GetSymbol(distHuffTree)
+                distSymbol = self.inputBitstream.GetSymbol(distDecodeTable)
+                if distSymbol > 29:
+                    raise Exception(f"Invalid distance code {int(distSymbol)}")
                 if distSymbol < 4:
                     copydist = distSymbol + 1
                 else:
                     extrabits = (distSymbol - 2) >> 1
                     parity = (distSymbol - 2) & 1
                     copydist = (2 << extrabits) + (parity * (1 << extrabits)) + 1 + self.inputBitstream.GetBits(extrabits)
-                # perform the copy operation
+                # perform the copy operation.  If the source overlaps the bytes being written, then
+                # the copy repeats the last copydist bytes
                 copyIdx = len(self.outputData) - copydist
-                for i in range(copylen):
-                    newChar = self.outputData[copyIdx]
-                    self.outputData += newChar
-                    copyIdx += 1
+                if copyIdx < 0:
+                    raise Exception(f"Copy distance {int(copydist)} is before the start of the output data")
+                if copydist >= copylen:
+                    self.outputData += self.outputData[copyIdx:copyIdx+copylen]
+                else:
+                    pattern = self.outputData[copyIdx:]
+                    self.outputData += (pattern * (copylen // copydist + 1))[:copylen]
             # process another block if this is not the last one
             if bFinalBlock:
                 break
-        return self.outputData
+        return bytes(self.outputData)
+
+# the 'best' compression mode runs its candidate encoders in a process pool, which is shared by all streams
+WorkerPool = None
+
+def GetWorkerPool():
+    global WorkerPool
+    if WorkerPool is None:
+        try:
+            WorkerPool = concurrent.futures.ProcessPoolExecutor()
+        except (OSError, NotImplementedError):
+            # no multiprocessing support, so the candidates will run one at a time
+            WorkerPool = False
+    return WorkerPool or None
+
+def DeflateCandidate(inputData, candidate):
+    # compress the input data with one candidate encoder, and return the stream only if it decompresses
+    # correctly, and decompress.asm can decode it (it doesn't support stored blocks)
+    (encoder, setting) = candidate
+    comp = Compressor(inputData)
+    if encoder == "native":
+        compData = comp.DeflateStream(False, setting, False)
+    else:
+        compData = comp.DeflateWithZlib(setting[0], setting[1])
+    decomp = Decompressor(compData)
+    try:
+        if decomp.Inflate() != bytes(inputData):
+            return None
+    except Exception:
+        return None
+    if 0 in decomp.blockTypes:
+        return None
+    return compData
+
+class CompressionCache:
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+
+    def MakeKey(self, inputData, mode):
+        # the zlib version is included because the 'gzip' and 'best' modes depend on it
+        keyHash = hashlib.sha256(f"{CompressorVersion}:{mode}:{zlib.ZLIB_RUNTIME_VERSION}:".encode())
+        keyHash.update(inputData)
+        return keyHash.hexdigest()
+
+    def Get(self, key):
+        cachePath = os.path.join(self.cacheDir, key + ".dfl")
+        try:
+            with open(cachePath, "rb") as f:
+                data = f.read()
+            # touch the file, so that the eviction order is least recently used
+            os.utime(cachePath)
+        except OSError:
+            return None
+        return data
+
+    def Put(self, key, data):
+        cachePath = os.path.join(self.cacheDir, key + ".dfl")
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            # write to a temporary file first, so that other build scripts never read a partial stream
+            tempPath = cachePath + f".{int(os.getpid())}.tmp"
+            with open(tempPath, "wb") as f:
+                f.write(data)
+            os.replace(tempPath, cachePath)
+            self.Evict()
+        except OSError:
+            # the cache is only an optimization, so a read-only or full disk is not an error
+            pass
+
+    def Evict(self):
+        # delete the least recently used streams until the cache is no bigger than maxBytes
+        entryList = [ ]
+        totalBytes = 0
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith(".dfl"):
+                stat = entry.stat()
+                entryList.append((stat.st_mtime, stat.st_size, entry.path))
+                totalBytes += stat.st_size
+        if totalBytes <= self.maxBytes:
+            return
+        entryList.sort()
+        for (mtime, size, path) in entryList:
+            os.remove(path)
+            totalBytes -= size
+            if totalBytes <= self.maxBytes:
+                break
+
+class StreamVerifier:
+    # the packer scripts check every compressed stream by inflating it and comparing it with the input data.
+    # Setting the DYNO_NOVERIFY environment variable to 1 (the makefile's NOVERIFY=1 option) disables this
+    def __init__(self):
+        self.bEnabled = (os.environ.get("DYNO_NOVERIFY", "0") != "1")
+        self.numStreams = 0
+        self.numRawBytes = 0
+        self.numCompBytes = 0
+        self.totalTime = 0.0
+
+    def Verify(self, rawData, compData, streamName):
+        if not self.bEnabled:
+            return
+        startTime = time.perf_counter()
+        decomp = Decompressor(compData)
+        try:
+            outData = decomp.Inflate()
+            errMsg = None
+        except Exception as e:
+            outData = None
+            errMsg = str(e)
+        self.totalTime += time.perf_counter() - startTime
+        if errMsg is not None:
+            print(f"****Error: compressed stream for {streamName} failed to decompress: {errMsg}")
+            sys.exit(1)
+        if 0 in decomp.blockTypes:
+            print(f"****Error: compressed stream for {streamName} contains stored blocks, which decompress.asm can't decode")
+            sys.exit(1)
+        if outData != bytes(rawData):
+            print(f"****Error: compressed stream for {streamName} doesn't match the original data ({int(len(outData))} bytes decompressed, {int(len(rawData))} expected)")
+            sys.exit(1)
+        self.numStreams += 1
+        self.numRawBytes += len(rawData)
+        self.numCompBytes += len(compData)
+
+    def PrintSummary(self):
+        if not self.bEnabled or self.numStreams == 0:
+            return
+        throughput = self.numRawBytes / max(self.totalTime, 1e-6) / 1048576
+        print(f"    Verified {int(self.numStreams)} compressed streams ({int(self.numCompBytes)} -> {int(self.numRawBytes)} bytes) in {self.totalTime:.3f} sec, {throughput:.2f} MB/sec")
 
 #******************************************************************************
 # main function for standard script execution
@@ -299,6 +299,8 @@ class SpriteInfo:
         self.pixArray = [ ]
         self.hotspot = [0, 0]
         self.chunkHint = sys.maxsize
+        self.animateTo = [ ]
+        self.timeBudget = None
 
 class SpriteGroupInfo:
     def __init__(self):
@@ -306,6 +308,7 @@ class SpriteGroupInfo:
         self.groupidx = -1
         self.paletteidx = -1
         self.transparentRGB = [0,0,0]
+        self.eraseMode = "save"
         self.sprites = [ ]
 
 def parseSpriteDescription(descFilename):
@@ -346,6 +349,11 @@ def parseSpriteDescription(descFilename):
                     info.transparentRGB = [int(v.strip()) for v in value.split(",")]
                 elif key == "palette":
                     info.paletteidx = int(value)
+                elif key == "erasemode":
+                    if value.lower() not in ("save", "redraw"):
+                        print(f"****Error: invalid EraseMode value in line '{line}' in sprite description file '{descFilename}'")
+                        sys.exit(2)
+                    info.eraseMode = value.lower()
                 else:
                     print(f"****Error: invalid global parameter definition '{line}' in sprite description file '{descFilename}'")
                     sys.exit(2)
@@ -363,6 +371,10 @@ def parseSpriteDescription(descFilename):
                     sys.exit(2)
             elif key == "chunkhint":
                 curSprite.chunkHint = int(value)
+            elif key == "timebudget":
+                curSprite.timeBudget = float(value)
+            elif key == "animateto":
+                curSprite.animateTo = [v.strip().lower() for v in value.split(",") if v.strip() != ""]
             else:
                 print(f"****Error: invalid sprite parameter definition '{line}' in sprite description file '{descFilename}'")
                 sys.exit(2)
@@ -919,6 +931,8 @@ def GenerateSprites(spritedesc_fname, palette_path, sprite_fname):
     f = open(sprite_fname, 'w')
     f.write(f'* The contents of this file were automatically generated with\n* gfx-process.py by processing the sprite image file {ImageFilename}\n*\n')
     f.write(f'group = {info.groupidx}\n')
+    if info.eraseMode != "save":
+        f.write(f'EraseMode = {info.eraseMode}\n')
     for sprite in info.sprites:
         f.write(f'[{sprite.name}]\n')
         f.write(f'Width = {len(sprite.pixArray[0])}\n')
@@ -927,6 +941,10 @@ def GenerateSprites(spritedesc_fname, palette_path, sprite_fname):
         f.write(f'Hotspot = ({sprite.hotspot[0]},{sprite.hotspot[1]})\n')
         if (sprite.chunkHint < sys.maxsize):
             f.write(f'ChunkHint = {sprite.chunkHint}\n')
+        if sprite.timeBudget != None:
+            f.write(f'TimeBudget = {sprite.timeBudget}\n')
+        if len(sprite.animateTo) > 0:
+            f.write(f'AnimateTo = {", ".join(sprite.animateTo)}\n')
         for pixLine in sprite.pixArray:
             f.write(' '.join([pixValMap[v] for v in pixLine]))
             f.write('\n')
@@ -26,9 +26,137 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #********************************************************************************
 
+import os
 import re
+import random
 import sys
+import time
 import copy
+import pickle
+import hashlib
+import collections
+import concurrent.futures
+
+# *************************************************************************************************
+# Instruction cost model: cycles and bytes for each instruction, for each type of CPU timing
+# *************************************************************************************************
+
+# CPU gives the instruction set (6809 or 6309) used in the generated code, and CpuTiming gives the timing which is
+# optimized for: "6809", "6309" (6309 in native mode), or "6309e" (6309 in 6809 emulation mode).  Use SetCpu to change them
+CPU = 6809
+CpuTiming = "6809"
+TimingColumns = { "6809":0, "6309":1, "6309e":2 }
+
+# the cost of each instruction by (mnemonic, addressing mode), as (6809 cycles, 6309 native mode cycles, 6309 emulation
+# mode cycles, bytes).  The mode is "inh" (inherent), "imm" (immediate), "idx" (indexed, without the extra cost of
+# the offset), "reg" (register operands), or "stk" (stack, without the cost of each byte).  The 6809 cycles are None
+# for the instructions which only exist on the 6309
+InstructionCosts = { ("rts", "inh"):(5, 4, 5, 1), ("addr", "reg"):(None, 4, 4, 3), ("tfm", "reg"):(None, 6, 6, 3) }
+for regChar in "ab":
+    for operation in ("clr", "com", "neg", "inc", "dec"):
+        InstructionCosts[(operation + regChar, "inh")] = (2, 1, 2, 1)
+for regChar in "defw":
+    for operation in ("clr", "com", "inc", "dec"):
+        InstructionCosts[(operation + regChar, "inh")] = (None, 2, 3, 2)
+InstructionCosts[("negd", "inh")] = (None, 2, 3, 2)
+for op in ("lda", "ldb", "anda", "andb", "ora", "orb"):
+    InstructionCosts[(op, "imm")] = (2, 2, 2, 2)
+    InstructionCosts[(op, "idx")] = (4, 4, 4, 2)
+for op in ("ldd", "ldu", "ldx"):
+    InstructionCosts[(op, "imm")] = (3, 3, 3, 3)
+InstructionCosts.update({ ("ldy", "imm"):(4, 4, 4, 4), ("addd", "imm"):(4, 3, 4, 3), ("lde", "imm"):(None, 3, 3, 3),
+                          ("ldf", "imm"):(None, 3, 3, 3), ("ldw", "imm"):(None, 4, 4, 4), ("ldq", "imm"):(None, 5, 5, 5) })
+for op in ("sta", "stb", "leax", "leay", "leau"):
+    InstructionCosts[(op, "idx")] = (4, 4, 4, 2)
+for op in ("ldd", "std", "ldu", "stu", "ldx", "stx"):
+    InstructionCosts[(op, "idx")] = (5, 5, 5, 2)
+for op in ("ldy", "sty"):
+    InstructionCosts[(op, "idx")] = (6, 6, 6, 3)
+for op in ("lde", "ldf", "ste", "stf"):
+    InstructionCosts[(op, "idx")] = (None, 5, 5, 3)
+for op in ("ldw", "stw"):
+    InstructionCosts[(op, "idx")] = (None, 6, 6, 3)
+for op in ("ldq", "stq"):
+    InstructionCosts[(op, "idx")] = (None, 8, 8, 3)
+
+# stack instructions have the "stk" mode, and take one more cycle for each byte pushed or pulled
+for op in ("pshs", "puls", "pshu", "pulu"):
+    InstructionCosts[(op, "stk")] = (5, 4, 5, 2)
+StackByteCycles = 1
+
+# the size of each register which may be pushed or pulled, in the order in which they are stored in memory
+StackRegisterBytes = { "cc":1, "a":1, "b":1, "dp":1, "x":2, "y":2, "u":2, "s":2, "pc":2 }
+
+# extra cost of the constant offset in an indexed instruction, for no offset, and 5-bit, 8-bit, and 16-bit offsets
+IndexedOffsetCosts = ( (0, 0, 0, 0), (1, 1, 1, 0), (1, 1, 1, 1), (4, 3, 4, 2) )
+
+# cycles for each byte copied by a tfm instruction
+TfmByteCycles = 3
+
+# the cost of each instruction which has been emitted, by (mnemonic, operand)
+CostCache = { }
+
+def SetCpu(cpu, timing):
+    global CPU, CpuTiming
+    if cpu not in (6809, 6309) or timing not in TimingColumns or (cpu == 6309 and timing == "6809"):
+        raise Exception(f"Invalid CPU type {cpu} with {timing} timing")
+    CPU = cpu
+    CpuTiming = timing
+    CostCache.clear()
+
+def GetCost(costs, description):
+    # return (cycles, bytes) from a cost table entry, using the timing of the selected CPU
+    cycles = costs[TimingColumns[CpuTiming]]
+    if cycles == None or (CPU == 6809 and costs[0] == None):
+        raise Exception(f"Instruction '{description}' is not supported by the {int(CPU)}")
+    return (cycles, costs[3])
+
+def IndexedOffsetCost(offset):
+    if offset == 0:
+        return GetCost(IndexedOffsetCosts[0], "")
+    if offset < 16 and offset >= -16:
+        return GetCost(IndexedOffsetCosts[1], "")
+    if offset < 128 and offset >= -128:
+        return GetCost(IndexedOffsetCosts[2], "")
+    return GetCost(IndexedOffsetCosts[3], "")
+
+def InstructionCost(op, mode):
+    if (op, mode) not in InstructionCosts:
+        raise Exception(f"Unknown instruction '{op}' with {mode} addressing mode")
+    return GetCost(InstructionCosts[(op, mode)], op)
+
+def GetStackRegisters(operand):
+    # return the names of the registers in the operand of a stack instruction, in the order in which they are stored
+    nameList = [ ]
+    for name in operand.split(","):
+        nameList += [ "a", "b" ] if name == "d" else [ name ]
+    for name in nameList:
+        if name not in StackRegisterBytes:
+            raise Exception(f"Unknown register '{name}' in stack operand '{operand}'")
+    return [ name for name in StackRegisterBytes if name in nameList ]
+
+def GetInstructionCost(op, operand):
+    # return (cycles, bytes) for an instruction.  For a tfm instruction, this doesn't include the cycles for each byte
+    key = (op, operand)
+    if key not in CostCache:
+        if op in ("pshs", "puls", "pshu", "pulu"):
+            (cycles, bytes) = InstructionCost(op, "stk")
+            numBytes = sum([ StackRegisterBytes[name] for name in GetStackRegisters(operand) ])
+            CostCache[key] = (cycles + StackByteCycles * numBytes, bytes)
+        elif operand == "":
+            CostCache[key] = InstructionCost(op, "inh")
+        elif operand.startswith("#"):
+            CostCache[key] = InstructionCost(op, "imm")
+        elif operand in ("u,x", "x+,y+"):
+            CostCache[key] = InstructionCost(op, "reg")
+        else:
+            match = re.match(r"^(-?\d*),([xyus])$", operand)
+            if match == None:
+                raise Exception(f"Unknown operand in instruction '{op} {operand}'")
+            (cycles, bytes) = InstructionCost(op, "idx")
+            (offsetCycles, offsetBytes) = IndexedOffsetCost(int(match.group(1) or "0"))
+            CostCache[key] = (cycles + offsetCycles, bytes + offsetBytes)
+    return CostCache[key]
 
 # *************************************************************************************************
 # Assembly language output classes
@@ -44,6 +172,23 @@ class AsmMetrics:
         self.bytes += other.bytes
         return self
 
+class AsmInstruction(collections.namedtuple("AsmInstruction", ("label", "op", "operand", "comment", "cycles", "bytes"))):
+    # one line of assembly code: a label (op is None), a comment line (label and op are None), or an instruction.
+    # These are never modified, so the same record may be shared by many streams
+    __slots__ = ()
+
+    def Render(self):
+        if self.label != None:
+            return f"{self.label}\n"
+        if self.op == None:
+            return "            * " + self.comment + "\n"
+        line = "            " + self.op
+        if self.operand != "":
+            line += " " * (12 - len(self.op)) + self.operand
+        if self.comment != "":
+            line += " " * (24 - len(self.operand)) + "* " + self.comment
+        return line + "\n"
+
 regA = 1
 regB = 2
 regD = 3
@@ -57,51 +202,56 @@ regU = 64
 regS = 128
 regName = { regA:"a", regB:"b", regD:"d", regE:"e", regF:"f", regW:"w", regQ:"q", regX:"x", regY:"y", regU:"u", regS:"s" }
 
+# position (shift, mask) of each accumulator in the packed register values, which are in the same order as Q
+RegisterFields = { regA:(24, 0xff), regB:(16, 0xff), regE:(8, 0xff), regF:(0, 0xff), regD:(16, 0xffff), regW:(0, 0xffff), regQ:(0, 0xffffffff) }
+
+# the registers which may be pushed with pshu to write 1 to 6 bytes of a sprite row, in the order in which they are
+# stored in memory.  Each layout is tried, and the one with the fewest cycles for loading its values is used
+StackBlastLayouts = { 1:((regA,), (regB,)), 2:((regD,), (regX,), (regY,)), 3:((regA, regX), (regA, regY), (regB, regX), (regB, regY)),
+                      4:((regX, regY), (regD, regX), (regD, regY)), 5:((regA, regX, regY), (regB, regX, regY)), 6:((regD, regX, regY),) }
+
+# a run of solid bytes must be at least this long to be written with pshu, to make up for setting up U and X
+StackBlastMinBytes = 6
+
 class AsmRegisters:
-    def __init__(self):
-        self.valid = 0
-        self.values = { }
+    # the known contents of the accumulators.  These objects are never modified (WithValue and WithInvalid return a
+    # new register state), so the same state may be shared by any number of code streams
+    __slots__ = ("valid", "values")
 
-    def Invalidate(self, regnum):
-        self.valid &= ~regnum
+    def __init__(self, valid=0, values=0):
+        self.valid = valid
+        self.values = values
 
-    def SetValue(self, regnum, value):
-        self.valid |= regnum
-        if regnum == regD:
-            self.values[regA] = value >> 8
-            self.values[regB] = value & 0xff
-        elif regnum == regW:
-            self.values[regE] = value >> 8
-            self.values[regF] = value & 0xff
-        elif regnum == regQ:
-            self.values[regA] = (value >> 24) & 0xff
-            self.values[regB] = (value >> 16) & 0xff
-            self.values[regE] = (value >> 8) & 0xff
-            self.values[regF] = (value & 0xff)
-        else:
-            self.values[regnum] = value
+    def WithInvalid(self, regnum):
+        return AsmRegisters(self.valid & ~regnum, self.values)
+
+    def WithValue(self, regnum, value):
+        (shift, mask) = RegisterFields[regnum]
+        return AsmRegisters(self.valid | regnum, (self.values & ~(mask << shift)) | ((value & mask) << shift))
 
     def GetValue(self, regnum):
-        if regnum == regD:
-            return ((self.values[regA] << 8) + self.values[regB])
-        elif regnum == regW:
-            return ((self.values[regE] << 8) + self.values[regF])
-        elif regnum == regQ:
-            return ((self.values[regA] << 24) + (self.values[regB] << 16) + (self.values[regE] << 8) + self.values[regF])
-        else:
-            return self.values[regnum]
+        (shift, mask) = RegisterFields[regnum]
+        return (self.values >> shift) & mask
 
     def IsValid(self, regnum):
         return bool((self.valid & regnum) == regnum)
 
+    def GetCacheKey(self):
+        # the values held in invalid registers are never used, so they are not part of the key
+        validMask = 0
+        for regnum in (regA, regB, regE, regF):
+            if (self.valid & regnum) == regnum:
+                validMask |= 0xff << RegisterFields[regnum][0]
+        return (self.valid, self.values & validMask)
+
 class AsmStream:
     def __init__(self, name, regState=None):
         self.name = name
-        if name == None:
-            self.text = ""
-        else:
-            self.text = "*" * 60 + f"\n* {name}:\n" + "*" * 60 + f"\n{name}\n"
+        # the instructions are only rendered as text when the assembly file is written
+        self.instructions = [ ]
         self.metrics = AsmMetrics()
+        # the cycles and bytes removed from the finished function by the peephole optimizer
+        self.peepholeSaved = AsmMetrics()
         if regState == None:
             self.reg = AsmRegisters()
         else:
@@ -109,30 +259,38 @@ class AsmStream:
 
     def __add__(self, other):
         self.metrics += other.metrics
-        self.text += other.text
+        self.instructions += other.instructions
         self.reg = other.reg
         return self
 
+    def Copy(self):
+        # the instruction records and register state are immutable, so only the list needs to be copied
+        newStream = AsmStream(None, self.reg)
+        newStream.name = self.name
+        newStream.instructions = self.instructions.copy()
+        newStream.metrics.cycles = self.metrics.cycles
+        newStream.metrics.bytes = self.metrics.bytes
+        return newStream
+
+    def Render(self):
+        if self.name == None:
+            text = ""
+        else:
+            text = "*" * 60 + f"\n* {self.name}:\n" + "*" * 60 + f"\n{self.name}\n"
+        return text + "".join([ instr.Render() for instr in self.instructions ])
+
     def emit_comment(self, text):
-        self.text += "            * " + text + "\n"
+        self.instructions.append(AsmInstruction(None, None, "", text, 0, 0))
 
     def emit_label(self, text):
-        self.text += f"{text}\n"
-
-    def emit_op(self, op, reg, comment, cycles6809, cycles6309, bytes):
-        # generate string for this instruction line
-        str = "            " + op
-        if reg != "":
-            str += " " * (12 - len(op)) + reg
-        if comment != "":
-            str += " " * (24 - len(reg)) + "* " + comment
-        str += "\n"
-        # update member variables
-        self.text += str
-        if CPU == 6309:
-            self.metrics.cycles += cycles6309
-        else:
-            self.metrics.cycles += cycles6809
+        self.instructions.append(AsmInstruction(text, None, "", "", 0, 0))
+
+    def emit_op(self, op, reg, comment, tfmBytes=0):
+        # the cost of the instruction is taken from the table for the selected CPU timing
+        (cycles, bytes) = GetInstructionCost(op, reg)
+        cycles += TfmByteCycles * tfmBytes
+        self.instructions.append(AsmInstruction(None, op, reg, comment, cycles, bytes))
+        self.metrics.cycles += cycles
         self.metrics.bytes += bytes
 
     def gen_loadimm_accum(self, regnum, value, comment):
@@ -160,8 +318,8 @@ class AsmStream:
             value = value >> 8
         # handle register Q loads separately
         if regnum == regQ:
-            self.emit_op("ldq", (f"#${value:08x}"), comment, 5, 5, 5)
-            self.reg.SetValue(regQ, value)
+            self.emit_op("ldq", (f"#${value:08x}"), comment)
+            self.reg = self.reg.WithValue(regQ, value)
             return
         # sanity check on register to load
         if regnum != regA and regnum != regB and regnum != regD and regnum != regE and regnum != regF and regnum != regW:
@@ -173,42 +331,42 @@ class AsmStream:
         else:
             oldval = None
         if value == 0 and (regnum == regA or regnum == regB):
-            self.emit_op(f"clr{regName[regnum]}", "", comment, 2, 1, 1)
+            self.emit_op(f"clr{regName[regnum]}", "", comment)
         elif value == 0 and CPU == 6309 and (regnum == regD or regnum == regE or regnum == regF or regnum == regW):
-            self.emit_op(f"clr{regName[regnum]}", "", comment, 3, 2, 2)
+            self.emit_op(f"clr{regName[regnum]}", "", comment)
         elif oldval == 255 - value and (regnum == regA or regnum == regB):
-            self.emit_op(f"com{regName[regnum]}", "", comment + f" ({regName[regnum]} = ~${oldval:02x} = ${value:02x})", 2, 1, 1)
+            self.emit_op(f"com{regName[regnum]}", "", comment + f" ({regName[regnum]} = ~${oldval:02x} = ${value:02x})")
         elif oldval == 255 - value and CPU == 6309 and (regnum == regE or regnum == regF):
-            self.emit_op(f"com{regName[regnum]}", "", comment + f" ({regName[regnum]} = ~${oldval:02x} = ${value:02x})", 3, 2, 2)
+            self.emit_op(f"com{regName[regnum]}", "", comment + f" ({regName[regnum]} = ~${oldval:02x} = ${value:02x})")
         elif oldval == 65535 - value and CPU == 6309 and (regnum == regD or regnum == regW):
-            self.emit_op(f"com{regName[regnum]}", "", comment + f" ({regName[regnum]} = ~${oldval:04x} = ${value:04x})", 3, 2, 2)
+            self.emit_op(f"com{regName[regnum]}", "", comment + f" ({regName[regnum]} = ~${oldval:04x} = ${value:04x})")
         elif oldval == (256 - value) & 0xff and (regnum == regA or regnum == regB):
-            self.emit_op(f"neg{regName[regnum]}", "", comment + f" ({regName[regnum]} = -${oldval:02x} = ${value:02x})", 2, 1, 1)
+            self.emit_op(f"neg{regName[regnum]}", "", comment + f" ({regName[regnum]} = -${oldval:02x} = ${value:02x})")
         elif oldval == (65536 - value) & 0xffff and CPU == 6309 and regnum == regD:
-            self.emit_op(f"neg{regName[regnum]}", "", comment + f" ({regName[regnum]} = -${oldval:04x} = ${value:04x})", 3, 2, 2)
+            self.emit_op(f"neg{regName[regnum]}", "", comment + f" ({regName[regnum]} = -${oldval:04x} = ${value:04x})")
         elif oldval == (value - 1) & 0xff and (regnum == regA or regnum == regB):
-            self.emit_op(f"inc{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:02x}+1 = ${value:02x})", 2, 1, 1)
+            self.emit_op(f"inc{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:02x}+1 = ${value:02x})")
         elif oldval == (value - 1) & 0xff and CPU == 6309 and (regnum == regE or regnum == regF):
-            self.emit_op(f"inc{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:02x}+1 = ${value:02x})", 3, 2, 2)
+            self.emit_op(f"inc{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:02x}+1 = ${value:02x})")
         elif oldval == (value - 1) & 0xffff and CPU == 6309 and (regnum == regD or regnum == regW):
-            self.emit_op(f"inc{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:04x}+1 = ${value:04x})", 3, 2, 2)
+            self.emit_op(f"inc{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:04x}+1 = ${value:04x})")
         elif oldval == (value + 1) & 0xff and (regnum == regA or regnum == regB):
-            self.emit_op(f"dec{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:02x}-1 = ${value:02x})", 2, 1, 1)
+            self.emit_op(f"dec{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:02x}-1 = ${value:02x})")
         elif oldval == (value + 1) & 0xff and CPU == 6309 and (regnum == regE or regnum == regF):
-            self.emit_op(f"dec{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:02x}-1 = ${value:02x})", 3, 2, 2)
+            self.emit_op(f"dec{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:02x}-1 = ${value:02x})")
         elif oldval == (value + 1) & 0xffff and CPU == 6309 and (regnum == regD or regnum == regW):
-            self.emit_op(f"dec{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:04x}-1 = ${value:04x})", 3, 2, 2)
+            self.emit_op(f"dec{regName[regnum]}", "", comment + f" ({regName[regnum]} = ${oldval:04x}-1 = ${value:04x})")
         else:
             # we must do a full register load instruction
             if regnum == regD:
-                self.emit_op("ldd", (f"#${value:04x}"), comment, 3, 3, 3)
+                self.emit_op("ldd", (f"#${value:04x}"), comment)
             elif regnum == regW:
-                self.emit_op("ldw", (f"#${value:04x}"), comment, 4, 4, 4)
+                self.emit_op("ldw", (f"#${value:04x}"), comment)
             elif regnum == regE or regnum == regF:
-                self.emit_op(f"ld{regName[regnum]}", (f"#${value:02x}"), comment, 3, 3, 3)
+                self.emit_op(f"ld{regName[regnum]}", (f"#${value:02x}"), comment)
             else:
-                self.emit_op(f"ld{regName[regnum]}", (f"#${value:02x}"), comment, 2, 2, 2)
-        self.reg.SetValue(regnum, value)
+                self.emit_op(f"ld{regName[regnum]}", (f"#${value:02x}"), comment)
+        self.reg = self.reg.WithValue(regnum, value)
 
     def gen_loadstore_indexed(self, bLoad, regLdSt, regIdx, offset, comment):
         opcode = "{}{}".format({False:"st",True:"ld"}[bLoad], regName[regLdSt])
@@ -216,41 +374,9 @@ class AsmStream:
             operands = f",{regName[regIdx]}"
         else:
             operands = f"{int(offset)},{regName[regIdx]}"
-        if regLdSt == regA or regLdSt == regB:
-            cycles = 4
-            bytes = 2
-        elif regLdSt == regE or regLdSt == regF:
-            cycles = 5
-            bytes = 3
-        elif regLdSt == regD or regLdSt == regU or regLdSt == regX:
-            cycles = 5
-            bytes = 2
-        elif regLdSt == regS or regLdSt == regW or regLdSt == regY:
-            cycles = 6
-            bytes = 3
-        elif regLdSt == regQ:
-            cycles = 8
-            bytes = 3
-        else:
-            raise Exception(f"Unsupported register {int(regLdSt)}")
-        if offset == 0:
-            cycles += 0
-            bytes += 0
-        elif offset < 16 and offset >= -16:
-            cycles += 1
-            bytes += 0
-        elif offset < 128 and offset >= -128:
-            cycles += 1
-            bytes += 1
-        else:
-            if CPU == 6309:
-                cycles += 3
-            else:
-                cycles += 4  # only 3 if 6309
-            bytes += 2
-        self.emit_op(opcode, operands, comment, cycles, cycles, bytes)
+        self.emit_op(opcode, operands, comment)
         if bLoad:
-            self.reg.Invalidate(regLdSt)
+            self.reg = self.reg.WithInvalid(regLdSt)
 
     def gen_loadeffaddr_offset(self, regDst, offset, regSrc, comment):
         opcode = f"lea{regName[regDst]}"
@@ -258,25 +384,144 @@ class AsmStream:
             operands = f",{regName[regSrc]}"
         else:
             operands = f"{int(offset)},{regName[regSrc]}"
-        cycles6309 = 4
-        cycles6809 = 4
-        bytes = 2
-        if offset == 0:
+        self.emit_op(opcode, operands, comment)
+
+
+# *************************************************************************************************
+# Code caches: the best code found for each searched fragment, shared by all sprites processed in this run
+# *************************************************************************************************
+
+class AsmCodeCache:
+    # the cached code streams are shared by all of the callers, so they must never be modified
+    def __init__(self):
+        self.fragments = { }
+        self.hits = 0
+        self.misses = 0
+
+    def Lookup(self, key):
+        if key not in self.fragments:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.fragments[key]
+
+    def Store(self, key, fragAsm):
+        self.fragments[key] = fragAsm
+
+# best code for a whole row
+RowCache = AsmCodeCache()
+# best 6309 write code for a list of bytes to write, following the store code in a row
+WriteCache = AsmCodeCache()
+
+# compiled sprites are cached in the folder given by the DYNO_CACHE_DIR environment variable (if it is set).  Every
+# cache key includes a hash of this script, so that any change to the compiler makes new keys.  When the cache grows
+# past CacheMaxBytes, the least recently used sprites are deleted
+CacheMaxBytes = 64 * 1048576
+CompilerVersion = None
+
+def GetCompilerVersion():
+    global CompilerVersion
+    if CompilerVersion is None:
+        with open(os.path.abspath(__file__), "rb") as f:
+            CompilerVersion = hashlib.sha256(f.read()).hexdigest()
+    return CompilerVersion
+
+class SpriteCodeCache:
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def Get(self, key):
+        cachePath = os.path.join(self.cacheDir, key + ".spr")
+        try:
+            with open(cachePath, "rb") as f:
+                compiledState = pickle.load(f)
+            # touch the file, so that the eviction order is least recently used
+            os.utime(cachePath)
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return compiledState
+
+    def Put(self, key, compiledState):
+        cachePath = os.path.join(self.cacheDir, key + ".spr")
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            # write to a temporary file first, so that other builds never read a partial sprite
+            tempPath = cachePath + f".{int(os.getpid())}.tmp"
+            with open(tempPath, "wb") as f:
+                pickle.dump(compiledState, f)
+            os.replace(tempPath, cachePath)
+            self.Evict()
+        except OSError:
+            # the cache is only an optimization, so a read-only or full disk is not an error
             pass
-        elif offset < 16 and offset >= -16:
-            cycles6309 += 1
-            cycles6809 += 1
-            bytes += 0
-        elif offset < 128 and offset >= -128:
-            cycles6309 += 1
-            cycles6809 += 1
-            bytes += 1
-        else:
-            cycles6309 += 3
-            cycles6809 += 4
-            bytes += 2
-        self.emit_op(opcode, operands, comment, cycles6309, cycles6809, bytes)
 
+    def Evict(self):
+        # delete the least recently used sprites until the cache is no bigger than maxBytes
+        entryList = [ ]
+        totalBytes = 0
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith(".spr"):
+                stat = entry.stat()
+                entryList.append((stat.st_mtime, stat.st_size, entry.path))
+                totalBytes += stat.st_size
+        if totalBytes <= self.maxBytes:
+            return
+        entryList.sort()
+        for (mtime, size, path) in entryList:
+            os.remove(path)
+            totalBytes -= size
+            if totalBytes <= self.maxBytes:
+                break
+
+# number of register states kept at each step of the 6309 row write optimizer
+Max6309WriteStates = 8
+
+# number of nodes which the exhaustive 6309 row layout search may visit in one row, unless the row is split into
+# chunks with the ChunkHint parameter
+Max6309SearchNodes = 20000
+
+# number of partial Draw functions (with different register contents) kept after each row by the row planner.  The
+# planner doubles the compile time and saves only a few cycles, so it is only used by the time-budgeted search
+MaxRowPlans = 8
+
+# search levels for compiling a Draw function with a time budget, as (row plans, 6309 write states, 6809 row layouts
+# to try or None to try all of them, 6309 exhaustive search nodes).  The first level is a greedy search, and the
+# second is the search done without a time budget, which keeps only the fastest code after each row.  Both are always
+# finished, and each deeper level which finishes in time may find faster code
+SearchLevels = [ (1, 1, 1, 0), (1, Max6309WriteStates, None, Max6309SearchNodes), (MaxRowPlans, Max6309WriteStates, None, Max6309SearchNodes),
+                 (16, 16, None, 4*Max6309SearchNodes), (32, 32, None, 16*Max6309SearchNodes), (64, 64, None, 64*Max6309SearchNodes) ]
+
+class SearchTimeout(Exception):
+    # raised inside the Draw function search when its time budget runs out
+    pass
+
+class SearchNodeLimit(Exception):
+    # raised inside the exhaustive 6309 row layout search when it has visited too many nodes
+    pass
+
+def LoadableFromValue(value):
+    # register values from which gen_loadimm_accum can make the given byte value without an immediate load
+    return set((value, (value+1) & 0xff, (value-1) & 0xff, 255-value, (256-value) & 0xff))
+
+# *************************************************************************************************
+# Layout search statistics and cost bounds
+# *************************************************************************************************
+
+class SearchNodeCounter:
+    def __init__(self):
+        self.visited = 0
+        self.pruned = 0
+
+SearchNodes = SearchNodeCounter()
+
+def IndexedOffsetCycles(offset):
+    # extra cycles taken by the offset in an indexed load/store instruction
+    return IndexedOffsetCost(offset)[0]
 
 # *************************************************************************************************
 # Sprite class: object definition, parsing, pre/post processing
@@ -292,6 +537,12 @@ class Sprite:
         self.hasRowPointerArray = False
         self.matrix = []
         self.hotspot = (0, 0)
+        self.animateTo = []
+        # for a Delta sprite, which changes the sprite 'deltaFrom' (already drawn) into this one, the sprite 'deltaTo'
+        self.deltaFrom = None
+        self.deltaTo = None
+        # True if the sprite is erased by redrawing the background tiles, so its Draw functions save nothing
+        self.eraseRedraw = False
         # member variables which are calculated
         self.numPixels = 0
         self.numSavedBytes = 0
@@ -301,9 +552,15 @@ class Sprite:
         self.originXcode = 0    # Index of pixel column in sprite which will be written into left pixel (MSB) of
                                 # the byte to which the destination pointer is pointing when DrawLeft is called.
                                 # When DrawRight is called, this pixel will be written into the right (LSB) of the destination byte
-        self.chunkHint = sys.maxsize # Chunk to process rows - this is a compromise between performance and 
         self.funcErase = AsmStream(f"Erase_{name}")
         self.funcDraw = [ None, None ]
+        # number of bytes in each chunk of a row for the exhaustive 6309 layout search
+        self.chunkHint = sys.maxsize
+        self.exhaustiveNodesLeft = None
+        # seconds to spend searching for the fastest code for each Draw function, or None for the standard search
+        self.timeBudget = None
+        self.searchLevel = SearchLevels[1]
+        self.deadline = None
 
     def ReadInputLine(self, line):
         pivot = line.find('=')
@@ -323,6 +580,10 @@ class Sprite:
                 self.hotspot = (coords[0], coords[1])
             elif key == "chunkhint":
                 self.chunkHint = int(value)
+            elif key == "animateto":
+                self.animateTo = [ name.strip() for name in value.split(',') if name.strip() != "" ]
+            elif key == "timebudget":
+                self.timeBudget = float(value)
             else:
                 print(f"illegal line in Sprite '{self.name}' definition: {line}")
         else:
@@ -343,6 +604,35 @@ class Sprite:
         else:
             self.funcDraw[0] = AsmStream(f"Draw_{self.name}")
 
+    def SetDeltaFrames(self, fromSprite, toSprite):
+        # make this a Delta sprite which changes fromSprite into toSprite.  It is drawn at the same position as
+        # toSprite, so it takes all of its parameters
+        self.deltaFrom = fromSprite
+        self.deltaTo = toSprite
+        self.width = toSprite.width
+        self.height = toSprite.height
+        self.hasSinglePixelPos = toSprite.hasSinglePixelPos
+        self.hasRowPointerArray = toSprite.hasRowPointerArray
+        self.matrix = toSprite.matrix
+        self.hotspot = toSprite.hotspot
+        self.FinishDefinition()
+
+    def GetCompileCacheKey(self):
+        # the compiled code depends upon everything read from the sprite file (the name is used in the labels),
+        # the CPU type and timing, the peephole optimizer's cycles-vs-bytes tradeoff, and the compiler itself
+        keyHash = hashlib.sha256(f"{GetCompilerVersion()}:{int(CPU)}:{CpuTiming}:{int(PeepholeBytesPerCycle)}:".encode())
+        keyHash.update(repr((self.name, self.width, self.height, self.hasSinglePixelPos, self.hasRowPointerArray, self.hotspot, self.matrix, self.chunkHint, self.timeBudget, self.eraseRedraw)).encode())
+        if self.deltaFrom != None:
+            keyHash.update(self.deltaFrom.GetCompileCacheKey().encode())
+        return keyHash.hexdigest()
+
+    def GetCompiledState(self):
+        # the results of compilation which are used for the statistics and the assembly output
+        return (self.numPixels, self.numSavedBytes, self.rowStripList, self.originXsprite, self.originXcode, self.funcErase, self.funcDraw)
+
+    def SetCompiledState(self, compiledState):
+        (self.numPixels, self.numSavedBytes, self.rowStripList, self.originXsprite, self.originXcode, self.funcErase, self.funcDraw) = compiledState
+
     def Process1_PreCalc(self):
         # analyze each row and make list of non-transparent strips (consecutive pixels)
         for y in range(self.height):
@@ -366,22 +656,46 @@ class Sprite:
                 stripList.append((stripStart, stripLen))
             # append this strip array to the row list
             self.rowStripList.append(stripList)
-        # calculate OriginX
+        self.CalcOrigin()
+
+    def CalcOrigin(self):
         self.originXsprite = self.hotspot[0]
         self.originXcode = ((self.width >> 1) & ~1) | (self.originXsprite & 1)
 
+    def GetSavedByteOffsets(self, y):
+        # return a list of the byte offsets (relative to the destination pointer) in row y which contain pixels in
+        # either the DrawLeft or DrawRight function.  Their background is saved by Draw and restored by Erase
+        byteList = []
+        for x in range(self.width):
+            if self.matrix[y][x] == -1:
+                continue
+            byteOffL = (x - self.originXcode) >> 1
+            byteOffR = (x - self.originXcode + 1) >> 1
+            if len(byteList) == 0 or byteList[-1] != byteOffL:
+                byteList.append(byteOffL)
+            if self.hasSinglePixelPos and byteList[-1] != byteOffR:
+                byteList.append(byteOffR)
+        return byteList
+
     # *************************************************************************************************
     # Sprite class: Erase function generation
     # *************************************************************************************************
 
-    def Process2_GenErase(self):
+    def EmitEraseHeader(self, funcErase):
         # print input conditions
-        self.funcErase.emit_comment("Input:   X = Pointer to buffer containing saved pixel data")
-        self.funcErase.emit_comment("         Y = Pointer to graphics memory")
+        funcErase.emit_comment("Input:   X = Pointer to buffer containing saved pixel data")
+        funcErase.emit_comment("         Y = Pointer to graphics memory")
         if CPU == 6309:
-            self.funcErase.emit_comment("Trashed: X,Y,D,W")
+            funcErase.emit_comment("Trashed: X,Y,D,W")
         else:
-            self.funcErase.emit_comment("Trashed: X,Y,D")
+            funcErase.emit_comment("Trashed: X,Y,D")
+
+    def Process2_GenErase(self):
+        if self.eraseRedraw:
+            # the engine redraws the background blocks under the sprite, so there is no Erase function
+            self.funcErase.emit_comment("Erased by redrawing the background tiles")
+            return
+        self.EmitEraseHeader(self.funcErase)
         # this gives the offset (relative to X pointer) from which newly restored bytes will be loaded
         SrcPtrOffNew = 0
         # the lineAdvance parameter gives the offset in rows to the line in graphics memory which we are writing
@@ -397,16 +711,7 @@ class Sprite:
                 lineAdvance += 1
                 continue
             # generate a list of all the byte offsets which must be stored
-            byteList = []
-            for x in range(self.width):
-                if self.matrix[y][x] == -1:
-                    continue
-                byteOffL = (x - self.originXcode) >> 1
-                byteOffR = (x - self.originXcode + 1) >> 1
-                if len(byteList) == 0 or byteList[-1] != byteOffL:
-                    byteList.append(byteOffL)
-                if self.hasSinglePixelPos and byteList[-1] != byteOffR:
-                    byteList.append(byteOffR)
+            byteList = self.GetSavedByteOffsets(y)
             # now, generate a list of byte strips which must be copied
             byteStripList = []
             byteStart = byteList[0]
@@ -427,7 +732,7 @@ class Sprite:
             for stripIdx in range(len(byteStripList)):
                 strip = byteStripList[stripIdx]
                 # first, try the erase operation with load/store accumulator instructions
-                asmStripAccum = AsmStream(None, copy.deepcopy(self.funcErase.reg))
+                asmStripAccum = AsmStream(None, self.funcErase.reg)
                 SrcPtrOffAccum = SrcPtrOffNew
                 lineAdvanceAccum = lineAdvance
                 DstCenterOffAccum = DstCenterOff
@@ -481,7 +786,7 @@ class Sprite:
                     strip = (strip[0] + 1, strip[1] - 1)
                 # then try the erase operation with TFM instructions
                 if CPU == 6309:
-                    asmStripTfm = AsmStream(None, copy.deepcopy(self.funcErase.reg))
+                    asmStripTfm = AsmStream(None, self.funcErase.reg)
                     SrcPtrOffTfm = SrcPtrOffNew
                     lineAdvanceTfm = lineAdvance
                     DstCenterOffTfm = DstCenterOff
@@ -500,9 +805,8 @@ class Sprite:
                     # tfm: load number of bytes to copy in W register
                     asmStripTfm.gen_loadimm_accum(regW, strip[1], "")
                     # tfm: do the copy
-                    cycles = 6 + 3 * strip[1]
-                    asmStripTfm.emit_op("tfm", "x+,y+", "", cycles, cycles, 3)
-                    asmStripTfm.reg.SetValue(regW, 0)
+                    asmStripTfm.emit_op("tfm", "x+,y+", "", strip[1])
+                    asmStripTfm.reg = asmStripTfm.reg.WithValue(regW, 0)
                     # tfm: source pointer was advanced, so still at 0, so no need to update SrcPtrOffTfm
                     # tfm: destination pointer was advanced, so update DstCenterOffTfm
                     DstCenterOffTfm += strip[1]
@@ -521,18 +825,114 @@ class Sprite:
             # next iteration will be on the next line
             lineAdvance += 1
         # dump out return instruction
-        self.funcErase.emit_op("rts", "", "", 5, 4, 1)
+        self.funcErase.emit_op("rts", "", "")
+        PeepholeOptimizer().Optimize(self.funcErase)
+        # also try restoring the bytes with stack pulls, and keep whichever function is faster
+        self.funcErase = self.BestResult(self.funcErase, self.GenErasePull())
+        if self.deltaFrom != None:
+            self.GenDeltaErase()
+
+    def GenErasePull(self):
+        # generate an Erase function which reads the saved bytes with pulu instructions, which load up to 4 bytes (into
+        # D and X) at a time.  The buffer is read in order, so U is used as its pointer and X is free to hold data.  The
+        # engine's erase loop expects U to be preserved, so it is saved on the S stack
+        funcPull = AsmStream(self.funcErase.name)
+        self.EmitEraseHeader(funcPull)
+        funcPull.emit_op("pshs", "u", "")
+        funcPull.gen_loadeffaddr_offset(regU, 0, regX, "")
+        lineAdvance = 0
+        for y in range(self.height):
+            if len(self.rowStripList[y]) == 0:
+                lineAdvance += 1
+                continue
+            # the peephole optimizer will choose better positions for the destination pointer
+            if lineAdvance > 0:
+                funcPull.gen_loadeffaddr_offset(regY, 256 * lineAdvance, regY, "")
+            funcPull += self.GenErasePullRow(self.GetSavedByteOffsets(y))
+            lineAdvance = 1
+        funcPull.emit_op("puls", "u,pc", "")
+        PeepholeOptimizer().Optimize(funcPull)
+        return funcPull
+
+    def GenErasePullRow(self, byteList):
+        # dynamic programming over the saved bytes in one row: bestAsm[idx] is the fastest code to restore the bytes
+        # from idx to the end of the row.  The registers are pulled in the order A, B, X, and the 2 bytes in X (or D)
+        # may only be stored with one instruction if they are next to each other in graphics memory
+        bestAsm = [ None ] * len(byteList) + [ AsmStream(None) ]
+        for idx in range(len(byteList) - 1, -1, -1):
+            for pullRegs in ((regA,), (regD,), (regA, regX), (regD, regX)):
+                numBytes = sum([ RegisterSizes[regnum] for regnum in pullRegs ])
+                if idx + numBytes > len(byteList):
+                    continue
+                pullAsm = AsmStream(None)
+                pullAsm.emit_op("pulu", ",".join([ regName[regnum] for regnum in pullRegs ]), "")
+                byteIdx = idx
+                for regnum in pullRegs:
+                    offX = byteList[byteIdx]
+                    if RegisterSizes[regnum] == 1 or byteList[byteIdx+1] == offX + 1:
+                        pullAsm.gen_loadstore_indexed(False, regnum, regY, offX, "")
+                    elif regnum == regD:
+                        pullAsm.gen_loadstore_indexed(False, regA, regY, offX, "")
+                        pullAsm.gen_loadstore_indexed(False, regB, regY, byteList[byteIdx+1], "")
+                    else:
+                        break
+                    byteIdx += RegisterSizes[regnum]
+                else:
+                    pullAsm += bestAsm[idx + numBytes]
+                    if bestAsm[idx] == None:
+                        bestAsm[idx] = pullAsm
+                    else:
+                        bestAsm[idx] = self.BestResult(bestAsm[idx], pullAsm)
+        return bestAsm[0]
 
     # *************************************************************************************************
     # Sprite class: Draw function generation
     # *************************************************************************************************
 
     def Process3_GenDraw(self, funcNum):
+        if self.deltaFrom != None:
+            self.GenDelta(funcNum)
+        elif self.timeBudget != None:
+            self.GenDrawAnytime(funcNum)
+        else:
+            self.GenDraw(funcNum)
+
+    def GenDrawAnytime(self, funcNum):
+        # generate the Draw function at each search level in turn until the time budget runs out, and keep the
+        # fastest one.  The greedy level and the standard level (the search done without a time budget) have no
+        # deadline, so a time budget never gives slower code than no budget
+        deadline = time.monotonic() + self.timeBudget
+        funcName = self.funcDraw[funcNum].name
+        bestDraw = None
+        for (levelIdx, searchLevel) in enumerate(SearchLevels):
+            self.searchLevel = searchLevel
+            self.deadline = deadline if levelIdx > 1 else None
+            self.funcDraw[funcNum] = AsmStream(funcName)
+            try:
+                self.GenDraw(funcNum)
+            except SearchTimeout:
+                break
+            if bestDraw == None:
+                bestDraw = self.funcDraw[funcNum]
+            else:
+                bestDraw = self.BestResult(bestDraw, self.funcDraw[funcNum])
+            if levelIdx > 0 and time.monotonic() > deadline:
+                break
+        self.funcDraw[funcNum] = bestDraw
+        self.searchLevel = SearchLevels[1]
+        self.deadline = None
+
+    def CheckDeadline(self):
+        if self.deadline != None and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def GenDraw(self, funcNum):
         # funcNum 0 is for Draw/DrawLeft, funcNum 1 if for DrawRight
         funcDraw = self.funcDraw[funcNum]
         # print input conditions
         funcDraw.emit_comment("Input:   X = Pointer to graphics memory")
-        funcDraw.emit_comment("         Y = Pointer to buffer for storing background pixel data")
+        if not self.eraseRedraw:
+            funcDraw.emit_comment("         Y = Pointer to buffer for storing background pixel data")
         if CPU == 6309:
             funcDraw.emit_comment("Trashed: X,Y,D,W,U")
         else:
@@ -545,21 +945,13 @@ class Sprite:
                 byteStripsByRow.append([])
                 continue
             # generate a list of all the byte offsets which must be stored (same as in Erase function)
-            byteStoreList = []
-            for x in range(self.width):
-                if self.matrix[y][x] == -1:
-                    continue
-                byteOffL = (x - self.originXcode) >> 1
-                byteOffR = (x - self.originXcode + 1) >> 1
-                if len(byteStoreList) == 0 or byteStoreList[-1] != byteOffL:
-                    byteStoreList.append(byteOffL)
-                if self.hasSinglePixelPos and byteStoreList[-1] != byteOffR:
-                    byteStoreList.append(byteOffR)
+            byteStoreList = self.GetSavedByteOffsets(y)
             # now generate a list of byte commands for the given draw routine
             # - Command 0: ignore (no Write routines modify either nibble in byte)
             # - Command 1: store only (other Write routine modifies byte)
             # - Command 2: store and write 1 nibble
             # - Command 3: store and write both nibbles
+            # if the sprite is erased by redrawing the background, then nothing is stored, so command 1 bytes are ignored
             byteCmds = [ ]  # value is (command number, value to store, mask)
             byteOffStart = (0 - self.originXcode) >> 1
             byteOffEnd = (self.width - self.originXcode) >> 1
@@ -584,7 +976,7 @@ class Sprite:
                     byteCmds.append((0, 0, 0))
                     continue
                 if nibToWrite == 0:
-                    byteCmds.append((1, 0, 0))
+                    byteCmds.append((0 if self.eraseRedraw else 1, 0, 0))
                     continue
                 if nibToWrite == 1:
                     byteCmds.append((2, valToWrite, maskToWrite))
@@ -611,6 +1003,15 @@ class Sprite:
                 thisStrip.append(byteCmds[idx])
             byteStripsByRow.append(byteStrips)
             # process the next row
+        # make a list of the Command-3 byte values in each row, which the row planner tries to leave in registers
+        self.writeValuesByRow = [ ]
+        for y in range(self.height):
+            writeValues = set()
+            for (offX, byteCmds) in byteStripsByRow[y]:
+                for byteCmd in byteCmds:
+                    if byteCmd[0] == 3:
+                        writeValues.add(byteCmd[1])
+            self.writeValuesByRow.append(writeValues)
         # build some custom data structures for the algorithm corresponding with the target CPU
         if CPU == 6309:
             pass
@@ -684,9 +1085,11 @@ class Sprite:
         self.lineAdvance = 0
         # but this is only used for the 6809. For the 6309, we always use "addr U,X" to advance one row
         if CPU == 6309:
-            funcDraw.emit_op("ldu","#256","", 3, 3, 3);
-        # now we will generate optimized assembly code for each row
-        regState = AsmRegisters()
+            funcDraw.emit_op("ldu","#256","")
+        # now we will generate optimized assembly code for each row.  The code chosen for each row determines which
+        # values are left in the registers for the next row, so the row planner may keep the fastest few partial Draw
+        # functions for different register values, and choose the fastest complete one at the end
+        planList = [ AsmStream(None) ]
         for y in range(self.height):
             # get list of byte command strips for this row, and count total number of bytes to save
             byteStrips = byteStripsByRow[y]
@@ -699,39 +1102,207 @@ class Sprite:
                 totalBytesToSave += len(cmdStrip[1])
             # set a flag if we will only store one byte or one word for this row
             bSingleWriteOp = totalBytesToSave < 2 or (totalBytesToSave == 2 and len(byteStrips) == 1)
+            if self.eraseRedraw:
+                totalBytesToSave = 0
             # advance the Y pointer if necessary
+            advanceAsm = AsmStream(None)
             if self.YPtrOffNew + totalBytesToSave > 64:
                 bytesToAdvance = self.YPtrOffNew + 16
-                funcDraw.gen_loadeffaddr_offset(regY, bytesToAdvance, regY, "")
+                advanceAsm.gen_loadeffaddr_offset(regY, bytesToAdvance, regY, "")
                 self.YPtrOffNew = -16
             # advance the X pointer if necessary
             if CPU == 6309:
                 if self.lineAdvance == 1:
-                    funcDraw.emit_op("addr", "u,x", "", 4, 4, 3)
+                    advanceAsm.emit_op("addr", "u,x", "")
                 elif self.lineAdvance > 1:
-                    funcDraw.gen_loadeffaddr_offset(regX, 256*self.lineAdvance, regX, "")
+                    advanceAsm.gen_loadeffaddr_offset(regX, 256*self.lineAdvance, regX, "")
                 self.lineAdvance = 0
             else:
                 if self.lineAdvance > 0 and not bSingleWriteOp:
-                    funcDraw.gen_loadeffaddr_offset(regX, 256*self.lineAdvance, regX, "")
+                    advanceAsm.gen_loadeffaddr_offset(regX, 256*self.lineAdvance, regX, "")
                     self.lineAdvance = 0
+            self.CheckDeadline()
             # fixme save the YPtrOffNew here if hasRowPointerArray is true
             if self.hasRowPointerArray:
-                funcDraw.emit_label(f"Row{int(y)}_{funcDraw.name}")
-            # call the specific row handler method for the current CPU
-            if CPU == 6309:
-                rowAsm = self.RowDraw6309(y, regState, byteStrips)
-            else:
-                rowAsm = self.RowDraw6809(y, regState, byteStrips)
-            # update our draw function with the best Asm code for this row, and update our register state tracking variable
-            funcDraw += rowAsm
-            regState = rowAsm.reg
+                advanceAsm.emit_label(f"Row{int(y)}_{funcDraw.name}")
+            # extend each partial Draw function with each candidate code for this row, keeping the fastest one
+            # for each set of register values which could be useful to the next row
+            nextPlans = { }
+            for planAsm in planList:
+                # the pointer advance code doesn't change the accumulators
+                advanceAsm.reg = planAsm.reg
+                planAsm += advanceAsm
+                for rowAsm in self.GetRowCode(y, planAsm.reg, byteStrips):
+                    trialAsm = planAsm.Copy()
+                    trialAsm += rowAsm
+                    planKey = self.GetPlanKey(y, trialAsm.reg)
+                    if planKey not in nextPlans:
+                        nextPlans[planKey] = trialAsm
+                    else:
+                        nextPlans[planKey] = self.BestResult(nextPlans[planKey], trialAsm)
+            planList = self.PrunePlans(y, nextPlans.values())
             # next iteration will be on the next line
             self.YPtrOffNew += totalBytesToSave
             self.lineAdvance += 1
-        # dump out return instruction
-        funcDraw.emit_op("rts", "", "", 5, 4, 1)
+        # add the fastest code to our draw function, and dump out return instruction
+        funcDraw += planList[0]
+        funcDraw.emit_op("rts", "", "")
+        PeepholeOptimizer().Optimize(funcDraw)
+
+    def PrunePlans(self, y, planAsmList):
+        # the register values left by one plan could be loaded after another plan with one immediate load for each
+        # register which differs, so a slower plan is only worth keeping if it is faster than that
+        planAsmList = sorted(planAsmList, key=lambda planAsm: (planAsm.metrics.cycles, planAsm.metrics.bytes))
+        keptList = [ ]
+        for planAsm in planAsmList:
+            planKey = self.GetPlanKey(y, planAsm.reg)
+            bDominated = False
+            for keptAsm in keptList:
+                keptKey = self.GetPlanKey(y, keptAsm.reg)
+                loadCycles = 0
+                for keyIdx in range(4):
+                    if planKey[keyIdx] != None and planKey[keyIdx] != keptKey[keyIdx]:
+                        loadCycles += InstructionCost("ld" + "abef"[keyIdx], "imm")[0]
+                if keptAsm.metrics.cycles + loadCycles <= planAsm.metrics.cycles:
+                    bDominated = True
+                    break
+            if not bDominated:
+                keptList.append(planAsm)
+                if len(keptList) == self.searchLevel[0]:
+                    break
+        return keptList
+
+    def GetRowCode(self, y, regState, byteStrips):
+        # call the specific row handler method for the current CPU, unless we have already generated code
+        # for an identical row (for example, in another frame of an animation).  This returns a list of
+        # candidate code for the row, leaving different register values for the next row
+        rowKey = self.GetRowCacheKey(y, regState, byteStrips)
+        rowAsmList = RowCache.Lookup(rowKey)
+        if rowAsmList == None:
+            if CPU == 6309:
+                rowAsmList = self.RowDraw6309(y, regState, byteStrips)
+            else:
+                rowAsmList = self.RowDraw6809(y, regState, byteStrips)
+            if self.eraseRedraw:
+                rowAsmList = self.GetRowCandidates(y, rowAsmList + self.RowDrawStackBlast(y, regState, byteStrips))
+            RowCache.Store(rowKey, rowAsmList)
+        return rowAsmList
+
+    def GetRowCacheKey(self, y, regState, byteStrips):
+        # the generated code for a row depends upon its byte commands, the starting register state, the current
+        # pointer offsets, and the register values which could be useful to the following row.  On the 6809,
+        # the word write order also depends upon the write probabilities in the following row
+        stripKey = tuple([ (offX, tuple(byteCmds)) for (offX, byteCmds) in byteStrips ])
+        nextValuesKey = tuple(sorted(self.GetNextRowValues(y)))
+        if CPU == 6309:
+            return (CPU, self.searchLevel[1], self.searchLevel[3], self.chunkHint, self.eraseRedraw, stripKey, regState.GetCacheKey(), self.YPtrOffNew, nextValuesKey)
+        nextRowKey = None
+        if y < self.height - 1:
+            nextRowKey = (tuple(sorted(self.wordWriteProbByRow[y+1].items())), tuple(sorted(self.byteWriteProbByRow[y+1].items())))
+        return (CPU, self.searchLevel[0] > 1, self.searchLevel[2], self.eraseRedraw, stripKey, regState.GetCacheKey(), self.YPtrOffNew, self.lineAdvance, nextRowKey, nextValuesKey)
+
+    def GetNextRowValues(self, y):
+        # byte values to write in the row after row y
+        if y < self.height - 1:
+            return self.writeValuesByRow[y+1]
+        return set()
 
+    def GetPlanKey(self, y, regState):
+        # partial Draw functions whose registers hold the same values to write in the next row are equivalent
+        planKey = [ ]
+        nextRowValues = self.GetNextRowValues(y)
+        for regnum in (regA, regB, regE, regF):
+            if regState.IsValid(regnum) and regState.GetValue(regnum) in nextRowValues:
+                planKey.append(regState.GetValue(regnum))
+            else:
+                planKey.append(None)
+        return tuple(planKey)
+
+    def GetRowCandidates(self, y, rowAsmList):
+        # keep only the fastest row code for each plan key, with the fastest one first
+        bestByKey = { }
+        for rowAsm in rowAsmList:
+            planKey = self.GetPlanKey(y, rowAsm.reg)
+            if planKey not in bestByKey:
+                bestByKey[planKey] = rowAsm
+            else:
+                bestByKey[planKey] = self.BestResult(bestByKey[planKey], rowAsm)
+        return sorted(bestByKey.values(), key=lambda rowAsm: (rowAsm.metrics.cycles, rowAsm.metrics.bytes))
+
+    # *************************************************************************************************
+    # Sprite class: Draw function row generation with stack pushes
+    # *************************************************************************************************
+
+    def RowDrawStackBlast(self, y, regState, byteStrips):
+        # when the sprite is erased by redrawing the background, nothing is saved, so Y is free.  A run of solid
+        # (Command-3) bytes may then be written backwards with pshu, up to 6 bytes (D, X, and Y) per instruction,
+        # with U pointing to the end of the run.  The other bytes in the row are written by the usual row code
+        # afterwards.  This returns a list of candidate code for the row, one for each run which is long enough
+        rowAsmList = [ ]
+        for (stripIdx, (offX, byteCmds)) in enumerate(byteStrips):
+            runStart = None
+            for idx in range(len(byteCmds) + 1):
+                if idx < len(byteCmds) and byteCmds[idx][0] == 3:
+                    if runStart == None:
+                        runStart = idx
+                    continue
+                if runStart != None and idx - runStart >= StackBlastMinBytes:
+                    blastAsm = self.GenStackBlast(regState, offX + runStart, [ byteCmd[1] for byteCmd in byteCmds[runStart:idx] ])
+                    otherStrips = byteStrips[:stripIdx]
+                    if runStart > 0:
+                        otherStrips.append((offX, byteCmds[:runStart]))
+                    if idx < len(byteCmds):
+                        otherStrips.append((offX + idx, byteCmds[idx:]))
+                    otherStrips += byteStrips[stripIdx+1:]
+                    if len(otherStrips) == 0:
+                        rowAsmList.append(blastAsm)
+                        continue
+                    for otherAsm in self.GetRowCode(y, blastAsm.reg, otherStrips):
+                        trialAsm = blastAsm.Copy()
+                        trialAsm += otherAsm
+                        rowAsmList.append(trialAsm)
+                runStart = None
+        return rowAsmList
+
+    def GenStackBlast(self, regState, offX, runValues):
+        # write the bytes in runValues, starting at offset offX from X, with pshu instructions.  X is used to hold
+        # data, and afterwards it is recalculated from U, which points to the start of the run.  On the 6309, U is
+        # then re-loaded with the row stride
+        blastAsm = AsmStream(None, regState)
+        rowOffset = 256 * self.lineAdvance
+        blastAsm.gen_loadeffaddr_offset(regU, offX + rowOffset + len(runValues), regX, "")
+        # the values in X and Y are not known at first
+        pointerValues = { regX:None, regY:None }
+        endIdx = len(runValues)
+        while endIdx > 0:
+            chunkValues = runValues[max(endIdx - 6, 0):endIdx]
+            bestAsm = None
+            for layout in StackBlastLayouts[len(chunkValues)]:
+                trialAsm = AsmStream(None, blastAsm.reg)
+                trialValues = pointerValues.copy()
+                valueIdx = 0
+                for regnum in layout:
+                    if regnum == regD or regnum == regA or regnum == regB:
+                        size = RegisterSizes[regnum]
+                        value = int.from_bytes(bytes(chunkValues[valueIdx:valueIdx+size]), "big")
+                        trialAsm.gen_loadimm_accum(regnum, value, "")
+                    else:
+                        size = 2
+                        value = (chunkValues[valueIdx] << 8) + chunkValues[valueIdx+1]
+                        if trialValues[regnum] != value:
+                            trialAsm.emit_op(f"ld{regName[regnum]}", f"#${value:04x}", "")
+                            trialValues[regnum] = value
+                    valueIdx += size
+                trialAsm.emit_op("pshu", ",".join([ regName[regnum] for regnum in layout ]), "")
+                if bestAsm == None or (trialAsm.metrics.cycles, trialAsm.metrics.bytes) < (bestAsm.metrics.cycles, bestAsm.metrics.bytes):
+                    (bestAsm, bestValues) = (trialAsm, trialValues)
+            blastAsm += bestAsm
+            pointerValues = bestValues
+            endIdx -= len(chunkValues)
+        blastAsm.gen_loadeffaddr_offset(regX, -(offX + rowOffset), regU, "")
+        if CPU == 6309:
+            blastAsm.emit_op("ldu", "#256", "")
+        return blastAsm
 
     # *************************************************************************************************
     # Sprite class: Draw function row generation for 6309
@@ -748,308 +1319,326 @@ class Sprite:
                 thisCmd = byteCmds[byteIdx]
                 byteOffCmdList.append((off0+byteIdx, dstOffset, thisCmd[0], thisCmd[1], thisCmd[2]))
                 dstOffset += 1
+        # all of the Store operations (which save the background) are done first, and then the Write operations,
+        # so that the immediate values loaded for writing may be re-used across the whole row.  Each phase is
+        # optimized over the whole row by dynamic programming, with the known register contents as the state
+        # the Store phase may finish in several different register states, with different bytes left to write
+        storeAsmByWriteList = { }
+        for (storeAsm, writeByteList) in self.Optimize6309Stores(regState, byteOffCmdList):
+            writeKey = tuple(sorted(writeByteList))
+            if writeKey not in storeAsmByWriteList:
+                storeAsmByWriteList[writeKey] = [ ]
+            storeAsmByWriteList[writeKey].append(storeAsm)
+        rowAsmList = [ ]
+        for (writeKey, storeAsmList) in storeAsmByWriteList.items():
+            rowAsmList += self.Optimize6309Writes(storeAsmList, list(writeKey), self.GetNextRowValues(y))
+        # the dynamic programming search only writes the bytes in order, and keeps a limited number of states, so
+        # it may miss the fastest code.  The exhaustive layout search finds it for rows which are narrow enough
+        searchAsm = self.Search6309RowLayouts(regState, byteOffCmdList)
+        if searchAsm != None:
+            rowAsmList.append(searchAsm)
+        return self.GetRowCandidates(y, rowAsmList)
+
+    def Optimize6309Stores(self, regState, byteOffCmdList):
+        # storeStates[i] is a dictionary of the best code for storing the first i bytes, for each register state.
+        # the values are (storeAsm, writeByteList), where writeByteList holds the Command-3 bytes to write later
+        numCmds = len(byteOffCmdList)
+        storeStates = [ { } for i in range(numCmds+1) ]
+        startAsm = AsmStream(None, regState)
+        storeStates[0][startAsm.reg.GetCacheKey()] = (startAsm, [ ])
+        for cmdIdx in range(numCmds):
+            for (storeAsm, writeByteList) in storeStates[cmdIdx].values():
+                for (storeSize, scratchReg) in self.Get6309StoreChoices(byteOffCmdList, cmdIdx):
+                    SearchNodes.visited += 1
+                    trialAsm = storeAsm.Copy()
+                    trialWriteList = copy.copy(writeByteList)
+                    self.Gen6309StoreCode(trialAsm, byteOffCmdList[cmdIdx:cmdIdx+storeSize], scratchReg, trialWriteList)
+                    nextStates = storeStates[cmdIdx+storeSize]
+                    stateKey = trialAsm.reg.GetCacheKey()
+                    if stateKey not in nextStates or self.StoreCostEstimate(trialAsm, trialWriteList) < self.StoreCostEstimate(*nextStates[stateKey]):
+                        nextStates[stateKey] = (trialAsm, trialWriteList)
+        return list(storeStates[numCmds].values())
+
+    def StoreCostEstimate(self, storeAsm, writeByteList):
+        # the Command-3 bytes which are not written during the Store phase will take at least one store
+        # instruction each in the Write phase
+        return (storeAsm.metrics.cycles + 4 * len(writeByteList), storeAsm.metrics.bytes + 2 * len(writeByteList))
+
+    def Get6309StoreChoices(self, byteOffCmdList, cmdIdx):
+        # return a list of the possible (storeSize, scratchReg) choices for storing bytes starting at cmdIdx
+        choices = [ ]
+        numLeft = len(byteOffCmdList) - cmdIdx
+        offX = byteOffCmdList[cmdIdx][0]
+        if numLeft >= 4 and byteOffCmdList[cmdIdx+3][0] == offX + 3 and byteOffCmdList[cmdIdx+1][0] == offX + 1 and byteOffCmdList[cmdIdx+2][0] == offX + 2:
+            # can't use Q if the last 2 bytes require AND/OR (command 2)
+            if byteOffCmdList[cmdIdx+2][2] != 2 and byteOffCmdList[cmdIdx+3][2] != 2:
+                choices.append((4, None))
+        if numLeft >= 2 and byteOffCmdList[cmdIdx+1][0] == offX + 1:
+            choices.append((2, None))
+        choices.append((1, regA))
+        choices.append((1, regB))
+        return choices
+
+    def Gen6309StoreCode(self, rowAsm, storeCmds, scratchReg, writeByteList):
+        # emit code to store 1, 2, or 4 consecutive bytes, and to write any Command-2 bytes among them.  Command-3
+        # bytes are added to the writeByteList, unless it is faster to write them now with the Command-2 bytes
+        offX = storeCmds[0][0]
+        offY = self.YPtrOffNew + storeCmds[0][1]
+        if self.eraseRedraw and 2 not in [ cmd[2] for cmd in storeCmds ]:
+            # nothing is saved, so these bytes don't need to be loaded
+            for cmd in storeCmds:
+                writeByteList.append((cmd[0], cmd[3]))
+            return
+        if len(storeCmds) == 1:
+            store1Cmd = storeCmds[0]
+            rowAsm.gen_loadstore_indexed(True, scratchReg, regX, offX, "")
+            if not self.eraseRedraw:
+                rowAsm.gen_loadstore_indexed(False, scratchReg, regY, offY, "")
+            # if this is Command-2 then update and write
+            if store1Cmd[2] == 2:
+                # we don't need to clear bits with AND mask if nybble we're writing is 15
+                if (store1Cmd[3] | store1Cmd[4]) != 0xff:
+                    rowAsm.emit_op(f"and{regName[scratchReg]}", (f"#${store1Cmd[4]:02x}"), "")
+                # we don't need to write nybble with OR if we're writing 0
+                if store1Cmd[3] != 0:
+                    rowAsm.emit_op(f"or{regName[scratchReg]}", (f"#${store1Cmd[3]:02x}"), "")
+                rowAsm.gen_loadstore_indexed(False, scratchReg, regX, offX, "")
+            elif store1Cmd[2] == 3:
+                writeByteList.append((offX, store1Cmd[3]))
+            return
+        byteCmds = [ (cmd[2], cmd[3], cmd[4]) for cmd in storeCmds ]
+        if len(storeCmds) == 4:
+            rowAsm.gen_loadstore_indexed(True, regQ, regX, offX, "")  # ldq off,x
+            if not self.eraseRedraw:
+                rowAsm.gen_loadstore_indexed(False, regQ, regY, offY, "")
+        else:
+            rowAsm.gen_loadstore_indexed(True, regD, regX, offX, "")  # ldd off,x
+            if not self.eraseRedraw:
+                rowAsm.gen_loadstore_indexed(False, regD, regY, offY, "")
+        # if these bytes contain no command-2 bytes, just add them to the WriteByteList
+        if byteCmds[0][0] != 2 and byteCmds[1][0] != 2:
+            for byteIdx in range(len(byteCmds)):
+                if byteCmds[byteIdx][0] == 3:
+                    writeByteList.append((offX+byteIdx, byteCmds[byteIdx][1]))
+            return
+        # generate AND/OR instructions to handle command-2 bytes in A and/or B registers
+        self.GenerateCommand2RegisterOps(byteCmds[0], byteCmds[1], rowAsm)
+        if len(storeCmds) == 4:
+            # if all 4 bytes are going to be written, then we should write them now (faster)
+            if byteCmds[0][0] > 1 and byteCmds[1][0] > 1 and byteCmds[2][0] == 3 and byteCmds[3][0] == 3:
+                if byteCmds[0][0] == 3:
+                    rowAsm.gen_loadimm_accum(regA, byteCmds[0][1], "")
+                elif byteCmds[1][0] == 3:
+                    rowAsm.gen_loadimm_accum(regB, byteCmds[1][1], "")
+                wordLoad = (byteCmds[2][1] << 8) + byteCmds[3][1]
+                rowAsm.gen_loadimm_accum(regW, wordLoad, "")
+                rowAsm.gen_loadstore_indexed(False, regQ, regX, offX, "") # stq off,x
+                return
+            # put lower 2 bytes into write list, we will deal with them later
+            for byteIdx in range(2,4):
+                if byteCmds[byteIdx][0] == 3:
+                    writeByteList.append((offX+byteIdx, byteCmds[byteIdx][1]))
+        # if only one of the 2 upper bytes needs to be written, the write it
+        if byteCmds[0][0] == 1: # only write B
+            rowAsm.gen_loadstore_indexed(False, regB, regX, offX+1, "")  # stb off,x
+        elif byteCmds[1][0] == 1: # only write A
+            rowAsm.gen_loadstore_indexed(False, regA, regX, offX, "")  # sta off,x
+        elif byteCmds[0][0] == 2 and byteCmds[1][0] == 2:
+            # if both upper bytes are command-2, write D
+            rowAsm.gen_loadstore_indexed(False, regD, regX, offX, "")  # std off,x
+        else:
+            # one byte is ready to write (command-2), but the other is command-3, so we will write them both now with reg D
+            if byteCmds[0][0] == 3:
+                rowAsm.gen_loadimm_accum(regA, byteCmds[0][1], "")
+            else:
+                rowAsm.gen_loadimm_accum(regB, byteCmds[1][1], "")
+            rowAsm.gen_loadstore_indexed(False, regD, regX, offX, "")  # std off,x
 
-        # in block of n commands, exhaustively search all permutations of store/write commands, and return best result
-        # we choose n = 12 as a compromise for compile time performance and runtime performance
-        layoutDict = { 1:[], 2:[], 4:[] }
-        results = [self.Permute6309StoreLayouts(regState, layoutDict, byteOffCmdList[ii:ii + self.chunkHint], 4)
-                      for ii in range(0, len(byteOffCmdList), self.chunkHint)]
-        return_value = results[0]
-        for ii in range(1, len(results)):
-            return_value += results[ii]
-        return return_value
+    def Optimize6309Writes(self, storeAsmList, writeByteList, nextRowValues):
+        # write the Command-3 bytes in order of their offsets, choosing the register used for each DWORD, WORD or
+        # BYTE write.  writeStates[i] is a dictionary of the best code for writing the first i bytes, for each
+        # register state, so values loaded into any of the accumulators may be re-used for later writes.  The
+        # search starts from all of the given Store phase code streams
+        numWrites = len(writeByteList)
+        # register values which can't help to load any of the remaining bytes are all equivalent.  At the end of
+        # the row, we keep the fastest code for each set of values to write in the next row
+        usefulValues = [ set() for i in range(numWrites+1) ]
+        for writeIdx in range(numWrites-1, -1, -1):
+            usefulValues[writeIdx] = usefulValues[writeIdx+1] | LoadableFromValue(writeByteList[writeIdx][1])
+        usefulValues[numWrites] = nextRowValues
+        writeStates = [ { } for i in range(numWrites+1) ]
+        for storeAsmIdx in range(len(storeAsmList)):
+            writeStates[0][storeAsmIdx] = storeAsmList[storeAsmIdx]
+        for writeIdx in range(numWrites):
+            # keep only the fastest states, so that the search time is linear in the number of bytes
+            self.CheckDeadline()
+            rowAsmList = list(writeStates[writeIdx].values())
+            if len(rowAsmList) > self.searchLevel[1]:
+                rowAsmList.sort(key=lambda rowAsm: (rowAsm.metrics.cycles, rowAsm.metrics.bytes))
+                rowAsmList = rowAsmList[:self.searchLevel[1]]
+            for rowAsm in rowAsmList:
+                for (writeSize, regnum) in self.Get6309WriteChoices(writeByteList, writeIdx):
+                    SearchNodes.visited += 1
+                    writeValue = 0
+                    for (offX, value) in writeByteList[writeIdx:writeIdx+writeSize]:
+                        writeValue = (writeValue << 8) + value
+                    # generate the code for this write separately, and only copy the code before it if this is
+                    # the best way found so far to reach the new register state
+                    writeAsm = AsmStream(None, rowAsm.reg)
+                    writeAsm.gen_loadimm_accum(regnum, writeValue, "")
+                    writeAsm.gen_loadstore_indexed(False, regnum, regX, writeByteList[writeIdx][0], "")
+                    nextStates = writeStates[writeIdx+writeSize]
+                    stateKey = [ ]
+                    for keyReg in (regA, regB, regE, regF):
+                        if writeAsm.reg.IsValid(keyReg) and writeAsm.reg.GetValue(keyReg) in usefulValues[writeIdx+writeSize]:
+                            stateKey.append(writeAsm.reg.GetValue(keyReg))
+                        else:
+                            stateKey.append(None)
+                    stateKey = tuple(stateKey)
+                    trialCost = (rowAsm.metrics.cycles + writeAsm.metrics.cycles, rowAsm.metrics.bytes + writeAsm.metrics.bytes)
+                    if stateKey not in nextStates or trialCost < (nextStates[stateKey].metrics.cycles, nextStates[stateKey].metrics.bytes):
+                        nextStates[stateKey] = rowAsm.Copy() + writeAsm
+        # return the fastest code for each set of register values which may be useful to the next row
+        return list(writeStates[numWrites].values())
+
+    def Get6309WriteChoices(self, writeByteList, writeIdx):
+        # return a list of the possible (writeSize, register) choices for writing bytes starting at writeIdx
+        choices = [ ]
+        numLeft = len(writeByteList) - writeIdx
+        offX = writeByteList[writeIdx][0]
+        if numLeft >= 4 and writeByteList[writeIdx+1][0] == offX + 1 and writeByteList[writeIdx+2][0] == offX + 2 and writeByteList[writeIdx+3][0] == offX + 3:
+            choices.append((4, regQ))
+        if numLeft >= 2 and writeByteList[writeIdx+1][0] == offX + 1:
+            choices.append((2, regD))
+            choices.append((2, regW))
+        for regnum in (regA, regB, regE, regF):
+            choices.append((1, regnum))
+        return choices
+
+    def Search6309RowLayouts(self, regState, byteOffCmdList):
+        # search all of the store and write layouts for the row, or for each chunk of ChunkHint bytes in turn.  This
+        # finds the fastest code for narrow rows, but the number of layouts grows very quickly with the row width, so
+        # this returns None if the search would visit more nodes than the current search level allows
+        if self.searchLevel[3] == 0:
+            return None
+        self.exhaustiveNodesLeft = self.searchLevel[3]
+        if self.chunkHint < sys.maxsize:
+            # the row is split as requested, so the search always finishes
+            self.exhaustiveNodesLeft = None
+        rowAsm = AsmStream(None, regState)
+        try:
+            for chunkIdx in range(0, len(byteOffCmdList), self.chunkHint):
+                layoutDict = { 1:[], 2:[], 4:[] }
+                rowAsm += self.Permute6309StoreLayouts(rowAsm.reg, layoutDict, byteOffCmdList[chunkIdx:chunkIdx+self.chunkHint], 4)
+        except SearchNodeLimit:
+            return None
+        return rowAsm
+
+    def VisitExhaustiveNodes(self, numNodes):
+        SearchNodes.visited += numNodes
+        if self.exhaustiveNodesLeft != None:
+            self.exhaustiveNodesLeft -= numNodes
+            if self.exhaustiveNodesLeft < 0:
+                raise SearchNodeLimit()
 
     def Permute6309StoreLayouts(self, regState, layoutDict, byteOffCmdList, searchSize):
+        self.VisitExhaustiveNodes(1)
         cmdListLen = len(byteOffCmdList)
         if cmdListLen == 0:
             # this is a leaf node, so we need to emit the code for handling the Store operations
-            startAsm = AsmStream(None, regState)
-            writeByteList = [ ]
-            layoutCopy = { 1:copy.copy(layoutDict[1]), 2:copy.copy(layoutDict[2]), 4:copy.copy(layoutDict[4]) }
-            return self.Permute6309StoreCodeGen(startAsm, layoutCopy, writeByteList, 4, None)
+            self.CheckDeadline()
+            return self.Permute6309StoreCodeGen(AsmStream(None, regState), layoutDict)
         if searchSize == 4:
             # search for DWORDs that we can store
-            bFoundCandidates = False
+            bestAsm = None
             for cmdIdx in range(cmdListLen-3):
                 # are these bytes consecutive?
-                if byteOffCmdList[cmdIdx+1][0] != byteOffCmdList[cmdIdx][0] + 1:
-                    continue
-                if byteOffCmdList[cmdIdx+2][0] != byteOffCmdList[cmdIdx][0] + 2:
-                    continue
-                if byteOffCmdList[cmdIdx+3][0] != byteOffCmdList[cmdIdx][0] + 3:
+                offX = byteOffCmdList[cmdIdx][0]
+                if byteOffCmdList[cmdIdx+1][0] != offX + 1 or byteOffCmdList[cmdIdx+2][0] != offX + 2 or byteOffCmdList[cmdIdx+3][0] != offX + 3:
                     continue
                 # can't use Q if the last 2 bytes require AND/OR (command 2)
                 if byteOffCmdList[cmdIdx+2][2] == 2 or byteOffCmdList[cmdIdx+3][2] == 2:
                     continue
                 # otherwise, this position is a candidate for Store operation with 32-bit Q accumulator
-                DWordCmdList = []
-                for i in range(4):
-                    DWordCmdList.append((byteOffCmdList[cmdIdx+i][2], byteOffCmdList[cmdIdx+i][3], byteOffCmdList[cmdIdx+i][4]))
-                layoutDict[4].append((byteOffCmdList[cmdIdx][0], byteOffCmdList[cmdIdx][1], DWordCmdList))
-                newByteOffCmdList = byteOffCmdList[:cmdIdx] + byteOffCmdList[cmdIdx+4:]
-                # recurse down into this case
-                trialAsm = self.Permute6309StoreLayouts(regState, layoutDict, newByteOffCmdList, 4)
-                # revert our layoutDict changes
+                layoutDict[4].append(byteOffCmdList[cmdIdx:cmdIdx+4])
+                trialAsm = self.Permute6309StoreLayouts(regState, layoutDict, byteOffCmdList[:cmdIdx] + byteOffCmdList[cmdIdx+4:], 4)
                 del layoutDict[4][-1]
-                # update our bestAsm
-                if not bFoundCandidates:
-                    bFoundCandidates = True
-                    bestAsm = trialAsm
-                else:
-                    bestAsm = self.BestResult(bestAsm, trialAsm)
-                continue
+                bestAsm = trialAsm if bestAsm == None else self.BestResult(bestAsm, trialAsm)
             # if we found any DWORD candidates during this function search, then just return the best result
-            if bFoundCandidates:
+            if bestAsm != None:
                 return bestAsm
             # otherwise our search continues with WORDs
             searchSize = 2
         if searchSize == 2:
             # search for WORDs that we can store
-            bFoundCandidates = False
+            bestAsm = None
             for cmdIdx in range(cmdListLen-1):
                 # are these bytes consecutive?
                 if byteOffCmdList[cmdIdx+1][0] != byteOffCmdList[cmdIdx][0] + 1:
                     continue
                 # otherwise, this position is a candidate for Store operation with 16-bit D accumulator
-                WordCmdList = []
-                for i in range(2):
-                    WordCmdList.append((byteOffCmdList[cmdIdx+i][2], byteOffCmdList[cmdIdx+i][3], byteOffCmdList[cmdIdx+i][4]))
-                layoutDict[2].append((byteOffCmdList[cmdIdx][0], byteOffCmdList[cmdIdx][1], WordCmdList))
-                newByteOffCmdList = byteOffCmdList[:cmdIdx] + byteOffCmdList[cmdIdx+2:]
-                # recurse down into this case
-                trialAsm = self.Permute6309StoreLayouts(regState, layoutDict, newByteOffCmdList, 2)
-                # revert our layoutDict changes
+                layoutDict[2].append(byteOffCmdList[cmdIdx:cmdIdx+2])
+                trialAsm = self.Permute6309StoreLayouts(regState, layoutDict, byteOffCmdList[:cmdIdx] + byteOffCmdList[cmdIdx+2:], 2)
                 del layoutDict[2][-1]
-                # update our bestAsm
-                if not bFoundCandidates:
-                    bFoundCandidates = True
-                    bestAsm = trialAsm
-                else:
-                    bestAsm = self.BestResult(bestAsm, trialAsm)
-                continue
+                bestAsm = trialAsm if bestAsm == None else self.BestResult(bestAsm, trialAsm)
             # if we found any WORD candidates during this function search, then just return the best result
-            if bFoundCandidates:
+            if bestAsm != None:
                 return bestAsm
             # otherwise our search continues with BYTEs
             searchSize = 1
-        # search size must be 1
-        if searchSize != 1:
-            raise Exception("Error: searchSize != 1 at end of Permute6309StoreLayouts!")
         # recurse over all possible orderings of BYTEs to store
-        bFoundCandidates = False
+        bestAsm = None
         for cmdIdx in range(cmdListLen):
             layoutDict[1].append(byteOffCmdList[cmdIdx])
-            newByteOffCmdList = byteOffCmdList[:cmdIdx] + byteOffCmdList[cmdIdx+1:]
-            # recurse down into this case
-            trialAsm = self.Permute6309StoreLayouts(regState, layoutDict, newByteOffCmdList, 1)
-            # revert our layoutDict changes
+            trialAsm = self.Permute6309StoreLayouts(regState, layoutDict, byteOffCmdList[:cmdIdx] + byteOffCmdList[cmdIdx+1:], 1)
             del layoutDict[1][-1]
-            # update our bestAsm
-            if not bFoundCandidates:
-                bFoundCandidates = True
-                bestAsm = trialAsm
-            else:
-                bestAsm = self.BestResult(bestAsm, trialAsm)
-            continue
-        # return the best result
+            bestAsm = trialAsm if bestAsm == None else self.BestResult(bestAsm, trialAsm)
         return bestAsm
 
-    def Permute6309StoreCodeGen(self, bestRowAsm, layoutDict, writeByteList, storeSize, scratchReg):
-        if storeSize == 1 and len(layoutDict[1]) == 0:
-            # this is a leaf node, so we need to permute across all possible variations of Write operations
-            # start by make a copy of our list of bytes to write, and then sorting it
-            writeByteListCopy = copy.copy(writeByteList)
-            writeByteListCopy.sort()
-            # it will be sorted primarily by the first element in the tuple, which is offX
-            # now call a function to permute all possible write commands
-            layoutDict = { 1:[], 2:[], 4:[] }
-            return self.Permute6309WriteLayouts(bestRowAsm, layoutDict, writeByteListCopy, 4)
-        if storeSize == 4:
-            # if there are no 4-byte stores left, then recurse to handle 2-byte stores
-            if len(layoutDict[4]) == 0:
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 2, None)
-            # store the first DWORD in the list
-            store4Cmds = layoutDict[4].pop(0)
-            offX = store4Cmds[0]
-            offY = self.YPtrOffNew + store4Cmds[1]
-            bestRowAsm.gen_loadstore_indexed(True, regQ, regX, offX, "")  # ldq off,x
-            bestRowAsm.gen_loadstore_indexed(False, regQ, regY, offY, "")
-            # if this 4-byte store contains command-2 bytes in the lower 2 positions, then crash
-            if store4Cmds[2][2][0] == 2 or store4Cmds[2][3][0] == 2:
-                raise Exception("Error: word in 32-bit store command contains Command-2 bytes in low WORD!")
-            # if this 4-byte store contains no command-2 bytes, just add to the WriteByteList and continue with next DWORD
-            if store4Cmds[2][0][0] != 2 and store4Cmds[2][1][0] != 2:
-                for byteIdx in range(4):
-                    cmd = store4Cmds[2][byteIdx]
-                    if cmd[0] == 3:
-                        writeByteList.append((offX+byteIdx, cmd[1]))
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 4, None)
-            # generate AND/OR instructions to handle command-2 bytes in A and/or B registers
-            self.GenerateCommand2RegisterOps(store4Cmds[2][0], store4Cmds[2][1], bestRowAsm)
-            # if all 4 bytes are going to be written, then we should write them now (faster)
-            if store4Cmds[2][0][0] > 1 and store4Cmds[2][1][0] > 1 and store4Cmds[2][2][0] == 3 and store4Cmds[2][3][0] == 3:
-                if store4Cmds[2][0][0] == 3:
-                    bestRowAsm.gen_loadimm_accum(regA, store4Cmds[2][0][1], "")
-                elif store4Cmds[2][1][0] == 3:
-                    bestRowAsm.gen_loadimm_accum(regB, store4Cmds[2][1][1], "")
-                wordLoad = (store4Cmds[2][2][1] << 8) + store4Cmds[2][3][1]
-                bestRowAsm.gen_loadimm_accum(regW, wordLoad, "")
-                bestRowAsm.gen_loadstore_indexed(False, regQ, regX, offX, "") # stq off,x
-                # fixme optimize: permute all possible byte/word stores with valid accumulators now
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 4, None)
-            # put lower 2 bytes into write list, we will deal with them later
-            for byteIdx in range(2,4):
-                cmd = store4Cmds[2][byteIdx]
-                if cmd[0] == 3:
-                    writeByteList.append((offX+byteIdx, cmd[1]))
-            # if only one of the 2 upper bytes needs to be written, the write it and continue
-            if store4Cmds[2][0][0] == 1: # only write B
-                bestRowAsm.gen_loadstore_indexed(False, regB, regX, offX+1, "")  # stb off,x
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 4, None)
-            if store4Cmds[2][1][0] == 1: # only write A
-                bestRowAsm.gen_loadstore_indexed(False, regA, regX, offX, "")  # sta off,x
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 4, None)
-            # if both upper bytes are command-2, write D and continue
-            if store4Cmds[2][0][0] == 2 and store4Cmds[2][1][0] == 2:
-                bestRowAsm.gen_loadstore_indexed(False, regD, regX, offX, "")  # std off,x
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 4, None)
-            # now we're in a situation where one byte is ready to write (command-2), but the other is command-3
-            # we will write them both now with reg D
-            if store4Cmds[2][0][0] == 3:
-                bestRowAsm.gen_loadimm_accum(regA, store4Cmds[2][0][1], "")
-            else:
-                bestRowAsm.gen_loadimm_accum(regB, store4Cmds[2][1][1], "")
-            bestRowAsm.gen_loadstore_indexed(False, regD, regX, offX, "")  # std off,x
-            return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 4, None)
-        if storeSize == 2:
-            # if there are no 2-byte stores left, then recurse to handle 1-byte stores
-            if len(layoutDict[2]) == 0:
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 1, None)
-            # store the first WORD in the list
-            store2Cmds = layoutDict[2].pop(0)
-            offX = store2Cmds[0]
-            offY = self.YPtrOffNew + store2Cmds[1]
-            bestRowAsm.gen_loadstore_indexed(True, regD, regX, offX, "")  # ldd off,x
-            bestRowAsm.gen_loadstore_indexed(False, regD, regY, offY, "")
-            # if this 2-byte store contains no command-2 bytes, just add to the WriteByteList and continue with next DWORD
-            if store2Cmds[2][0][0] != 2 and store2Cmds[2][1][0] != 2:
-                for byteIdx in range(2):
-                    cmd = store2Cmds[2][byteIdx]
-                    if cmd[0] == 3:
-                        writeByteList.append((offX+byteIdx, cmd[1]))
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 2, None)
-            # generate AND/OR instructions to handle command-2 bytes in A and/or B registers
-            self.GenerateCommand2RegisterOps(store2Cmds[2][0], store2Cmds[2][1], bestRowAsm)
-            # if only one of the 2 upper bytes needs to be written, the write it and continue
-            if store2Cmds[2][0][0] == 1: # only write B
-                bestRowAsm.gen_loadstore_indexed(False, regB, regX, offX+1, "")  # stb off,x
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 2, None)
-            if store2Cmds[2][1][0] == 1: # only write A
-                bestRowAsm.gen_loadstore_indexed(False, regA, regX, offX, "")  # sta off,x
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 2, None)
-            # if both upper bytes are command-2, write D and continue
-            if store2Cmds[2][0][0] == 2 and store2Cmds[2][1][0] == 2:
-                bestRowAsm.gen_loadstore_indexed(False, regD, regX, offX, "")  # std off,x
-                return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 2, None)
-            # now we're in a situation where one byte is ready to write (command-2), but the other is command-3
-            # we will write them both now with reg D
-            if store2Cmds[2][0][0] == 3:
-                bestRowAsm.gen_loadimm_accum(regA, store2Cmds[2][0][1], "")
-            else:
-                bestRowAsm.gen_loadimm_accum(regB, store2Cmds[2][1][1], "")
-            bestRowAsm.gen_loadstore_indexed(False, regD, regX, offX, "")  # std off,x
-            # fixme optimize: permute all possible byte/word stores with valid accumulators now
-            return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 2, None)
-        # store size must be 1
-        if storeSize != 1:
-            raise Exception("Error: storeSize != 1 at end of Permute6309StoreCodeGen!")
-        # figure out whiche register to use as scratch for the byte stores
-        if scratchReg == None:
-            if not bestRowAsm.reg.IsValid(regA):
-                scratchReg = regA
-            elif not bestRowAsm.reg.IsValid(regB):
-                scratchReg = regB
-            else:
-                # both A and B are valid, so permute over 2 possible cases and return best
-                trial1Asm = copy.deepcopy(bestRowAsm)
-                layoutCopy = { 1:copy.copy(layoutDict[1]), 2:copy.copy(layoutDict[2]), 4:copy.copy(layoutDict[4]) }
-                trial1Asm = self.Permute6309StoreCodeGen(trial1Asm, layoutCopy, copy.copy(writeByteList), 1, regA)
-                # then try out the second case
-                trial2Asm = bestRowAsm
-                trial2Asm = self.Permute6309StoreCodeGen(trial2Asm, layoutDict, writeByteList, 1, regB)
-                # now choose the best option
-                return self.BestResult(trial1Asm, trial2Asm)
-        # store each BYTE in the list
-        while len(layoutDict[1]) > 0:
-            store1Cmd = layoutDict[1].pop(0)
-            offX = store1Cmd[0]
-            offY = self.YPtrOffNew + store1Cmd[1]
-            bestRowAsm.gen_loadstore_indexed(True, scratchReg, regX, offX, "")
-            bestRowAsm.gen_loadstore_indexed(False, scratchReg, regY, offY, "")
-            # if this is Command-1 then we're done
-            if store1Cmd[2] == 1:
-                continue
-            # if this is Command-2 then update and write
-            if store1Cmd[2] == 2:
-                # we don't need to clear bits with AND mask if nybble we're writing is 15
-                if (store1Cmd[3] | store1Cmd[4]) != 0xff:
-                    bestRowAsm.emit_op(f"and{regName[scratchReg]}", (f"#${store1Cmd[4]:02x}"), "", 2, 2, 2)
-                # we don't need to write nybble with OR if we're writing 0
-                if store1Cmd[3] != 0:
-                    bestRowAsm.emit_op(f"or{regName[scratchReg]}", (f"#${store1Cmd[3]:02x}"), "", 2, 2, 2)
-                bestRowAsm.gen_loadstore_indexed(False, scratchReg, regX, offX, "")
-                continue
-            # if this is Command-3, add it to the byte write list and continue
-            if store1Cmd[2] != 3:
-                raise Exception("Error: command number for byte store != 3 at end of Permute6309StoreCodeGen!")
-            writeByteList.append((offX, store1Cmd[3]))
-        # now the store operations are all completed, so we will recurse into ourself to start the writes
-        return self.Permute6309StoreCodeGen(bestRowAsm, layoutDict, writeByteList, 1, scratchReg)
-
-    def BestResult(self, trial1Asm, trial2Asm):
-        if trial1Asm.metrics.cycles < trial2Asm.metrics.cycles or (trial1Asm.metrics.cycles == trial2Asm.metrics.cycles and trial1Asm.metrics.bytes <= trial2Asm.metrics.bytes):
-            return trial1Asm
+    def Permute6309StoreCodeGen(self, storeAsm, layoutDict):
+        # emit the code for the DWORD and WORD stores in the layout, then the BYTE stores, and then search for the best
+        # code to write the remaining Command-3 bytes
+        writeByteList = [ ]
+        for storeCmds in layoutDict[4] + layoutDict[2]:
+            self.Gen6309StoreCode(storeAsm, storeCmds, None, writeByteList)
+        if len(layoutDict[1]) == 0:
+            return storeAsm + self.Search6309Writes(storeAsm.reg, writeByteList)
+        # use a free accumulator for the BYTE stores, or try both of them if A and B both hold known values
+        if not storeAsm.reg.IsValid(regA):
+            scratchList = [ regA ]
+        elif not storeAsm.reg.IsValid(regB):
+            scratchList = [ regB ]
         else:
-            return trial2Asm
+            scratchList = [ regA, regB ]
+        bestAsm = None
+        for scratchReg in scratchList:
+            trialAsm = storeAsm.Copy()
+            trialWriteList = copy.copy(writeByteList)
+            for storeCmd in layoutDict[1]:
+                self.Gen6309StoreCode(trialAsm, [ storeCmd ], scratchReg, trialWriteList)
+            trialAsm += self.Search6309Writes(trialAsm.reg, trialWriteList)
+            bestAsm = trialAsm if bestAsm == None else self.BestResult(bestAsm, trialAsm)
+        return bestAsm
 
-    def GenerateCommand2RegisterOps(self, byteCmd1, byteCmd2, rowAsm):
-        if byteCmd1[0] == 2 and byteCmd2[0] == 2:
-            byteSplit = False
-            # we don't need to clear bits with AND mask if nybble we're writing is 15
-            if (byteCmd1[1] | byteCmd1[2]) != 0xff:
-                rowAsm.emit_op("anda", (f"#${byteCmd1[2]:02x}"), "", 2, 2, 2)
-            else:
-                byteSplit = True
-            if (byteCmd2[1] | byteCmd2[2]) != 0xff:
-                rowAsm.emit_op("andb", (f"#${byteCmd2[2]:02x}"), "", 2, 2, 2)
-            else:
-                byteSplit = True
-            if byteSplit:
-                # we don't need to write nybble with OR if we're writing 0
-                if byteCmd1[1] != 0:
-                    rowAsm.emit_op("ora", (f"#${byteCmd1[1]:02x}"), "", 2, 2, 2)
-                if byteCmd2[1] != 0:
-                    rowAsm.emit_op("orb", (f"#${byteCmd2[1]:02x}"), "", 2, 2, 2)
-            else:
-                wordAdd = (byteCmd1[1] << 8) + byteCmd2[1]
-                if wordAdd != 0:
-                    rowAsm.emit_op("addd", f"#${wordAdd:04x}", "", 4, 3, 3)
-        elif byteCmd1[0] == 2:
-            # we don't need to clear bits with AND mask if nybble we're writing is 15
-            if (byteCmd1[1] | byteCmd1[2]) != 0xff:
-                rowAsm.emit_op("anda", (f"#${byteCmd1[2]:02x}"), "", 2, 2, 2)
-            # we don't need to write nybble with OR if we're writing 0
-            if byteCmd1[1] != 0:
-                rowAsm.emit_op("ora", (f"#${byteCmd1[1]:02x}"), "", 2, 2, 2)
-        elif byteCmd2[0] == 2:
-            # we don't need to clear bits with AND mask if nybble we're writing is 15
-            if (byteCmd2[1] | byteCmd2[2]) != 0xff:
-                rowAsm.emit_op("andb", (f"#${byteCmd2[2]:02x}"), "", 2, 2, 2)
-            # we don't need to write nybble with OR if we're writing 0
-            if byteCmd2[1] != 0:
-                rowAsm.emit_op("orb", (f"#${byteCmd2[1]:02x}"), "", 2, 2, 2)
+    def Search6309Writes(self, regState, writeByteList):
+        # the write code depends only upon the register state and the bytes to write, so many store layouts lead to
+        # the same write search.  The number of nodes is cached too, so that the search limit doesn't depend upon
+        # which rows were compiled before this one
+        writeByteList = sorted(writeByteList)
+        writeKey = (CPU, regState.GetCacheKey(), tuple(writeByteList))
+        cachedWrite = WriteCache.Lookup(writeKey)
+        if cachedWrite == None:
+            visitedStart = SearchNodes.visited
+            writeAsm = self.Permute6309WriteLayouts(AsmStream(None, regState), { 1:[], 2:[], 4:[] }, writeByteList, 4, None)
+            cachedWrite = (writeAsm, SearchNodes.visited - visitedStart)
+            WriteCache.Store(writeKey, cachedWrite)
+        else:
+            self.VisitExhaustiveNodes(cachedWrite[1])
+        return cachedWrite[0]
 
-    def Permute6309WriteLayouts(self, startAsm, layoutDict, writeByteList, writeSize):
+    def Permute6309WriteLayouts(self, startAsm, layoutDict, writeByteList, writeSize, bestAsm):
+        # bestAsm is the best write code found so far, or None at the start of the search
+        self.VisitExhaustiveNodes(1)
         writeListLen = len(writeByteList)
         if writeListLen == 0:
             layoutDict = { 1:copy.copy(layoutDict[1]), 2:copy.copy(layoutDict[2]), 4:copy.copy(layoutDict[4]) }
@@ -1059,17 +1648,17 @@ class Sprite:
                 startAsm.gen_loadstore_indexed(False, regQ, regX, write4Bytes[0], "") # stq off,x
                 # handle WORD write operations with D, W registers and BYTE write operations with A,B registers
                 for write2Bytes in layoutDict[2][:]:
-                    if write2Bytes[1] == startAsm.reg.GetValue(regD):
+                    if startAsm.reg.IsValid(regD) and write2Bytes[1] == startAsm.reg.GetValue(regD):
                         layoutDict[2].remove(write2Bytes)
                         startAsm.gen_loadstore_indexed(False, regD, regX, write2Bytes[0], "") # std off,x
-                    elif write2Bytes[1] == startAsm.reg.GetValue(regW):
+                    elif startAsm.reg.IsValid(regW) and write2Bytes[1] == startAsm.reg.GetValue(regW):
                         layoutDict[2].remove(write2Bytes)
                         startAsm.gen_loadstore_indexed(False, regW, regX, write2Bytes[0], "") # stw off,x
                 for write1Bytes in layoutDict[1][:]:
-                    if write1Bytes[1] == startAsm.reg.GetValue(regA):
+                    if startAsm.reg.IsValid(regA) and write1Bytes[1] == startAsm.reg.GetValue(regA):
                         layoutDict[1].remove(write1Bytes)
                         startAsm.gen_loadstore_indexed(False, regA, regX, write1Bytes[0], "") # sta off,x
-                    elif write1Bytes[1] == startAsm.reg.GetValue(regB):
+                    elif startAsm.reg.IsValid(regB) and write1Bytes[1] == startAsm.reg.GetValue(regB):
                         layoutDict[1].remove(write1Bytes)
                         startAsm.gen_loadstore_indexed(False, regB, regX, write1Bytes[0], "") # stb off,x
             for write2Bytes in layoutDict[2]:
@@ -1077,42 +1666,37 @@ class Sprite:
                 startAsm.gen_loadstore_indexed(False, regD, regX, write2Bytes[0], "") # std off,x
                 # handle BYTE write operations with A/B registers
                 for write1Bytes in layoutDict[1][:]:
-                    if write1Bytes[1] == startAsm.reg.GetValue(regA):
+                    if startAsm.reg.IsValid(regA) and write1Bytes[1] == startAsm.reg.GetValue(regA):
                         layoutDict[1].remove(write1Bytes)
                         startAsm.gen_loadstore_indexed(False, regA, regX, write1Bytes[0], "") # sta off,x
-                    elif write1Bytes[1] == startAsm.reg.GetValue(regB):
+                    elif startAsm.reg.IsValid(regB) and write1Bytes[1] == startAsm.reg.GetValue(regB):
                         layoutDict[1].remove(write1Bytes)
                         startAsm.gen_loadstore_indexed(False, regB, regX, write1Bytes[0], "") # stb off,x
             for write1Bytes in layoutDict[1]:
                 startAsm.gen_loadimm_accum(regA, write1Bytes[1], "")
                 startAsm.gen_loadstore_indexed(False, regA, regX, write1Bytes[0], "") # sta off,x
-            return startAsm
+            if bestAsm == None:
+                return startAsm
+            return self.BestResult(bestAsm, startAsm)
         if writeSize == 4:
             # search for DWORDs that we can write
             bFoundCandidates = False
             for writeIdx in range(writeListLen-3):
                 # are these bytes consecutive?
-                if writeByteList[writeIdx+1][0] != writeByteList[writeIdx][0] + 1:
-                    continue
-                if writeByteList[writeIdx+2][0] != writeByteList[writeIdx][0] + 2:
-                    continue
-                if writeByteList[writeIdx+3][0] != writeByteList[writeIdx][0] + 3:
+                offX = writeByteList[writeIdx][0]
+                if writeByteList[writeIdx+1][0] != offX + 1 or writeByteList[writeIdx+2][0] != offX + 2 or writeByteList[writeIdx+3][0] != offX + 3:
                     continue
                 # this position is a candidate for Write operation with 32-bit Q accumulator
                 DWordValue = (writeByteList[writeIdx][1] << 24) + (writeByteList[writeIdx+1][1] << 16) + (writeByteList[writeIdx+2][1] << 8) + writeByteList[writeIdx+3][1]
-                layoutDict[4].append((writeByteList[writeIdx][0], DWordValue))
+                layoutDict[4].append((offX, DWordValue))
                 newWriteByteList = writeByteList[:writeIdx] + writeByteList[writeIdx+4:]
-                # recurse down into this case
-                trialAsm = self.Permute6309WriteLayouts(copy.deepcopy(startAsm), layoutDict, newWriteByteList, 4)
-                # revert our layoutDict changes
-                del layoutDict[4][-1]
-                # update our bestAsm case
-                if not bFoundCandidates:
-                    bestAsm = trialAsm  # since this is our first candidate, it is currently the best
-                    bFoundCandidates = True
+                bFoundCandidates = True
+                # recurse down into this case, unless it can't be faster than the best code already found
+                if bestAsm == None or self.WriteLayoutLowerBound(startAsm, layoutDict, newWriteByteList, 4) <= bestAsm.metrics.cycles:
+                    bestAsm = self.Permute6309WriteLayouts(startAsm.Copy(), layoutDict, newWriteByteList, 4, bestAsm)
                 else:
-                    bestAsm = self.BestResult(bestAsm, trialAsm)
-                continue
+                    SearchNodes.pruned += 1
+                del layoutDict[4][-1]
             # if we found any DWORD candidates during this function search, then just return the best result
             if bFoundCandidates:
                 return bestAsm
@@ -1129,86 +1713,282 @@ class Sprite:
                 WordValue = (writeByteList[writeIdx][1] << 8) + writeByteList[writeIdx+1][1]
                 layoutDict[2].append((writeByteList[writeIdx][0], WordValue))
                 newWriteByteList = writeByteList[:writeIdx] + writeByteList[writeIdx+2:]
-                # recurse down into this case
-                trialAsm = self.Permute6309WriteLayouts(copy.deepcopy(startAsm), layoutDict, newWriteByteList, 2)
-                # revert our layoutDict changes
-                del layoutDict[2][-1]
-                # update our bestAsm case
-                if not bFoundCandidates:
-                    bestAsm = trialAsm  # since this is our first candidate, it is currently the best
-                    bFoundCandidates = True
+                bFoundCandidates = True
+                # recurse down into this case, unless it can't be faster than the best code already found
+                if bestAsm == None or self.WriteLayoutLowerBound(startAsm, layoutDict, newWriteByteList, 2) <= bestAsm.metrics.cycles:
+                    bestAsm = self.Permute6309WriteLayouts(startAsm.Copy(), layoutDict, newWriteByteList, 2, bestAsm)
                 else:
-                    bestAsm = self.BestResult(bestAsm, trialAsm)
-                continue
+                    SearchNodes.pruned += 1
+                del layoutDict[2][-1]
             # if we found any WORD candidates during this function search, then just return the best result
             if bFoundCandidates:
                 return bestAsm
             # otherwise our search continues with BYTEs
             writeSize = 1
-        # write size must be 1
-        if writeSize != 1:
-            raise Exception("Error: writeSize != 1 at end of Permute6309WriteLayouts!")
-        # if there are no bytes to write, recurse into ourselves to emit the Write operation code
-        if len(writeByteList) == 0:
-            return self.Permute6309WriteLayouts(startAsm, layoutDict, writeByteList, 1)
         # try out all possible permutations of byte writes
-        bFoundCandidates = False
         for writeIdx in range(writeListLen):
-            writeByteCmd = writeByteList[writeIdx]
-            layoutDict[1].append(writeByteCmd)
+            layoutDict[1].append(writeByteList[writeIdx])
             newWriteByteList = writeByteList[:writeIdx] + writeByteList[writeIdx+1:]
-            # recurse down into this case
-            trialAsm = self.Permute6309WriteLayouts(copy.deepcopy(startAsm), layoutDict, newWriteByteList, 1)
-            # revert our layoutDict changes
-            del layoutDict[1][-1]
-            # update our bestAsm case
-            if not bFoundCandidates:
-                bestAsm = trialAsm  # since this is our first candidate, it is currently the best
-                bFoundCandidates = True
+            # recurse down into this case, unless it can't be faster than the best code already found
+            if bestAsm == None or self.WriteLayoutLowerBound(startAsm, layoutDict, newWriteByteList, 1) <= bestAsm.metrics.cycles:
+                bestAsm = self.Permute6309WriteLayouts(startAsm.Copy(), layoutDict, newWriteByteList, 1, bestAsm)
             else:
-                bestAsm = self.BestResult(bestAsm, trialAsm)
-            continue
+                SearchNodes.pruned += 1
+            del layoutDict[1][-1]
         # we are completely done; return the best result
         return bestAsm
 
+    def WriteLayoutLowerBound(self, startAsm, layoutDict, writeByteList, writeSize):
+        # lower bound on the cycles of the code which Permute6309WriteLayouts will generate for any complete layout
+        # starting with the given one.  Every byte is written by exactly one store instruction, and every change
+        # in the value of Q needs at least one load instruction
+        byteStoreCycles = min(InstructionCost("sta", "idx")[0], InstructionCost("stb", "idx")[0])
+        wordStoreCycles = min(InstructionCost("std", "idx")[0], InstructionCost("stw", "idx")[0])
+        dwordStoreCycles = InstructionCost("stq", "idx")[0]
+        cycles = startAsm.metrics.cycles
+        loadCycles = 0
+        lastQValue = None
+        if startAsm.reg.IsValid(regQ):
+            lastQValue = startAsm.reg.GetValue(regQ)
+        for (offX, value) in layoutDict[4]:
+            if value != lastQValue:
+                loadCycles += 1
+            lastQValue = value
+            cycles += dwordStoreCycles + IndexedOffsetCycles(offX)
+        for (offX, value) in layoutDict[2]:
+            cycles += wordStoreCycles + IndexedOffsetCycles(offX)
+        for (offX, value) in layoutDict[1]:
+            cycles += byteStoreCycles + IndexedOffsetCycles(offX)
+        # the remaining bytes can only be written with stores of writeSize bytes or less
+        if writeSize == 1:
+            for (offX, value) in writeByteList:
+                cycles += byteStoreCycles + IndexedOffsetCycles(offX)
+            # byte values which match A or B after a DWORD or WORD write may be written early.  The rest are written in
+            # order with A, and each change in the value needs at least one load instruction
+            earlyValues = set()
+            for (offX, value) in layoutDict[4]:
+                earlyValues.add(value >> 24)
+                earlyValues.add((value >> 16) & 0xff)
+            for (offX, value) in layoutDict[2]:
+                earlyValues.add(value >> 8)
+                earlyValues.add(value & 0xff)
+            lastValue = None
+            for (offX, value) in layoutDict[1]:
+                if value in earlyValues:
+                    continue
+                if lastValue != None and value != lastValue:
+                    loadCycles += 1
+                lastValue = value
+            remainingValues = set([ value for (offX, value) in writeByteList if value not in earlyValues ])
+            if lastValue != None:
+                remainingValues.discard(lastValue)
+                loadCycles += len(remainingValues)
+            else:
+                loadCycles += max(len(remainingValues) - 1, 0)
+        elif writeSize == 2:
+            cycles += min(wordStoreCycles / 2, byteStoreCycles) * len(writeByteList)
+        else:
+            cycles += min(dwordStoreCycles / 4, wordStoreCycles / 2, byteStoreCycles) * len(writeByteList)
+        # also, each byte value which isn't already in A, B, E or F must be loaded, at 1 cycle per value or more
+        writeValues = set([ value for (offX, value) in writeByteList + layoutDict[1] ])
+        for (offX, value) in layoutDict[2]:
+            writeValues.update((value >> 8, value & 0xff))
+        for (offX, value) in layoutDict[4]:
+            writeValues.update((value >> 24, (value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff))
+        for regnum in (regA, regB, regE, regF):
+            if startAsm.reg.IsValid(regnum):
+                writeValues.discard(startAsm.reg.GetValue(regnum))
+        return cycles + max(loadCycles, len(writeValues))
+
+    def BestResult(self, trial1Asm, trial2Asm):
+        if trial1Asm.metrics.cycles < trial2Asm.metrics.cycles or (trial1Asm.metrics.cycles == trial2Asm.metrics.cycles and trial1Asm.metrics.bytes <= trial2Asm.metrics.bytes):
+            return trial1Asm
+        else:
+            return trial2Asm
+
+    def GenerateCommand2RegisterOps(self, byteCmd1, byteCmd2, rowAsm):
+        if byteCmd1[0] == 2 and byteCmd2[0] == 2:
+            byteSplit = False
+            # we don't need to clear bits with AND mask if nybble we're writing is 15
+            if (byteCmd1[1] | byteCmd1[2]) != 0xff:
+                rowAsm.emit_op("anda", (f"#${byteCmd1[2]:02x}"), "")
+            else:
+                byteSplit = True
+            if (byteCmd2[1] | byteCmd2[2]) != 0xff:
+                rowAsm.emit_op("andb", (f"#${byteCmd2[2]:02x}"), "")
+            else:
+                byteSplit = True
+            if byteSplit:
+                # we don't need to write nybble with OR if we're writing 0
+                if byteCmd1[1] != 0:
+                    rowAsm.emit_op("ora", (f"#${byteCmd1[1]:02x}"), "")
+                if byteCmd2[1] != 0:
+                    rowAsm.emit_op("orb", (f"#${byteCmd2[1]:02x}"), "")
+            else:
+                wordAdd = (byteCmd1[1] << 8) + byteCmd2[1]
+                if wordAdd != 0:
+                    rowAsm.emit_op("addd", f"#${wordAdd:04x}", "")
+        elif byteCmd1[0] == 2:
+            # we don't need to clear bits with AND mask if nybble we're writing is 15
+            if (byteCmd1[1] | byteCmd1[2]) != 0xff:
+                rowAsm.emit_op("anda", (f"#${byteCmd1[2]:02x}"), "")
+            # we don't need to write nybble with OR if we're writing 0
+            if byteCmd1[1] != 0:
+                rowAsm.emit_op("ora", (f"#${byteCmd1[1]:02x}"), "")
+        elif byteCmd2[0] == 2:
+            # we don't need to clear bits with AND mask if nybble we're writing is 15
+            if (byteCmd2[1] | byteCmd2[2]) != 0xff:
+                rowAsm.emit_op("andb", (f"#${byteCmd2[2]:02x}"), "")
+            # we don't need to write nybble with OR if we're writing 0
+            if byteCmd2[1] != 0:
+                rowAsm.emit_op("orb", (f"#${byteCmd2[1]:02x}"), "")
+
     # *************************************************************************************************
     # Sprite class: Draw function row generation for 6809
     # *************************************************************************************************
 
     def RowDraw6809(self, y, regState, byteStrips):
-        # iterate through all permutations of byte/word layouts for strips to find fastest one
-        layoutList = [ ]
-        return self.PermuteByteStripLayouts(y, regState, layoutList, byteStrips)
+        # calculate a lower bound on the cycle count of each possible layout of each strip
+        self.stripLayoutBounds = [ ]
+        offY = self.YPtrOffNew
+        for byteCmdStrip in byteStrips:
+            bytesInStrip = len(byteCmdStrip[1])
+            if bytesInStrip == 1 or (bytesInStrip & 1) == 0:
+                layoutBounds = { None: self.StripLowerBound(byteCmdStrip, None, offY) }
+            else:
+                layoutBounds = { }
+                for idx in range(0, bytesInStrip, 2):
+                    singleByteOffX = byteCmdStrip[0] + idx
+                    layoutBounds[singleByteOffX] = self.StripLowerBound(byteCmdStrip, singleByteOffX, offY)
+            self.stripLayoutBounds.append(layoutBounds)
+            offY += bytesInStrip
+        # and the lower bound for all of the strips after each one.  Every Command-3 byte value which isn't already
+        # in A or B must be loaded, whatever the layout.  Each value takes at least half of an ldd, or one inherent
+        # instruction (such as inca) on CPU timings where that is cheaper
+        writeValues = set()
+        for (offX, byteCmds) in byteStrips:
+            for byteCmd in byteCmds:
+                if byteCmd[0] == 3:
+                    writeValues.add(byteCmd[1])
+        for regnum in (regA, regB):
+            if regState.IsValid(regnum):
+                writeValues.discard(regState.GetValue(regnum))
+        valueLoadCycles = min([ InstructionCost("ldd", "imm")[0] / 2 ] + [ InstructionCost(op + "a", "inh")[0] for op in ("clr", "com", "neg", "inc", "dec") ])
+        self.remainingStripBounds = [ valueLoadCycles * len(writeValues) ] * (len(byteStrips) + 1)
+        for stripIdx in range(len(byteStrips)-1, -1, -1):
+            self.remainingStripBounds[stripIdx] = self.remainingStripBounds[stripIdx+1] + min(self.stripLayoutBounds[stripIdx].values())
+        # iterate through all permutations of byte/word layouts for strips to find fastest one.  With a limited
+        # search, only try that many layouts, starting with the one with the lowest bound
+        self.lastWordWrite = None
+        self.layoutsLeft = self.searchLevel[2]
+        rowAsmList = [ self.PermuteByteStripLayouts(y, regState, [ ], byteStrips, 0, None) ]
+        if self.searchLevel[0] == 1:
+            # only the fastest code is kept, so the row planner isn't used
+            return self.GetRowCandidates(y, rowAsmList)
+        # the last word written is left in D for the next row, so also find the fastest code which ends with each
+        # word containing a byte value to write in the next row
+        nextRowValues = self.GetNextRowValues(y)
+        lastWordList = [ ]
+        for (offX, byteCmds) in byteStrips:
+            for idx in range(len(byteCmds)-1):
+                if byteCmds[idx][0] == 3 and byteCmds[idx+1][0] == 3:
+                    wordVal = (byteCmds[idx][1] << 8) + byteCmds[idx+1][1]
+                    if wordVal not in lastWordList and (byteCmds[idx][1] in nextRowValues or byteCmds[idx+1][1] in nextRowValues):
+                        lastWordList.append(wordVal)
+        for lastWord in lastWordList:
+            self.lastWordWrite = lastWord
+            rowAsmList.append(self.PermuteByteStripLayouts(y, regState, [ ], byteStrips, 0, None))
+        self.lastWordWrite = None
+        return self.GetRowCandidates(y, rowAsmList)
 
-    def PermuteByteStripLayouts(self, rowNum, regState, layoutList, remainingCmdStrips):
+    def PermuteByteStripLayouts(self, rowNum, regState, layoutList, remainingCmdStrips, layoutCycles, bestAsm):
+        # layoutCycles is the lower bound for the strips in layoutList, and bestAsm is the fastest row code found so far
+        SearchNodes.visited += 1
+        self.CheckDeadline()
         # if we are at a leaf, then we have a complete row layout to turn into assembly code
         if len(remainingCmdStrips) == 0:
-            rowAsm = self.GenRowCode(rowNum, copy.deepcopy(regState), layoutList)
-            return rowAsm
+            if self.layoutsLeft != None:
+                self.layoutsLeft -= 1
+            trialAsm = self.GenRowCode(rowNum, regState, layoutList)
+            if bestAsm == None or trialAsm.metrics.cycles < bestAsm.metrics.cycles:
+                bestAsm = trialAsm
+            return bestAsm
         # otherwise we have more pixel strips to permute, so we will recurse
+        stripIdx = len(layoutList)
         activeByteCmdStrip = remainingCmdStrips[0]
         nextByteCmdStrips = remainingCmdStrips[1:]
-        # if there is only one layout choice, then recurse into trivial case
-        bytesInStrip = len(activeByteCmdStrip[1])
-        if bytesInStrip == 1 or (bytesInStrip & 1) == 0:
-            layoutList.append((activeByteCmdStrip, None))
-            bestAsm = self.PermuteByteStripLayouts(rowNum, regState, layoutList, nextByteCmdStrips)
-            layoutList.pop()
-            return bestAsm
-        # otherwise, iterate through each possible position for single byte in odd-length strip
-        bestAsm = None
-        for idx in range(0, bytesInStrip, 2):
-            singleByteOffX = activeByteCmdStrip[0] + idx
+        # try each possible position for single byte in odd-length strip (or the only layout for other strips)
+        # skip any layout which can't be faster than the best row code which we have already found
+        layoutBounds = list(self.stripLayoutBounds[stripIdx].items())
+        if self.layoutsLeft != None:
+            layoutBounds.sort(key=lambda item: item[1])
+        for (singleByteOffX, stripCycles) in layoutBounds:
+            if self.layoutsLeft == 0:
+                break
+            if bestAsm != None and layoutCycles + stripCycles + self.remainingStripBounds[stripIdx+1] >= bestAsm.metrics.cycles:
+                SearchNodes.pruned += 1
+                continue
             layoutList.append((activeByteCmdStrip, singleByteOffX))
-            trialAsm = self.PermuteByteStripLayouts(rowNum, regState, layoutList, nextByteCmdStrips)
+            bestAsm = self.PermuteByteStripLayouts(rowNum, regState, layoutList, nextByteCmdStrips, layoutCycles + stripCycles, bestAsm)
             layoutList.pop()
-            if bestAsm == None or trialAsm.metrics.cycles < bestAsm.metrics.cycles:
-                #if bestAsm != None:   # fixme debug
-                #    print("%s: row layout with (cyc=%i,bytes=%i) is better than (cyc=%i,bytes=%i)" % (self.name, trialAsm.metrics.cycles, trialAsm.metrics.bytes, bestAsm.metrics.cycles, bestAsm.metrics.bytes))
-                bestAsm = trialAsm
         # return the best one
         return bestAsm
 
+    def StripLowerBound(self, byteCmdStrip, singleByteOffX, offY):
+        # lower bound on the cycles taken by the code from GenRowCode to store and write one strip with the
+        # given layout.  This counts all of the indexed load/store and AND/OR instructions, but none of the
+        # immediate loads, which depend upon the register values
+        (stripOffX, stripByteCmds) = byteCmdStrip
+        numByteCmds = len(stripByteCmds)
+        byteStoreCycles = InstructionCost("sta", "idx")[0]
+        byteLoadCycles = InstructionCost("lda", "idx")[0]
+        byteCopyCycles = byteLoadCycles + byteStoreCycles
+        wordStoreCycles = InstructionCost("std", "idx")[0]
+        wordLoadCycles = InstructionCost("ldd", "idx")[0]
+        wordCopyCycles = wordLoadCycles + wordStoreCycles
+        cycles = 0
+        offX = stripOffX
+        while offX < stripOffX+numByteCmds:
+            numLeft = stripOffX+numByteCmds - offX
+            offXLine = offX + 256*self.lineAdvance
+            if numLeft == 1 or singleByteOffX == offX:
+                # single byte: load and store with A or B, then modify and write
+                byteCmd = stripByteCmds[offX-stripOffX]
+                if not self.eraseRedraw:
+                    cycles += byteCopyCycles + IndexedOffsetCycles(offXLine) + IndexedOffsetCycles(offY)
+                elif byteCmd[0] == 2:
+                    cycles += byteLoadCycles + IndexedOffsetCycles(offXLine)
+                if byteCmd[0] == 2:
+                    cycles += self.Command2OpCycles(byteCmd, (0, 0, 0))
+                if byteCmd[0] >= 2:
+                    cycles += byteStoreCycles + IndexedOffsetCycles(offXLine)
+                offX += 1
+                offY += 1
+                continue
+            # word: load and store with U or D, then modify and write
+            byteCmd1 = stripByteCmds[offX-stripOffX]
+            byteCmd2 = stripByteCmds[offX-stripOffX+1]
+            if not self.eraseRedraw:
+                cycles += wordCopyCycles + IndexedOffsetCycles(offXLine) + IndexedOffsetCycles(offY)
+            elif byteCmd1[0] == 2 or byteCmd2[0] == 2:
+                cycles += wordLoadCycles + IndexedOffsetCycles(offXLine)
+            if byteCmd1[0] == 2 or byteCmd2[0] == 2:
+                cycles += self.Command2OpCycles(byteCmd1, byteCmd2)
+            if byteCmd1[0] >= 2 and byteCmd2[0] >= 2:
+                cycles += wordStoreCycles + IndexedOffsetCycles(offXLine)
+            elif byteCmd1[0] >= 2:
+                cycles += byteStoreCycles + IndexedOffsetCycles(offXLine)
+            elif byteCmd2[0] >= 2:
+                cycles += byteStoreCycles + IndexedOffsetCycles(offXLine+1)
+            offX += 2
+            offY += 2
+        return cycles
+
+    def Command2OpCycles(self, byteCmd1, byteCmd2):
+        opAsm = AsmStream(None)
+        self.GenerateCommand2RegisterOps(byteCmd1, byteCmd2, opAsm)
+        return opAsm.metrics.cycles
+
     def GenRowCode(self, rowNum, regState, layoutList):
         rowAsm = AsmStream(None, regState)
         # generate cmdBytesToStore and cmdWordsToStore lists
@@ -1241,8 +2021,9 @@ class Sprite:
             (offX,offY,byteCmd1,byteCmd2) = cmdWordsToStore[idx]
             if byteCmd1[0] != 2 and byteCmd2[0] != 2:
                 # emit code to store the background word with U
-                rowAsm.gen_loadstore_indexed(True, regU, regX, offX + 256*self.lineAdvance, "")  # ldu off,x
-                rowAsm.gen_loadstore_indexed(False, regU, regY, offY, "")
+                if not self.eraseRedraw:
+                    rowAsm.gen_loadstore_indexed(True, regU, regX, offX + 256*self.lineAdvance, "")  # ldu off,x
+                    rowAsm.gen_loadstore_indexed(False, regU, regY, offY, "")
                 # move this command word into the cmdWordsToWrite or cmdBytesToWrite list
                 if byteCmd1[0] == 1:
                     cmdWordsToStore.pop(idx)
@@ -1281,14 +2062,19 @@ class Sprite:
         # use the scratch register to store all bytes, and write all Command2 bytes
         while len(cmdBytesToStore) > 0:
             (offX,offY,byteCmd) = cmdBytesToStore.pop(0)
+            if self.eraseRedraw and byteCmd[0] == 3:
+                # nothing is saved, so this byte doesn't need to be loaded
+                cmdBytesToWrite.append((offX,offY,byteCmd))
+                continue
             rowAsm.gen_loadstore_indexed(True, scratchReg, regX, offX + 256*self.lineAdvance, "")
-            rowAsm.gen_loadstore_indexed(False, scratchReg, regY, offY, "")
+            if not self.eraseRedraw:
+                rowAsm.gen_loadstore_indexed(False, scratchReg, regY, offY, "")
             if byteCmd[0] == 2:
                 # we don't need to clear bits with AND mask if nybble we're writing is 15
                 if (byteCmd[1] | byteCmd[2]) != 0xff:
-                    rowAsm.emit_op(f"and{regName[scratchReg]}", (f"#${byteCmd[2]:02x}"), "", 2, 2, 2)
+                    rowAsm.emit_op(f"and{regName[scratchReg]}", (f"#${byteCmd[2]:02x}"), "")
                 if byteCmd[1] != 0:
-                    rowAsm.emit_op(f"or{regName[scratchReg]}", (f"#${byteCmd[1]:02x}"), "", 2, 2, 2)
+                    rowAsm.emit_op(f"or{regName[scratchReg]}", (f"#${byteCmd[1]:02x}"), "")
                 rowAsm.gen_loadstore_indexed(False, scratchReg, regX, offX + 256*self.lineAdvance, "")
             elif byteCmd[0] == 3:
                 cmdBytesToWrite.append((offX,offY,byteCmd))
@@ -1313,36 +2099,37 @@ class Sprite:
         while len(cmdWordsToStore) > 0:
             (offX,offY,byteCmd1,byteCmd2) = cmdWordsToStore.pop(0)
             rowAsm.gen_loadstore_indexed(True, regD, regX, offX + 256*self.lineAdvance, "")  # ldd off,x
-            rowAsm.gen_loadstore_indexed(False, regD, regY, offY, "")
+            if not self.eraseRedraw:
+                rowAsm.gen_loadstore_indexed(False, regD, regY, offY, "")
             if byteCmd1[0] == 2 and byteCmd2[0] == 2:
                 byteSplit = False
                 # we don't need to clear bits with AND mask if nybble we're writing is 15
                 if (byteCmd1[1] | byteCmd1[2]) != 0xff:
-                    rowAsm.emit_op("anda", (f"#${byteCmd1[2]:02x}"), "", 2, 2, 2)
+                    rowAsm.emit_op("anda", (f"#${byteCmd1[2]:02x}"), "")
                 else:
                     byteSplit = True
                 if (byteCmd2[1] | byteCmd2[2]) != 0xff:
-                    rowAsm.emit_op("andb", (f"#${byteCmd2[2]:02x}"), "", 2, 2, 2)
+                    rowAsm.emit_op("andb", (f"#${byteCmd2[2]:02x}"), "")
                 else:
                     byteSplit = True
                 if byteSplit:
                     # we don't need to write nybble with OR if we're writing 0
                     if byteCmd1[1] != 0:
-                        rowAsm.emit_op("ora", (f"#${byteCmd1[1]:02x}"), "", 2, 2, 2)
+                        rowAsm.emit_op("ora", (f"#${byteCmd1[1]:02x}"), "")
                     if byteCmd2[1] != 0:
-                        rowAsm.emit_op("orb", (f"#${byteCmd2[1]:02x}"), "", 2, 2, 2)
+                        rowAsm.emit_op("orb", (f"#${byteCmd2[1]:02x}"), "")
                 else:
                     wordAdd = (byteCmd1[1] << 8) + byteCmd2[1]
                     if wordAdd != 0:
-                        rowAsm.emit_op("addd", f"#${wordAdd:04x}", "", 4, 3, 3)
+                        rowAsm.emit_op("addd", f"#${wordAdd:04x}", "")
                 rowAsm.gen_loadstore_indexed(False, regD, regX, offX + 256*self.lineAdvance, "")  # std off,x
             elif byteCmd1[0] == 2:
                 # we don't need to clear bits with AND mask if nybble we're writing is 15
                 if (byteCmd1[1] | byteCmd1[2]) != 0xff:
-                    rowAsm.emit_op("anda", (f"#${byteCmd1[2]:02x}"), "", 2, 2, 2)
+                    rowAsm.emit_op("anda", (f"#${byteCmd1[2]:02x}"), "")
                 # we don't need to write nybble with OR if we're writing 0
                 if byteCmd1[1] != 0:
-                    rowAsm.emit_op("ora", (f"#${byteCmd1[1]:02x}"), "", 2, 2, 2)
+                    rowAsm.emit_op("ora", (f"#${byteCmd1[1]:02x}"), "")
                 if byteCmd2[0] == 1:
                     rowAsm.gen_loadstore_indexed(False, regA, regX, offX + 256*self.lineAdvance, "")  # sta off,x
                 else:  # assert: byteCmd2[0] == 3
@@ -1351,10 +2138,10 @@ class Sprite:
             elif byteCmd2[0] == 2:
                 # we don't need to clear bits with AND mask if nybble we're writing is 15
                 if (byteCmd2[1] | byteCmd2[2]) != 0xff:
-                    rowAsm.emit_op("andb", (f"#${byteCmd2[2]:02x}"), "", 2, 2, 2)
+                    rowAsm.emit_op("andb", (f"#${byteCmd2[2]:02x}"), "")
                 # we don't need to write nybble with OR if we're writing 0
                 if byteCmd2[1] != 0:
-                    rowAsm.emit_op("orb", (f"#${byteCmd2[1]:02x}"), "", 2, 2, 2)
+                    rowAsm.emit_op("orb", (f"#${byteCmd2[1]:02x}"), "")
                 if byteCmd1[0] == 1:
                     rowAsm.gen_loadstore_indexed(False, regB, regX, offX+1 + 256*self.lineAdvance, "")  # stb off,x
                 else:  # assert: byteCmd1[0] == 3
@@ -1400,7 +2187,7 @@ class Sprite:
             if val not in uniqWordValues:
                 uniqWordValues.append(val)
         # permute across all orderings of word writes to minimize number of loads
-        score,wordOrder = self.PermuteWordWriteOrder(rowNum, rowAsm.reg, uniqWordValues, [ ])
+        score,wordOrder = self.PermuteWordWriteOrder(rowNum, rowAsm.reg, uniqWordValues, [ ], 0, None)
         # we need a scratch register to use while writing bytes that don't match words
         # choose one which doesn't destroy a useful register for the first word
         if not rowAsm.reg.IsValid(regA):
@@ -1475,7 +2262,9 @@ class Sprite:
         # return the generated assembly language code
         return rowAsm
 
-    def PermuteWordWriteOrder(self, rowNum, regState, uniqWordValues, wordOrder):
+    def PermuteWordWriteOrder(self, rowNum, regState, uniqWordValues, wordOrder, bestScore, bestOrder):
+        # bestScore and bestOrder give the best ordering found so far (bestOrder is None at the start)
+        SearchNodes.visited += 1
         # if we are at a leaf, calculate the score and return
         if len(uniqWordValues) == 0:
             score = 0.0
@@ -1505,21 +2294,916 @@ class Sprite:
                     score += 1.0
                 if (wordOrder[idx] & 0xff) == (wordOrder[idx+1] & 0xff):
                     score += 1.0
-            return (score,copy.copy(wordOrder))
+            if bestOrder == None or score > bestScore:
+                return (score,copy.copy(wordOrder))
+            return (bestScore, bestOrder)
         # otherwise, try all possible orderings and keep track of the one with the best score
-        bestScore = 0
-        bestOrder = None
         for idx in range(len(uniqWordValues)):
+            # the row planner may require a particular word to be written last
+            if uniqWordValues[idx] == self.lastWordWrite and len(uniqWordValues) > 1:
+                continue
             nextWord = uniqWordValues.pop(idx)
             wordOrder.append(nextWord)
-            tryScore,tryOrder = self.PermuteWordWriteOrder(rowNum, regState, uniqWordValues, wordOrder)
-            if bestOrder == None or tryScore > bestScore:
-                bestScore = tryScore
-                bestOrder = tryOrder
+            # skip this ordering if its upper bound score can't beat the best ordering already found
+            if bestOrder == None or self.WordOrderUpperBound(rowNum, regState, uniqWordValues, wordOrder) > bestScore:
+                bestScore,bestOrder = self.PermuteWordWriteOrder(rowNum, regState, uniqWordValues, wordOrder, bestScore, bestOrder)
+            else:
+                SearchNodes.pruned += 1
             wordOrder.pop()
             uniqWordValues.insert(idx, nextWord)
         return (bestScore, bestOrder)
 
+    def WordOrderUpperBound(self, rowNum, regState, uniqWordValues, wordOrder):
+        # upper bound on the score of any complete ordering which starts with wordOrder.  The terms are added in the
+        # same order as in the leaf score calculation, so that rounding can never make the bound smaller than the score
+        score = 0.0
+        # 1 point if the first word matches a known register value
+        firstWordWriteVal = wordOrder[0]
+        if regState.IsValid(regA) and regState.GetValue(regA) == (firstWordWriteVal >> 8):
+            score += 1.0
+        elif regState.IsValid(regB) and regState.GetValue(regB) == (firstWordWriteVal & 0xff):
+            score += 1.0
+        # the last word will be one of the remaining words, or the last word in wordOrder if it is complete
+        if rowNum < self.height - 1:
+            wordWriteProb = self.wordWriteProbByRow[rowNum+1]
+            byteWriteProb = self.byteWriteProbByRow[rowNum+1]
+            lastValList = uniqWordValues if len(uniqWordValues) > 0 else [ wordOrder[-1] ]
+            bestScore = score
+            for lastVal in lastValList:
+                lastScore = score + wordWriteProb.get(lastVal, 0.0)
+                lastScore += max(byteWriteProb.get(lastVal >> 8, 0.0), byteWriteProb.get(lastVal & 0xff, 0.0))
+                bestScore = max(bestScore, lastScore)
+            score = bestScore
+        for idx in range(len(wordOrder)-1):
+            if (wordOrder[idx] & 0xff00) == (wordOrder[idx+1] & 0xff00):
+                score += 1.0
+            if (wordOrder[idx] & 0xff) == (wordOrder[idx+1] & 0xff):
+                score += 1.0
+        # the word values are unique, so each of the remaining words can only match one byte of the word before it
+        for idx in range(len(uniqWordValues)):
+            score += 1.0
+        return score
+
+
+    # *************************************************************************************************
+    # Sprite class: Delta function generation
+    # *************************************************************************************************
+
+    def GetFrameOffset(self, frame):
+        # return the destination pointer for a frame drawn at the same position as this sprite, relative to the
+        # destination pointer for this sprite
+        self.CalcOrigin()
+        frame.CalcOrigin()
+        rowAdjust = self.hotspot[1] - frame.hotspot[1]
+        byteAdjust = (frame.originXcode - frame.originXsprite) // 2 - (self.originXcode - self.originXsprite) // 2
+        return 256 * rowAdjust + byteAdjust
+
+    def GetFrameBytes(self, frame, funcNum):
+        # return the list of bytes whose background is saved when a frame is drawn (in the order of the saved data)
+        # and a dictionary of the bytes written by the frame as (mask of nibbles written, value).  The addresses
+        # of the bytes are given relative to the destination pointer for this sprite
+        frameOffset = self.GetFrameOffset(frame)
+        savedList = [ ]
+        for y in range(frame.height):
+            for byteOff in frame.GetSavedByteOffsets(y):
+                savedList.append(frameOffset + 256 * y + byteOff)
+        pixelBytes = { }
+        for y in range(frame.height):
+            for x in range(frame.width):
+                if frame.matrix[y][x] == -1:
+                    continue
+                pixOff = x - frame.originXcode + funcNum
+                address = frameOffset + 256 * y + (pixOff >> 1)
+                (mask, value) = pixelBytes.get(address, (0, 0))
+                if (pixOff & 1) == 0:
+                    pixelBytes[address] = (mask | 0xf0, value | (frame.matrix[y][x] << 4))
+                else:
+                    pixelBytes[address] = (mask | 0x0f, value | frame.matrix[y][x])
+        return (savedList, pixelBytes)
+
+    def GenDeltaErase(self):
+        # the saved data is left in the layout of the new sprite, so the Erase function generated above (which is the
+        # same as the new sprite's Erase function) restores it.  The buffer must be large enough for both sprites
+        numSavedFrom = len(self.GetFrameBytes(self.deltaFrom, 0)[0])
+        self.numSavedBytes = max(self.numSavedBytes, numSavedFrom)
+
+    def GenDelta(self, funcNum):
+        # generate a function which changes the old sprite (deltaFrom), drawn by the DrawLeft or DrawRight function
+        # at the same position, into this one.  The graphics memory and saved background data are left exactly as
+        # if the old sprite had been erased and this one drawn, but only the bytes which change are written
+        funcDelta = self.funcDraw[funcNum]
+        funcDelta.emit_comment("Input:   X = Pointer to graphics memory")
+        funcDelta.emit_comment(f"         Y = Pointer to background pixel data saved by {self.deltaFrom.name}")
+        if CPU == 6309:
+            funcDelta.emit_comment("Trashed: X,Y,D,W")
+        else:
+            funcDelta.emit_comment("Trashed: X,Y,D")
+        (oldSavedList, oldPixels) = self.GetFrameBytes(self.deltaFrom, funcNum)
+        (newSavedList, newPixels) = self.GetFrameBytes(self, funcNum)
+        oldSlots = { oldSavedList[idx]:idx for idx in range(len(oldSavedList)) }
+        newSlots = { newSavedList[idx]:idx for idx in range(len(newSavedList)) }
+        # the positions of the X (graphics memory) and Y (saved data) pointers
+        self.deltaPtrPos = { regX:0, regY:0 }
+        # first, restore the background of the bytes which are only covered by the old sprite
+        self.GenDeltaCopies(funcDelta, [ (regY, oldSlots[address], regX, address) for address in oldSavedList if address not in newSlots ])
+        # then move the saved background of the bytes covered by both sprites into the new layout.  These bytes
+        # are in the same order in both layouts, so by moving the bytes which go up in reverse order and the bytes
+        # which go down in forward order, we never overwrite saved data which hasn't been moved yet
+        commonList = [ address for address in newSavedList if address in oldSlots ]
+        self.GenDeltaCopies(funcDelta, [ (regY, oldSlots[address], regY, newSlots[address]) for address in reversed(commonList) if newSlots[address] > oldSlots[address] ])
+        self.GenDeltaCopies(funcDelta, [ (regY, oldSlots[address], regY, newSlots[address]) for address in commonList if newSlots[address] < oldSlots[address] ])
+        # then save the background of the bytes which are only covered by the new sprite
+        self.GenDeltaCopies(funcDelta, [ (regX, address, regY, newSlots[address]) for address in newSavedList if address not in oldSlots ])
+        # finally, write the bytes whose pixels change.  A byte which is partly transparent in the new sprite is
+        # made from its saved background, in case the old sprite covered the other nibble
+        writeList = [ ]
+        for address in newSavedList:
+            (oldMask, oldValue) = oldPixels.get(address, (0, 0))
+            (newMask, newValue) = newPixels.get(address, (0, 0))
+            if oldMask == newMask and oldValue == newValue:
+                continue
+            if newMask == 0xff:
+                writeList.append((address, (3, newValue, 0)))
+            elif newMask == 0:
+                writeList.append((address, (1, 0, 0)))
+            else:
+                writeList.append((address, (2, newValue, newMask ^ 0xff)))
+        idx = 0
+        while idx < len(writeList):
+            (address, byteCmd) = writeList[idx]
+            if idx + 1 < len(writeList) and writeList[idx+1][0] == address + 1 and (byteCmd[0] == 3) == (writeList[idx+1][1][0] == 3):
+                byteCmd2 = writeList[idx+1][1]
+                idx += 2
+                if byteCmd[0] == 3:
+                    funcDelta.gen_loadimm_accum(regD, (byteCmd[1] << 8) + byteCmd2[1], "")
+                else:
+                    funcDelta.gen_loadstore_indexed(True, regD, regY, self.GetDeltaOffset(funcDelta, regY, newSlots[address]), "")
+                    self.GenerateCommand2RegisterOps(byteCmd, byteCmd2, funcDelta)
+                funcDelta.gen_loadstore_indexed(False, regD, regX, self.GetDeltaOffset(funcDelta, regX, address), "")
+                continue
+            idx += 1
+            if byteCmd[0] == 3 and funcDelta.reg.IsValid(regB) and funcDelta.reg.GetValue(regB) == byteCmd[1]:
+                regWrite = regB
+            else:
+                regWrite = regA
+            if byteCmd[0] == 3:
+                funcDelta.gen_loadimm_accum(regWrite, byteCmd[1], "")
+            else:
+                funcDelta.gen_loadstore_indexed(True, regA, regY, self.GetDeltaOffset(funcDelta, regY, newSlots[address]), "")
+                self.GenerateCommand2RegisterOps(byteCmd, (0, 0, 0), funcDelta)
+            funcDelta.gen_loadstore_indexed(False, regWrite, regX, self.GetDeltaOffset(funcDelta, regX, address), "")
+        funcDelta.emit_op("rts", "", "")
+        PeepholeOptimizer().Optimize(funcDelta)
+
+    def GetDeltaOffset(self, asmStream, regIdx, address):
+        # return the offset from a pointer register to an address, moving the pointer if it is too far away.  The
+        # peephole optimizer chooses the best positions for the pointer afterwards
+        offset = address - self.deltaPtrPos[regIdx]
+        if offset < -128 or offset >= 128:
+            asmStream.gen_loadeffaddr_offset(regIdx, offset, regIdx, "")
+            self.deltaPtrPos[regIdx] = address
+            offset = 0
+        return offset
+
+    def GenDeltaCopies(self, asmStream, copyList):
+        # copy bytes given as (source register, source address, destination register, destination address),
+        # using word (or 6309 dword) loads and stores for runs of consecutive bytes in the same direction
+        idx = 0
+        while idx < len(copyList):
+            runLen = 1
+            runStep = None
+            while idx + runLen < len(copyList):
+                prevCopy = copyList[idx+runLen-1]
+                nextCopy = copyList[idx+runLen]
+                step = nextCopy[1] - prevCopy[1]
+                if step not in (1, -1) or nextCopy[3] - prevCopy[3] != step or (runStep != None and step != runStep):
+                    break
+                runStep = step
+                runLen += 1
+            if CPU == 6309 and runLen >= 4:
+                (copyLen, regCopy) = (4, regQ)
+            elif runLen >= 2:
+                (copyLen, regCopy) = (2, regD)
+            else:
+                (copyLen, regCopy) = (1, regA)
+            copyItems = copyList[idx:idx+copyLen]
+            (srcReg, srcAddress, dstReg, dstAddress) = copyItems[0]
+            srcAddress = min([ item[1] for item in copyItems ])
+            dstAddress = min([ item[3] for item in copyItems ])
+            asmStream.gen_loadstore_indexed(True, regCopy, srcReg, self.GetDeltaOffset(asmStream, srcReg, srcAddress), "")
+            asmStream.gen_loadstore_indexed(False, regCopy, dstReg, self.GetDeltaOffset(asmStream, dstReg, dstAddress), "")
+            idx += copyLen
+
+
+# *************************************************************************************************
+# Peephole optimizer: rewrite rules applied to the finished Draw and Erase functions
+# *************************************************************************************************
+
+# registers named in the instruction mnemonics, and their sizes in bytes
+PeepholeRegs = { name:regnum for (regnum, name) in regName.items() }
+RegisterSizes = { regA:1, regB:1, regE:1, regF:1, regD:2, regW:2, regQ:4, regX:2, regY:2, regU:2, regS:2 }
+
+# the next wider store for each accumulator: (partner register, offset of partner from this register, wide register)
+WideStores = { regA:(regB, 1, regD), regB:(regA, -1, regD), regD:(regW, 2, regQ), regW:(regD, -2, regQ) }
+
+# the number of code bytes which the peephole optimizer will spend to save one clock cycle.  A rewrite is only made
+# if it is a net win when cycles and bytes are weighed this way, which bounds the code growth for small cycle savings
+PeepholeBytesPerCycle = 2
+
+def PeepholeCost(cycles, bytes):
+    # cost of some code, as one number to be minimized by the peephole optimizer
+    return cycles * PeepholeBytesPerCycle + bytes
+
+def IsReturn(instr):
+    # a function returns with rts, or by pulling PC from the S stack
+    return instr.op == "rts" or (instr.op == "puls" and "pc" in GetStackRegisters(instr.operand))
+
+class PeepholeState:
+    # what is known about the registers before an instruction: the values of the accumulators (as AsmRegisters),
+    # the value of U, and the position of each pointer as (epoch, delta).  A pointer's epoch changes whenever it
+    # is changed by an unknown amount, so that two addresses may only be compared if they have the same epoch
+    def __init__(self):
+        self.reg = AsmRegisters()
+        self.valueU = None
+        self.pointers = { }
+
+    def Copy(self):
+        newState = PeepholeState()
+        newState.reg = self.reg
+        newState.valueU = self.valueU
+        newState.pointers = self.pointers.copy()
+        return newState
+
+class PeepholeOptimizer:
+    def __init__(self):
+        self.nextEpoch = 0
+        self.decoded = { }
+
+    def DecodeInstruction(self, instr):
+        # return (operation, register, mode, value) for an instruction, where mode is "imm" (value is the
+        # immediate value), "idx" (value is (index register, offset)), or None.  Return None for anything else
+        if instr.op == None:
+            return None
+        key = (instr.op, instr.operand)
+        if key not in self.decoded:
+            self.decoded[key] = self.DecodeOperation(instr)
+        return self.decoded[key]
+
+    def DecodeOperation(self, instr):
+        for operation in ("ld", "st", "and", "or", "add", "clr", "com", "neg", "inc", "dec", "lea"):
+            if instr.op.startswith(operation) and instr.op[len(operation):] in PeepholeRegs:
+                regnum = PeepholeRegs[instr.op[len(operation):]]
+                break
+        else:
+            return (instr.op, None, None, None)
+        if instr.operand.startswith("#$"):
+            return (operation, regnum, "imm", int(instr.operand[2:], 16))
+        if instr.operand.startswith("#"):
+            return (operation, regnum, "imm", int(instr.operand[1:]))
+        match = re.match(r"^(-?\d*),([xyus])$", instr.operand)
+        if match:
+            return (operation, regnum, "idx", (PeepholeRegs[match.group(2)], int(match.group(1) or "0")))
+        return (operation, regnum, None, None)
+
+    def NewPointer(self, state, regnum):
+        self.nextEpoch += 1
+        state.pointers[regnum] = (self.nextEpoch, 0)
+
+    def ForgetAll(self):
+        state = PeepholeState()
+        for regnum in (regX, regY, regU, regS):
+            self.NewPointer(state, regnum)
+        return state
+
+    def StepState(self, state, instr):
+        # return the state after executing an instruction
+        if instr.label != None:
+            # a label is an entry point, so nothing is known there
+            return self.ForgetAll()
+        decoded = self.DecodeInstruction(instr)
+        if decoded == None:
+            return state
+        (operation, regnum, mode, value) = decoded
+        newState = state.Copy()
+        if regnum in (regX, regY, regU, regS):
+            if operation == "lea" and mode == "idx" and value[0] == regnum:
+                (epoch, delta) = state.pointers[regnum]
+                newState.pointers[regnum] = (epoch, delta + value[1])
+            elif operation == "lea" and mode == "idx":
+                (epoch, delta) = state.pointers[value[0]]
+                newState.pointers[regnum] = (epoch, delta + value[1])
+            elif operation != "st":
+                self.NewPointer(newState, regnum)
+            if regnum == regU and operation != "st":
+                newState.valueU = value if (operation == "ld" and mode == "imm") else None
+            return newState
+        if regnum != None:
+            knownValue = None
+            if state.reg.IsValid(regnum):
+                knownValue = state.reg.GetValue(regnum)
+            mask = (1 << (8 * RegisterSizes[regnum])) - 1
+            if operation == "st":
+                return newState
+            elif operation == "ld" and mode == "imm":
+                knownValue = value
+            elif operation == "clr":
+                knownValue = 0
+            elif knownValue == None or operation == "ld":
+                knownValue = None
+            elif operation == "com":
+                knownValue = knownValue ^ mask
+            elif operation == "neg":
+                knownValue = (-knownValue) & mask
+            elif operation == "inc":
+                knownValue = (knownValue + 1) & mask
+            elif operation == "dec":
+                knownValue = (knownValue - 1) & mask
+            elif mode == "imm" and operation == "and":
+                knownValue = knownValue & value
+            elif mode == "imm" and operation == "or":
+                knownValue = knownValue | value
+            elif mode == "imm" and operation == "add":
+                knownValue = (knownValue + value) & mask
+            else:
+                knownValue = None
+            if knownValue == None:
+                newState.reg = state.reg.WithInvalid(regnum)
+            else:
+                newState.reg = state.reg.WithValue(regnum, knownValue)
+            return newState
+        if operation in ("pshs", "puls", "pshu", "pulu"):
+            # the stack pointer moves by the number of bytes pushed or pulled, and the pulled registers are unknown
+            stackReg = regS if operation[3] == "s" else regU
+            nameList = GetStackRegisters(instr.operand)
+            numBytes = sum([ StackRegisterBytes[name] for name in nameList ])
+            (epoch, delta) = state.pointers[stackReg]
+            newState.pointers[stackReg] = (epoch, delta + numBytes if operation[:3] == "pul" else delta - numBytes)
+            if stackReg == regU:
+                newState.valueU = None
+            if operation[:3] == "pul":
+                for name in nameList:
+                    if name in ("a", "b"):
+                        newState.reg = newState.reg.WithInvalid(PeepholeRegs[name])
+                    elif name in ("x", "y", "u", "s"):
+                        self.NewPointer(newState, PeepholeRegs[name])
+                        if name == "u":
+                            newState.valueU = None
+            return newState
+        if operation == "addr" and instr.operand == "u,x" and state.valueU != None:
+            (epoch, delta) = state.pointers[regX]
+            newState.pointers[regX] = (epoch, delta + state.valueU)
+            return newState
+        if operation == "rts":
+            return newState
+        # tfm (or anything else) changes the pointers and accumulators in ways which we don't track
+        return self.ForgetAll()
+
+    def GetStates(self, instructions):
+        # return a list of the states before each instruction (and after the last one)
+        stateList = [ self.ForgetAll() ]
+        for instr in instructions:
+            stateList.append(self.StepState(stateList[-1], instr))
+        return stateList
+
+    def GetMemoryAccess(self, state, instr):
+        # return (pointer epoch, first address, last address) for an indexed load or store, None if the
+        # instruction doesn't access memory, or False if it may access any memory
+        if instr.label != None or instr.op == None:
+            return None
+        decoded = self.DecodeInstruction(instr)
+        (operation, regnum, mode, value) = decoded
+        if operation in ("ld", "st", "and", "or", "add") and mode == "idx":
+            (epoch, delta) = state.pointers[value[0]]
+            return (epoch, delta + value[1], delta + value[1] + RegisterSizes[regnum] - 1)
+        if operation in ("pshs", "puls", "pshu", "pulu"):
+            stackReg = regS if operation[3] == "s" else regU
+            numBytes = sum([ StackRegisterBytes[name] for name in GetStackRegisters(instr.operand) ])
+            (epoch, delta) = state.pointers[stackReg]
+            if operation[:3] == "pul":
+                return (epoch, delta, delta + numBytes - 1)
+            return (epoch, delta - numBytes, delta - 1)
+        if operation in ("tfm", "jsr", "bsr"):
+            return False
+        return None
+
+    def Optimize(self, asmStream):
+        # apply the rewrite rules until none of them changes the code, and record the cycles and bytes saved
+        oldCycles = asmStream.metrics.cycles
+        oldBytes = asmStream.metrics.bytes
+        instructions = asmStream.instructions
+        while self.RemoveKnownLoads(instructions) or self.WidenStores(instructions) or self.RebasePointers(instructions):
+            pass
+        asmStream.metrics.cycles = sum([ instr.cycles for instr in instructions ])
+        asmStream.metrics.bytes = sum([ instr.bytes for instr in instructions ])
+        asmStream.peepholeSaved.cycles = oldCycles - asmStream.metrics.cycles
+        asmStream.peepholeSaved.bytes = oldBytes - asmStream.metrics.bytes
+
+    def RemoveKnownLoads(self, instructions):
+        # delete an immediate load (or clr) of a value which is already in the register
+        stateList = self.GetStates(instructions)
+        for idx in range(len(instructions)):
+            decoded = self.DecodeInstruction(instructions[idx])
+            if decoded == None or decoded[1] not in RegisterFields:
+                continue
+            (operation, regnum, mode, value) = decoded
+            if operation == "clr":
+                value = 0
+            elif operation != "ld" or mode != "imm":
+                continue
+            reg = stateList[idx].reg
+            if reg.IsValid(regnum) and reg.GetValue(regnum) == value:
+                instructions.pop(idx)
+                return True
+        return False
+
+    def WidenStores(self, instructions):
+        # when a register is stored next to the address where a later instruction stores the value which is
+        # already in its partner register, store both registers together with the first instruction and delete
+        # the later store.  The Draw and Erase functions never access the same memory through different pointers
+        stateList = self.GetStates(instructions)
+        for idx in range(len(instructions)):
+            instr = instructions[idx]
+            decoded = self.DecodeInstruction(instr)
+            if decoded == None or decoded[0] != "st" or decoded[2] != "idx" or decoded[1] not in WideStores:
+                continue
+            (operation, regnum, mode, (regIdx, offset)) = decoded
+            (partnerReg, partnerOff, wideReg) = WideStores[regnum]
+            if wideReg == regQ and CPU != 6309:
+                continue
+            state = stateList[idx]
+            if not state.reg.IsValid(partnerReg):
+                continue
+            partnerValue = state.reg.GetValue(partnerReg)
+            (epoch, delta) = state.pointers[regIdx]
+            partnerFirst = delta + offset + partnerOff
+            partnerLast = partnerFirst + RegisterSizes[partnerReg] - 1
+            # look for the later store of the partner value
+            for laterIdx in range(idx+1, len(instructions)):
+                laterState = stateList[laterIdx]
+                access = self.GetMemoryAccess(laterState, instructions[laterIdx])
+                if instructions[laterIdx].label != None or access == False or laterState.pointers[regIdx][0] != epoch:
+                    break
+                if access == None or access[0] != epoch or access[2] < partnerFirst or access[1] > partnerLast:
+                    continue
+                # this instruction accesses the partner's address, so it must be the store that we're looking for
+                laterDecoded = self.DecodeInstruction(instructions[laterIdx])
+                laterReg = laterDecoded[1]
+                if laterDecoded[0] == "st" and access[1] == partnerFirst and access[2] == partnerLast and laterState.reg.IsValid(laterReg) and laterState.reg.GetValue(laterReg) == partnerValue:
+                    wideOffset = offset + min(0, partnerOff)
+                    wideAsm = AsmStream(None)
+                    wideAsm.gen_loadstore_indexed(False, wideReg, regIdx, wideOffset, instr.comment)
+                    wideInstr = wideAsm.instructions[0]
+                    if PeepholeCost(wideInstr.cycles, wideInstr.bytes) < PeepholeCost(instr.cycles + instructions[laterIdx].cycles, instr.bytes + instructions[laterIdx].bytes):
+                        instructions.pop(laterIdx)
+                        instructions[idx] = wideInstr
+                        return True
+                break
+        return False
+
+    def GetPointerChains(self, instructions, regnum):
+        # split the function into chains of lea instructions which only move the pointer by a constant offset. Each
+        # chain is (windowList, baseList, leaIdxList, bFixedEnd): for each position of the pointer in the chain, the
+        # indexed accesses made from it as (instruction index, address) and the position of the pointer, both
+        # relative to the start of the chain, and the index of each lea instruction.  The pointer must be in its
+        # original position at the start of each chain, and also at the end unless the function returns there
+        chainList = [ ]
+        windowList = [ [ ] ]
+        baseList = [ 0 ]
+        leaIdxList = [ ]
+        for idx in range(len(instructions)):
+            instr = instructions[idx]
+            decoded = self.DecodeInstruction(instr)
+            if instr.label == None and decoded == None:
+                continue
+            if instr.label == None:
+                (operation, regLdSt, mode, value) = decoded
+                if operation == "lea" and regLdSt == regnum and mode == "idx" and value[0] == regnum:
+                    leaIdxList.append(idx)
+                    baseList.append(baseList[-1] + value[1])
+                    windowList.append([ ])
+                    continue
+                if operation != "lea" and regLdSt != regnum and mode == "idx" and value[0] == regnum:
+                    windowList[-1].append((idx, baseList[-1] + value[1]))
+                    continue
+                if not IsReturn(instr) and regLdSt != regnum and regName[regnum] not in instr.operand:
+                    continue
+            # any other use of the pointer (or an entry point) ends the chain
+            chainList.append((windowList, baseList, leaIdxList, not IsReturn(instr)))
+            windowList = [ [ ] ]
+            baseList = [ 0 ]
+            leaIdxList = [ ]
+        return chainList
+
+    def GetOffsetCost(self, offset):
+        # extra cycles and bytes for the offset in an indexed instruction, as one number to be minimized
+        return PeepholeCost(*IndexedOffsetCost(offset))
+
+    def GetLeaCosts(self, regnum):
+        # cost of moving a pointer with a 5-bit, 8-bit, or 16-bit offset.  Moving it by 0 is free, because the lea
+        # instruction can be deleted
+        leaCosts = [ 0 ]
+        for offset in (1, 16, 128):
+            leaAsm = AsmStream(None)
+            leaAsm.gen_loadeffaddr_offset(regnum, offset, regnum, "")
+            leaCosts.append(PeepholeCost(leaAsm.instructions[0].cycles, leaAsm.instructions[0].bytes))
+        return leaCosts
+
+    def RebasePointers(self, instructions):
+        # choose new positions for the pointers after each lea instruction to minimize the cost of the indexed
+        # offsets and the lea instructions themselves.  This may merge or delete the lea instructions
+        for regnum in (regX, regY):
+            for (windowList, baseList, leaIdxList, bFixedEnd) in self.GetPointerChains(instructions, regnum):
+                if len(leaIdxList) == 0:
+                    continue
+                newBaseList = self.PlanPointerChain(regnum, windowList, baseList, bFixedEnd)
+                if newBaseList == None:
+                    continue
+                # rewrite the lea instructions and the offsets of the indexed accesses
+                deleteIdxList = [ ]
+                for baseIdx in range(len(baseList)):
+                    newBase = newBaseList[baseIdx]
+                    for (idx, address) in windowList[baseIdx]:
+                        instr = instructions[idx]
+                        newOffset = address - newBase
+                        if newOffset == 0:
+                            operand = f",{regName[regnum]}"
+                        else:
+                            operand = f"{int(newOffset)},{regName[regnum]}"
+                        (cycles, bytes) = GetInstructionCost(instr.op, operand)
+                        instructions[idx] = instr._replace(operand=operand, cycles=cycles, bytes=bytes)
+                    if baseIdx == 0:
+                        continue
+                    idx = leaIdxList[baseIdx-1]
+                    offset = newBase - newBaseList[baseIdx-1]
+                    if offset == 0:
+                        deleteIdxList.append(idx)
+                    else:
+                        leaAsm = AsmStream(None)
+                        leaAsm.gen_loadeffaddr_offset(regnum, offset, regnum, instructions[idx].comment)
+                        instructions[idx] = leaAsm.instructions[0]
+                for idx in reversed(deleteIdxList):
+                    instructions.pop(idx)
+                # the instruction indices of any later chains have changed
+                return True
+        return False
+
+    def PlanPointerChain(self, regnum, windowList, baseList, bFixedEnd):
+        # dynamic programming over the pointer positions in a chain.  The candidate positions for each window are
+        # those which put one of its accesses at a zero offset or at the edge of a 5-bit or 8-bit offset, and the
+        # original positions before and after its lea (so that the lea may be deleted).  Return the new list of
+        # positions, or None if they aren't a net win when cycles and bytes are weighed by PeepholeBytesPerCycle
+        windowCosts = [ ]
+        for baseIdx in range(len(baseList)):
+            if baseIdx == 0 or (bFixedEnd and baseIdx == len(baseList) - 1):
+                candidateSet = { baseList[baseIdx] }
+            else:
+                candidateSet = { baseList[baseIdx], baseList[baseIdx-1] }
+                for (idx, address) in windowList[baseIdx]:
+                    candidateSet.update((address, address - 15, address + 16, address - 127, address + 128))
+            windowCosts.append({ base:sum([ self.GetOffsetCost(address - base) for (idx, address) in windowList[baseIdx] ]) for base in candidateSet })
+        leaCosts = self.GetLeaCosts(regnum)
+        def GetLeaCost(offset):
+            if offset == 0:
+                return leaCosts[0]
+            if offset < 16 and offset >= -16:
+                return leaCosts[1]
+            if offset < 128 and offset >= -128:
+                return leaCosts[2]
+            return leaCosts[3]
+        oldCost = windowCosts[0][0]
+        bestList = [ { 0:(oldCost, None) } ]
+        for baseIdx in range(1, len(baseList)):
+            oldCost += windowCosts[baseIdx][baseList[baseIdx]] + GetLeaCost(baseList[baseIdx] - baseList[baseIdx-1])
+            bestDict = { }
+            for (base, windowCost) in windowCosts[baseIdx].items():
+                bestDict[base] = min([ (prevCost + GetLeaCost(base - prevBase) + windowCost, prevBase) for (prevBase, (prevCost, prevPrev)) in bestList[-1].items() ])
+            bestList.append(bestDict)
+        (newCost, base) = min([ (cost, base) for (base, (cost, prevBase)) in bestList[-1].items() ])
+        if newCost >= oldCost:
+            return None
+        newBaseList = [ base ]
+        for baseIdx in range(len(baseList) - 1, 0, -1):
+            base = bestList[baseIdx][base][1]
+            newBaseList.insert(0, base)
+        return newBaseList
+
+# *************************************************************************************************
+# Simulator: cycle-counting interpreter used to verify the generated Draw and Erase functions
+# *************************************************************************************************
+
+# instruction timing, as (6809 cycles, 6309 native mode cycles, 6309 emulation mode cycles, bytes).  These tables are
+# written from the CPU data sheets, independently of the cost model used by the code generator (InstructionCosts),
+# so that the two can be checked against each other.  An entry of None for the 6809 cycles means that the instruction
+# only exists on the 6309
+SimInherentOps = { "rts":(5, 4, 5, 1) }
+for regChar in "ab":
+    for operation in ("clr", "com", "neg", "inc", "dec"):
+        SimInherentOps[operation + regChar] = (2, 1, 2, 1)
+for regChar in "defw":
+    for operation in ("clr", "com", "inc", "dec"):
+        SimInherentOps[operation + regChar] = (None, 2, 3, 2)
+SimInherentOps["negd"] = (None, 2, 3, 2)
+
+SimImmediateOps = { "lda":(2, 2, 2, 2), "ldb":(2, 2, 2, 2), "anda":(2, 2, 2, 2), "andb":(2, 2, 2, 2), "ora":(2, 2, 2, 2), "orb":(2, 2, 2, 2),
+                    "ldd":(3, 3, 3, 3), "ldu":(3, 3, 3, 3), "ldx":(3, 3, 3, 3), "ldy":(4, 4, 4, 4), "addd":(4, 3, 4, 3),
+                    "lde":(None, 3, 3, 3), "ldf":(None, 3, 3, 3), "ldw":(None, 4, 4, 4), "ldq":(None, 5, 5, 5) }
+
+# indexed instructions: the base timing, without the extra cycles and bytes for the offset
+SimIndexedOps = { "lda":(4, 4, 4, 2), "ldb":(4, 4, 4, 2), "sta":(4, 4, 4, 2), "stb":(4, 4, 4, 2),
+                  "anda":(4, 4, 4, 2), "andb":(4, 4, 4, 2), "ora":(4, 4, 4, 2), "orb":(4, 4, 4, 2),
+                  "ldd":(5, 5, 5, 2), "std":(5, 5, 5, 2), "ldu":(5, 5, 5, 2), "stu":(5, 5, 5, 2), "ldx":(5, 5, 5, 2), "stx":(5, 5, 5, 2),
+                  "ldy":(6, 6, 6, 3), "sty":(6, 6, 6, 3), "leax":(4, 4, 4, 2), "leay":(4, 4, 4, 2), "leau":(4, 4, 4, 2),
+                  "lde":(None, 5, 5, 3), "ldf":(None, 5, 5, 3), "ste":(None, 5, 5, 3), "stf":(None, 5, 5, 3),
+                  "ldw":(None, 6, 6, 3), "stw":(None, 6, 6, 3), "ldq":(None, 8, 8, 3), "stq":(None, 8, 8, 3) }
+
+# register-to-register instructions, and the stack instructions without the extra cycle for each byte moved.  The
+# tfm instruction also takes 3 cycles for each byte copied
+SimRegisterOps = { "addr":(None, 4, 4, 3), "tfm":(None, 6, 6, 3) }
+SimStackOps = { "pshs":(5, 4, 5, 2), "puls":(5, 4, 5, 2), "pshu":(5, 4, 5, 2), "pulu":(5, 4, 5, 2) }
+
+def SimIndexedOffsetCost(offset):
+    # extra (6809 cycles, 6309 native cycles, 6309 emulation cycles, bytes) for a constant offset from an index register
+    if offset == 0:
+        return (0, 0, 0, 0)
+    if offset >= -16 and offset < 16:
+        return (1, 1, 1, 0)
+    if offset >= -128 and offset < 128:
+        return (1, 1, 1, 1)
+    return (4, 3, 4, 2)
+
+def CheckInstructionCosts():
+    # compare every entry in the code generator's cost model with the simulator's timing tables, for all of the CPU
+    # timings, and return a list of the differences
+    simTables = { "inh":SimInherentOps, "imm":SimImmediateOps, "idx":SimIndexedOps, "reg":SimRegisterOps, "stk":SimStackOps }
+    errorList = [ ]
+    for ((op, mode), costs) in sorted(InstructionCosts.items()):
+        simCosts = simTables[mode].get(op)
+        if simCosts != costs:
+            errorList.append(f"cost model gives '{op}' ({mode}) as {costs}, but the simulator has {simCosts}")
+    for (offset, costs) in zip((0, 1, -128, 128), IndexedOffsetCosts):
+        if SimIndexedOffsetCost(offset) != costs:
+            errorList.append(f"cost model gives indexed offset {int(offset)} as {costs}, but the simulator has {SimIndexedOffsetCost(offset)}")
+    if (StackByteCycles, TfmByteCycles) != (1, 3):
+        errorList.append(f"cost model gives {int(StackByteCycles)} cycles per stack byte and {int(TfmByteCycles)} per tfm byte, but the simulator has 1 and 3")
+    return errorList
+
+class AsmSimulator:
+    # executes the straight-line functions made by sprite2asm on a 64k memory image.  The condition codes are not
+    # simulated, because the generated code never branches
+    def __init__(self, memory, regValues):
+        self.memory = memory
+        self.regs = regValues.copy()
+        self.cycles = 0
+        self.bytes = 0
+        self.countErrors = [ ]
+
+    def GetReg(self, regnum):
+        if regnum == regD:
+            return (self.regs[regA] << 8) | self.regs[regB]
+        if regnum == regW:
+            return (self.regs[regE] << 8) | self.regs[regF]
+        if regnum == regQ:
+            return (self.GetReg(regD) << 16) | self.GetReg(regW)
+        return self.regs[regnum]
+
+    def SetReg(self, regnum, value):
+        if regnum == regD:
+            self.regs[regA] = (value >> 8) & 0xff
+            self.regs[regB] = value & 0xff
+        elif regnum == regW:
+            self.regs[regE] = (value >> 8) & 0xff
+            self.regs[regF] = value & 0xff
+        elif regnum == regQ:
+            self.SetReg(regD, value >> 16)
+            self.SetReg(regW, value)
+        else:
+            self.regs[regnum] = value & ((1 << (8 * RegisterSizes[regnum])) - 1)
+
+    def ReadMemory(self, address, size):
+        value = 0
+        for idx in range(size):
+            value = (value << 8) | self.memory[(address + idx) & 0xffff]
+        return value
+
+    def WriteMemory(self, address, size, value):
+        for idx in range(size):
+            self.memory[(address + idx) & 0xffff] = (value >> (8 * (size - 1 - idx))) & 0xff
+
+    def GetTiming(self, instr, timing):
+        # return (cycles, bytes) from a simulator table entry, using the timing of the selected CPU
+        if timing == None or (CPU == 6809 and timing[0] == None):
+            raise Exception(f"Simulator: unsupported instruction '{instr.op} {instr.operand}' for {int(CPU)}")
+        return (timing[TimingColumns[CpuTiming]], timing[3])
+
+    def Run(self, asmStream):
+        for instr in asmStream.instructions:
+            if instr.op == None:
+                continue
+            (cycles, bytes) = self.Step(instr)
+            # compare the timing of each instruction with the numbers given by the code generator
+            if (instr.cycles, instr.bytes) != (cycles, bytes):
+                self.countErrors.append(f"'{instr.op} {instr.operand}' counted as {int(instr.cycles)} cycles and {int(instr.bytes)} bytes, "
+                                        f"but takes {int(cycles)} cycles and {int(bytes)} bytes")
+            self.cycles += cycles
+            self.bytes += bytes
+            if IsReturn(instr):
+                return
+        raise Exception(f"Simulator: function '{asmStream.name}' has no rts")
+
+    def Step(self, instr):
+        # execute one instruction, and return its (cycles, bytes)
+        op = instr.op
+        operand = instr.operand
+        if op == "rts":
+            self.SetReg(regS, self.GetReg(regS) + 2)
+            return self.GetTiming(instr, SimInherentOps[op])
+        if operand == "":
+            (cycles, bytes) = self.GetTiming(instr, SimInherentOps.get(op))
+            regnum = PeepholeRegs[op[3:]]
+            mask = (1 << (8 * RegisterSizes[regnum])) - 1
+            value = self.GetReg(regnum)
+            value = { "clr":0, "com":value ^ mask, "neg":-value, "inc":value + 1, "dec":value - 1 }[op[:3]]
+            self.SetReg(regnum, value)
+            return (cycles, bytes)
+        if op == "addr" and operand == "u,x":
+            self.SetReg(regX, self.GetReg(regX) + self.GetReg(regU))
+            return self.GetTiming(instr, SimRegisterOps[op])
+        if op in SimStackOps:
+            # the return address pulled into PC is ignored, because the function ends there
+            (cycles, bytes) = self.GetTiming(instr, SimStackOps[op])
+            stackReg = regS if op[3] == "s" else regU
+            nameList = GetStackRegisters(operand)
+            if op[:3] == "psh":
+                nameList.reverse()
+            for name in nameList:
+                size = StackRegisterBytes[name]
+                if name in ("cc", "dp") or name == regName[stackReg]:
+                    raise Exception(f"Simulator: unsupported register in '{op} {operand}'")
+                cycles += size
+                if op[:3] == "psh":
+                    self.SetReg(stackReg, self.GetReg(stackReg) - size)
+                    self.WriteMemory(self.GetReg(stackReg), size, 0 if name == "pc" else self.GetReg(PeepholeRegs[name]))
+                else:
+                    value = self.ReadMemory(self.GetReg(stackReg), size)
+                    self.SetReg(stackReg, self.GetReg(stackReg) + size)
+                    if name != "pc":
+                        self.SetReg(PeepholeRegs[name], value)
+            return (cycles, bytes)
+        if op == "tfm" and operand == "x+,y+":
+            (cycles, bytes) = self.GetTiming(instr, SimRegisterOps[op])
+            count = self.GetReg(regW)
+            for idx in range(count):
+                self.memory[(self.GetReg(regY) + idx) & 0xffff] = self.memory[(self.GetReg(regX) + idx) & 0xffff]
+            self.SetReg(regX, self.GetReg(regX) + count)
+            self.SetReg(regY, self.GetReg(regY) + count)
+            self.SetReg(regW, 0)
+            return (cycles + 3 * count, bytes)
+        match = re.match(r"^(ld|st|and|or|add|lea)([abdefwqxyu])$", op)
+        if match == None:
+            raise Exception(f"Simulator: unsupported instruction '{op} {operand}'")
+        operation = match.group(1)
+        regnum = PeepholeRegs[match.group(2)]
+        size = RegisterSizes[regnum]
+        if operand.startswith("#"):
+            (cycles, bytes) = self.GetTiming(instr, SimImmediateOps.get(op))
+            value = int(operand[2:], 16) if operand.startswith("#$") else int(operand[1:])
+            if value >= (1 << (8 * size)):
+                raise Exception(f"Simulator: immediate value too large in '{op} {operand}'")
+        else:
+            match = re.match(r"^(-?\d*),([xyu])$", operand)
+            if match == None:
+                raise Exception(f"Simulator: unsupported addressing mode in '{op} {operand}'")
+            offset = int(match.group(1) or "0")
+            (cycles, bytes) = self.GetTiming(instr, SimIndexedOps.get(op))
+            (extraCycles, extraBytes) = self.GetTiming(instr, SimIndexedOffsetCost(offset))
+            cycles += extraCycles
+            bytes += extraBytes
+            address = (self.GetReg(PeepholeRegs[match.group(2)]) + offset) & 0xffff
+            if operation == "lea":
+                self.SetReg(regnum, address)
+                return (cycles, bytes)
+            if operation == "st":
+                self.WriteMemory(address, size, self.GetReg(regnum))
+                return (cycles, bytes)
+            value = self.ReadMemory(address, size)
+        if operation == "ld":
+            self.SetReg(regnum, value)
+        elif operation == "and":
+            self.SetReg(regnum, self.GetReg(regnum) & value)
+        elif operation == "or":
+            self.SetReg(regnum, self.GetReg(regnum) | value)
+        else:
+            self.SetReg(regnum, self.GetReg(regnum) + value)
+        return (cycles, bytes)
+
+class SpriteVerifier:
+    # runs the Draw and Erase functions of each sprite on memory filled with random data, and checks the graphics
+    # memory, the saved background data, and the cycle and byte counts
+    GfxAddress = 0x4080
+    BufferAddress = 0xc000
+    StackAddress = 0x0100
+
+    def __init__(self):
+        self.random = random.Random(6809)
+        self.numRuns = 0
+        self.errors = [ ]
+
+    def RandomRegisters(self):
+        regValues = { regA:0, regB:0, regE:0, regF:0, regX:0, regY:0, regU:0, regS:0 }
+        for regnum in regValues:
+            regValues[regnum] = self.random.getrandbits(8 * RegisterSizes[regnum])
+        return regValues
+
+    def RunFunction(self, asmStream, memory, pointerX, pointerY):
+        # run a function on the memory image, and check its cycle and byte counts
+        regValues = self.RandomRegisters()
+        regValues[regX] = pointerX
+        regValues[regY] = pointerY
+        regValues[regS] = self.StackAddress
+        simulator = AsmSimulator(memory, regValues)
+        simulator.Run(asmStream)
+        self.numRuns += 1
+        for text in simulator.countErrors[:1]:
+            self.errors.append(f"{asmStream.name}: {text}")
+        if (simulator.cycles, simulator.bytes) != (asmStream.metrics.cycles, asmStream.metrics.bytes):
+            self.errors.append(f"{asmStream.name}: reported {int(asmStream.metrics.cycles)} cycles and {int(asmStream.metrics.bytes)} bytes, "
+                               f"but takes {int(simulator.cycles)} cycles and {int(simulator.bytes)} bytes")
+        return (regValues, simulator)
+
+    def CheckMemory(self, asmStream, memory, expected):
+        if memory == expected:
+            return True
+        badList = [ address for address in range(65536) if memory[address] != expected[address] ]
+        self.errors.append(f"{asmStream.name}: {len(badList)} bytes wrong, first at ${badList[0]:04x} "
+                           f"(graphics pointer ${self.GfxAddress:04x}, buffer ${self.BufferAddress:04x})")
+        return False
+
+    def VerifySprite(self, sprite):
+        for funcNum in range(2 if sprite.hasSinglePixelPos else 1):
+            (savedList, pixelBytes) = sprite.GetFrameBytes(sprite, funcNum)
+            if not sprite.eraseRedraw and len(savedList) > sprite.numSavedBytes:
+                self.errors.append(f"{sprite.name}: saves {len(savedList)} bytes, but only {int(sprite.numSavedBytes)} are reserved")
+            original = bytearray(self.random.randbytes(65536))
+            memory = bytearray(original)
+            if sprite.deltaFrom != None:
+                # draw the old frame at the same position first
+                frameOffset = sprite.GetFrameOffset(sprite.deltaFrom)
+                self.RunFunction(sprite.deltaFrom.funcDraw[funcNum], memory, self.GfxAddress + frameOffset, self.BufferAddress)
+            # the expected memory after drawing: sprite pixels on top of the original data, and the original bytes
+            # under the sprite in the saved data buffer.  The part of the buffer which is not used by a Delta
+            # sprite may contain anything
+            self.RunFunction(sprite.funcDraw[funcNum], memory, self.GfxAddress, self.BufferAddress)
+            expected = bytearray(original)
+            for (address, (mask, value)) in pixelBytes.items():
+                address = self.GfxAddress + address
+                expected[address] = (expected[address] & ~mask) | value
+            for idx in range(sprite.numSavedBytes):
+                if idx < len(savedList):
+                    expected[self.BufferAddress + idx] = original[self.GfxAddress + savedList[idx]]
+                else:
+                    expected[self.BufferAddress + idx] = memory[self.BufferAddress + idx]
+            if not self.CheckMemory(sprite.funcDraw[funcNum], memory, expected) or sprite.eraseRedraw:
+                continue
+            # erasing must restore the graphics memory, and leave the buffer alone.  The engine's erase loop keeps
+            # using U after calling the Erase function, so it must not be changed, and the return address must be
+            # pulled from the top of the stack.  The stack area may contain anything
+            (regValues, simulator) = self.RunFunction(sprite.funcErase, memory, self.BufferAddress, self.GfxAddress)
+            if simulator.GetReg(regU) != regValues[regU]:
+                self.errors.append(f"{sprite.funcErase.name}: register U is changed")
+            if simulator.GetReg(regS) != self.StackAddress + 2:
+                self.errors.append(f"{sprite.funcErase.name}: stack pointer S is not balanced")
+            for idx in range(sprite.numSavedBytes):
+                original[self.BufferAddress + idx] = expected[self.BufferAddress + idx]
+            for address in range(self.StackAddress - 16, self.StackAddress):
+                original[address] = memory[address]
+            self.CheckMemory(sprite.funcErase, memory, original)
+
+
+# *************************************************************************************************
+# Parallel compilation: each worker process compiles one part of one sprite
+# *************************************************************************************************
+
+def InitWorker(cpu, timing, bytesPerCycle):
+    # worker processes may not have run our __main__ code, so set the CPU type and peephole tradeoff here
+    global PeepholeBytesPerCycle
+    SetCpu(cpu, timing)
+    PeepholeBytesPerCycle = bytesPerCycle
+
+def CompileSpritePart(job):
+    # part 0 is the Erase and Draw/DrawLeft functions, and part 1 is the DrawRight function.  Return the compiled
+    # sprite (or DrawRight function), and the changes in this worker's statistics counters
+    (sprite, part) = job
+    startStats = (RowCache.hits, RowCache.misses, SearchNodes.visited, SearchNodes.pruned)
+    sprite.Process1_PreCalc()
+    if part == 0:
+        sprite.Process2_GenErase()
+        sprite.Process3_GenDraw(0)
+        result = sprite
+    else:
+        sprite.Process3_GenDraw(1)
+        result = sprite.funcDraw[1]
+    endStats = (RowCache.hits, RowCache.misses, SearchNodes.visited, SearchNodes.pruned)
+    return (result, tuple([ endStats[i] - startStats[i] for i in range(4) ]))
 
 # *************************************************************************************************
 # Application object: high-level processing, statistics gathering, final assembly dump
@@ -1531,6 +3215,7 @@ class App:
         self.asmFilename = asmFilename
         self.spriteList = []
         self.groupNumber = None
+        self.eraseRedraw = False
 
     def ReadInput(self):
         curSprite = None
@@ -1559,11 +3244,55 @@ class App:
                     if key == "group":
                         self.groupNumber = int(value)
                         continue
+                    if key == "erasemode":
+                        if value.lower() not in ("save", "redraw"):
+                            raise Exception(f"Invalid EraseMode '{value}' in input file {self.spriteFilename}")
+                        self.eraseRedraw = (value.lower() == "redraw")
+                        continue
                 print(f"Warning: ignore line before sprite section: {line}")
                 continue
             curSprite.ReadInputLine(line)
         if curSprite != None:
             curSprite.FinishDefinition()
+        for sprite in self.spriteList:
+            sprite.eraseRedraw = self.eraseRedraw
+        self.AddDeltaSprites()
+
+    def SetTimeBudget(self, seconds):
+        # the time budget for the group is used for every sprite which doesn't have its own TimeBudget parameter
+        for sprite in self.spriteList:
+            if sprite.timeBudget == None:
+                sprite.timeBudget = seconds
+
+    def AddDeltaSprites(self):
+        # each sprite named in an AnimateTo parameter gets a Delta sprite, which is added after all of the regular
+        # sprites so that their indices don't change
+        spriteByName = { sprite.name.lower():sprite for sprite in self.spriteList }
+        deltaList = [ ]
+        for sprite in self.spriteList:
+            for toName in sprite.animateTo:
+                if toName.lower() not in spriteByName:
+                    raise Exception(f"Sprite '{sprite.name}' animates to unknown sprite '{toName}'")
+                toSprite = spriteByName[toName.lower()]
+                if self.eraseRedraw:
+                    raise Exception(f"Sprite '{sprite.name}' can't use AnimateTo, because Delta sprites need the saved background data")
+                if toSprite.hasSinglePixelPos != sprite.hasSinglePixelPos:
+                    raise Exception(f"Sprites '{sprite.name}' and '{toSprite.name}' must have the same SinglePixelPosition to animate between them")
+                deltaSprite = Sprite(f"{sprite.name}_to_{toSprite.name}")
+                deltaSprite.SetDeltaFrames(sprite, toSprite)
+                deltaList.append(deltaSprite)
+        self.spriteList += deltaList
+
+    def Verify(self):
+        # run every generated function in the simulator, and print any differences from the sprite definitions
+        verifier = SpriteVerifier()
+        verifier.errors.extend(CheckInstructionCosts())
+        for sprite in self.spriteList:
+            verifier.VerifySprite(sprite)
+        for text in verifier.errors:
+            print(f"****Error: {text}")
+        print(f"Simulator verification: {int(verifier.numRuns)} function runs, {len(verifier.errors)} errors")
+        return len(verifier.errors) == 0
 
     def PrintRow(self, RowName, Values, datatype):
         if len(RowName) < 16:
@@ -1588,13 +3317,31 @@ class App:
                 print(" " * (8 - len(s)) + s, end=' ')
         print()
 
-    def Calculate(self):
-        for sprite in self.spriteList:
-            sprite.Process1_PreCalc()
-            sprite.Process2_GenErase()
-            sprite.Process3_GenDraw(0)
-            if sprite.hasSinglePixelPos:
-                sprite.Process3_GenDraw(1)
+    def Calculate(self, numJobs=1):
+        # sprites which haven't changed since they were last compiled are loaded from the cache
+        cache = None
+        compileIdxList = list(range(len(self.spriteList)))
+        if os.environ.get("DYNO_CACHE_DIR"):
+            cache = SpriteCodeCache(os.environ["DYNO_CACHE_DIR"], CacheMaxBytes)
+            compileIdxList = [ ]
+            for spriteIdx in range(len(self.spriteList)):
+                compiledState = cache.Get(self.spriteList[spriteIdx].GetCompileCacheKey())
+                if compiledState is None:
+                    compileIdxList.append(spriteIdx)
+                else:
+                    self.spriteList[spriteIdx].SetCompiledState(compiledState)
+        if numJobs <= 1 or not self.CalculateParallel(numJobs, compileIdxList):
+            for spriteIdx in compileIdxList:
+                sprite = self.spriteList[spriteIdx]
+                sprite.Process1_PreCalc()
+                sprite.Process2_GenErase()
+                sprite.Process3_GenDraw(0)
+                if sprite.hasSinglePixelPos:
+                    sprite.Process3_GenDraw(1)
+        if cache is not None:
+            for spriteIdx in compileIdxList:
+                sprite = self.spriteList[spriteIdx]
+                cache.Put(sprite.GetCompileCacheKey(), sprite.GetCompiledState())
         # calculate and print statistics for each sprite
         Names = []
         Pixels = []
@@ -1607,9 +3354,15 @@ class App:
         DrawLCycles = []
         DrawRBytes = []
         DrawRCycles = []
+        PeepEraseCycles = []
+        PeepDrawLCycles = []
+        PeepDrawRCycles = []
+        PeepByteChange = []
         TotalErase = 0
         TotalDrawL = 0
         TotalDrawR = 0
+        TotalPeepCycles = 0
+        TotalPeepByteChange = 0
         # add data to lists
         for sprite in self.spriteList:
             name = sprite.name
@@ -1634,16 +3387,34 @@ class App:
             myMaxCycles = MaxDrawCycles + sprite.funcErase.metrics.cycles
             MaxCycles.append(myMaxCycles)
             CyclesPerPix.append(float(myMaxCycles) / float(sprite.numPixels))
-            TotalErase += sprite.funcErase.metrics.bytes
+            if sprite.deltaFrom == None:
+                TotalErase += sprite.funcErase.metrics.bytes
             TotalDrawL += sprite.funcDraw[0].metrics.bytes
             if sprite.hasSinglePixelPos:
                 TotalDrawR += sprite.funcDraw[1].metrics.bytes
+            # cycles saved by the peephole optimizer, and the change in code size (which may grow)
+            funcList = [ sprite.funcErase, sprite.funcDraw[0] ]
+            PeepEraseCycles.append(sprite.funcErase.peepholeSaved.cycles)
+            PeepDrawLCycles.append(sprite.funcDraw[0].peepholeSaved.cycles)
+            if sprite.hasSinglePixelPos:
+                PeepDrawRCycles.append(sprite.funcDraw[1].peepholeSaved.cycles)
+                funcList.append(sprite.funcDraw[1])
+            else:
+                PeepDrawRCycles.append(None)
+            PeepByteChange.append(-sum([ func.peepholeSaved.bytes for func in funcList ]))
+            TotalPeepCycles += sum([ func.peepholeSaved.cycles for func in funcList ])
+            TotalPeepByteChange += PeepByteChange[-1]
         # print summary
         numSprites = len(self.spriteList)
         print(f"Total number of sprites: {int(numSprites)}")
         print(f"Total Erase code bytes: {int(TotalErase)}")
         print(f"Total Draw Left code bytes: {int(TotalDrawL)}")
         print(f"Total Draw Right code bytes: {int(TotalDrawR)}")
+        if cache is not None:
+            print(f"Sprite code cache: {int(cache.hits)} sprites reused, {int(cache.misses)} compiled")
+        print(f"Row code cache: {int(RowCache.hits)} hits, {int(RowCache.misses)} misses")
+        print(f"Layout search: {int(SearchNodes.visited)} nodes visited, {int(SearchNodes.pruned)} branches pruned")
+        print(f"Peephole optimizer: {int(TotalPeepCycles)} clock cycles saved, code size changed by {int(TotalPeepByteChange):+d} bytes")
         print()
         # last column should be averages
         Names.append("Average")
@@ -1660,6 +3431,10 @@ class App:
         if len(ValidDrawRBytes) > 0:
             DrawRBytes.append(sum(ValidDrawRBytes) / len(ValidDrawRBytes))
             DrawRCycles.append(sum(ValidDrawRCycles) / len(ValidDrawRCycles))
+            PeepDrawRCycles.append(sum([val for val in PeepDrawRCycles if val is not None]) / len(ValidDrawRCycles))
+        PeepEraseCycles.append(sum(PeepEraseCycles) / numSprites)
+        PeepDrawLCycles.append(sum(PeepDrawLCycles) / numSprites)
+        PeepByteChange.append(sum(PeepByteChange) / numSprites)
         # print tables
         numCols = len(Names)
         for startIdx in range(0, numCols, 8):
@@ -1679,8 +3454,47 @@ class App:
                 print("*********Draw_Right:")
                 self.PrintRow("Code bytes", DrawRBytes[startIdx:endIdx], int)
                 self.PrintRow("Clock cycles", DrawRCycles[startIdx:endIdx], int)
+            print("***********Peephole:")
+            self.PrintRow("Erase cyc saved", PeepEraseCycles[startIdx:endIdx], int)
+            self.PrintRow("DrawL cyc saved", PeepDrawLCycles[startIdx:endIdx], int)
+            if len(ValidDrawRBytes) > 0:
+                self.PrintRow("DrawR cyc saved", PeepDrawRCycles[startIdx:endIdx], int)
+            self.PrintRow("Code size change", PeepByteChange[startIdx:endIdx], int)
             print()
 
+    def CalculateParallel(self, numJobs, compileIdxList):
+        # compile the sprites (and their DrawRight functions separately) in a pool of worker processes.  Each part
+        # is compiled exactly as it would be in a serial run, and the results are merged in their original order,
+        # so the output is identical.  Only the cache statistics differ, because each worker has its own cache
+        jobList = [ ]
+        for spriteIdx in compileIdxList:
+            sprite = self.spriteList[spriteIdx]
+            jobList.append((spriteIdx, sprite, 0))
+            if sprite.hasSinglePixelPos:
+                jobList.append((spriteIdx, sprite, 1))
+        try:
+            pool = concurrent.futures.ProcessPoolExecutor(numJobs, initializer=InitWorker, initargs=(CPU, CpuTiming, PeepholeBytesPerCycle))
+        except (OSError, NotImplementedError):
+            # no multiprocessing support, so the sprites will be compiled one at a time
+            return False
+        deltaFromIdx = { spriteIdx:(self.spriteList.index(sprite.deltaFrom), self.spriteList.index(sprite.deltaTo)) for (spriteIdx, sprite) in enumerate(self.spriteList) if sprite.deltaFrom != None }
+        with pool:
+            resultList = list(pool.map(CompileSpritePart, [ (sprite, part) for (spriteIdx, sprite, part) in jobList ]))
+        for ((spriteIdx, sprite, part), (result, stats)) in zip(jobList, resultList):
+            if part == 0:
+                self.spriteList[spriteIdx] = result
+            else:
+                self.spriteList[spriteIdx].funcDraw[1] = result
+            RowCache.hits += stats[0]
+            RowCache.misses += stats[1]
+            SearchNodes.visited += stats[2]
+            SearchNodes.pruned += stats[3]
+        # the workers return copies of the sprites, so the Delta sprites must be linked to the compiled frames
+        for (spriteIdx, (fromIdx, toIdx)) in deltaFromIdx.items():
+            self.spriteList[spriteIdx].deltaFrom = self.spriteList[fromIdx]
+            self.spriteList[spriteIdx].deltaTo = self.spriteList[toIdx]
+        return True
+
     def WriteAsm(self):
         # make sure we have a group number
         if self.groupNumber == None:
@@ -1694,20 +3508,21 @@ class App:
             # drawLeft
             length = sprite.funcDraw[0].metrics.bytes
             f.write(f"* (Origin: ${origin:04X}  Length: {int(length)} bytes)\n")
-            f.write(sprite.funcDraw[0].text + "\n")
+            f.write(sprite.funcDraw[0].Render() + "\n")
             origin += length
             # drawRight
             if sprite.hasSinglePixelPos:
                 length = sprite.funcDraw[1].metrics.bytes
                 f.write(f"* (Origin: ${origin:04X}  Length: {int(length)} bytes)\n")
-                f.write(sprite.funcDraw[1].text + "\n")
+                f.write(sprite.funcDraw[1].Render() + "\n")
                 origin += length
                 bHasDrawRight = True
-            # erase
-            length = sprite.funcErase.metrics.bytes
-            f.write(f"* (Origin: ${origin:04X}  Length: {int(length)} bytes)\n")
-            f.write(sprite.funcErase.text + "\n")
-            origin += length
+            # erase (a Delta sprite uses the Erase function of the sprite which it changes into)
+            if sprite.deltaFrom == None:
+                length = sprite.funcErase.metrics.bytes
+                f.write(f"* (Origin: ${origin:04X}  Length: {int(length)} bytes)\n")
+                f.write(sprite.funcErase.Render() + "\n")
+                origin += length
         # at the end, write the Sprite Descriptor Table
         f.write(f"\nNumberOfSprites\n            fcb         {int(len(self.spriteList))}\n")
         f.write("SpriteDescriptorTable\n")
@@ -1733,25 +3548,82 @@ class App:
                 f.write(f"            fdb         {p}{' ' * (24 - len(p))}* length of drawRight in bytes\n")
             else:
                 f.write("            fdb         0                       * length of drawRight in bytes\n")
-            p = str(sprite.funcErase.metrics.bytes)
-            f.write(f"            fdb         {p}{' ' * (24 - len(p))}* length of erase in bytes\n")
-            f.write("            fcb         0                       * res1\n")
+            if sprite.deltaFrom != None:
+                # the loader copies the erase pointer from the Sprite Descriptor Table entry of the new sprite
+                p = f"${0x8000 + self.spriteList.index(sprite.deltaTo):04X}"
+                f.write(f"            fdb         {p}{' ' * (24 - len(p))}* erase function of sprite {sprite.deltaTo.name}\n")
+            else:
+                p = str(sprite.funcErase.metrics.bytes)
+                f.write(f"            fdb         {p}{' ' * (24 - len(p))}* length of erase in bytes\n")
+            if sprite.deltaFrom != None:
+                # the index of the old sprite plus one, so the engine can find the Delta sprite which changes it
+                p = str(self.spriteList.index(sprite.deltaFrom) + 1)
+                f.write(f"            fcb         {p}{' ' * (24 - len(p))}* redrawOffX (old sprite index + 1)\n")
+            elif sprite.eraseRedraw:
+                # the left edge of the sprite relative to the hotspot, minus one pixel for the Draw function which
+                # is used at odd X coordinates when there is no DrawRight function
+                redrawOffX = -sprite.hotspot[0] - 1
+                if redrawOffX < -128 or redrawOffX > 127:
+                    raise Exception(f"Sprite '{sprite.name}' hotspot is too far from its left edge to erase by redrawing")
+                p = str(redrawOffX)
+                f.write(f"            fcb         {p}{' ' * (24 - len(p))}* redrawOffX\n")
+            else:
+                f.write("            fcb         0                       * redrawOffX\n")
 
 # *************************************************************************************************
 # main function for standard script execution
 # *************************************************************************************************
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print(f"Usage: {sys.argv[0]} <InputSpriteFile> <OutputAsmFile> <6809 | 6309>")
+    # options may follow the 3 required arguments
+    numJobs = 1
+    bVerify = False
+    timing = None
+    timeBudget = None
+    argList = sys.argv[1:4]
+    optList = sys.argv[4:]
+    bBadArgs = (len(argList) != 3 or argList[2] not in ("6809", "6309"))
+    while len(optList) > 0 and not bBadArgs:
+        if optList[0] == "-j" and len(optList) > 1 and optList[1].isdigit():
+            # number of worker processes for compiling the sprites
+            numJobs = int(optList[1])
+            optList = optList[2:]
+        elif optList[0] == "--verify":
+            # run the generated code in the simulator and check it before writing it out
+            bVerify = True
+            optList = optList[1:]
+        elif optList[0] == "--timing" and len(optList) > 1 and optList[1] in TimingColumns:
+            # CPU timing to optimize for, if different from the instruction set: 6309 (native mode) or 6309e (emulation mode)
+            timing = optList[1]
+            optList = optList[2:]
+        elif optList[0] == "--time-budget" and len(optList) > 1 and re.match(r"^\d+(\.\d*)?$", optList[1]):
+            # seconds to spend searching for faster code for each Draw function
+            timeBudget = float(optList[1])
+            optList = optList[2:]
+        elif optList[0] == "--bytes-per-cycle" and len(optList) > 1 and optList[1].isdigit():
+            # code bytes which the peephole optimizer may spend to save one clock cycle
+            PeepholeBytesPerCycle = int(optList[1])
+            optList = optList[2:]
+        else:
+            bBadArgs = True
+    if bBadArgs:
+        print(f"Usage: {sys.argv[0]} <InputSpriteFile> <OutputAsmFile> <6809 | 6309> [-j N] [--verify] [--timing <6809 | 6309 | 6309e>] [--time-budget SECONDS] [--bytes-per-cycle N]")
+        sys.exit(1)
+    # set CPU type and timing
+    if timing == None:
+        timing = argList[2]
+    if argList[2] == "6309" and timing == "6809":
+        print("****Error: 6309 code can't be optimized for 6809 timing")
         sys.exit(1)
-    # set CPU type
-    global CPU
-    CPU = int(sys.argv[3])
+    SetCpu(int(argList[2]), timing)
     # run the app
-    myApp = App(sys.argv[1], sys.argv[2])
+    myApp = App(argList[0], argList[1])
     myApp.ReadInput()
-    myApp.Calculate()
+    if timeBudget != None:
+        myApp.SetTimeBudget(timeBudget)
+    myApp.Calculate(numJobs)
+    if bVerify and not myApp.Verify():
+        sys.exit(1)
     myApp.WriteAsm()
 
 
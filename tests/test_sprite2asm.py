@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#********************************************************************************
+# DynoSprite - tests/test_sprite2asm.py
+# Checks the pruned layout searches in scripts/sprite2asm.py against exhaustive searches, the cost model
+# against the simulator's timing tables, and the stack push Draw code for sprites erased by redrawing
+#********************************************************************************
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import sprite2asm
+
+def ExhaustiveWordWriteOrder(sprite, rowNum, regState, uniqWordValues, wordOrder):
+    # the original search, which scores every ordering of the words
+    if len(uniqWordValues) == 0:
+        score = 0.0
+        if len(wordOrder) > 0:
+            firstWordWriteVal = wordOrder[0]
+            if regState.IsValid(sprite2asm.regA) and regState.GetValue(sprite2asm.regA) == (firstWordWriteVal >> 8):
+                score += 1.0
+            elif regState.IsValid(sprite2asm.regB) and regState.GetValue(sprite2asm.regB) == (firstWordWriteVal & 0xff):
+                score += 1.0
+            lastVal = wordOrder[-1]
+            if rowNum < sprite.height - 1:
+                wordWriteProb = sprite.wordWriteProbByRow[rowNum+1]
+                byteWriteProb = sprite.byteWriteProbByRow[rowNum+1]
+                if lastVal in wordWriteProb:
+                    score += wordWriteProb[lastVal]
+                byteProb = 0.0
+                if (lastVal >> 8) in byteWriteProb:
+                    byteProb = byteWriteProb[lastVal >> 8]
+                if (lastVal & 0xff) in byteWriteProb:
+                    byteProb = max(byteProb, byteWriteProb[lastVal & 0xff])
+                score += byteProb
+        for idx in range(len(wordOrder)-1):
+            if (wordOrder[idx] & 0xff00) == (wordOrder[idx+1] & 0xff00):
+                score += 1.0
+            if (wordOrder[idx] & 0xff) == (wordOrder[idx+1] & 0xff):
+                score += 1.0
+        return (score, list(wordOrder))
+    bestScore = 0
+    bestOrder = None
+    for idx in range(len(uniqWordValues)):
+        nextWord = uniqWordValues.pop(idx)
+        wordOrder.append(nextWord)
+        tryScore,tryOrder = ExhaustiveWordWriteOrder(sprite, rowNum, regState, uniqWordValues, wordOrder)
+        if bestOrder == None or tryScore > bestScore:
+            bestScore = tryScore
+            bestOrder = tryOrder
+        wordOrder.pop()
+        uniqWordValues.insert(idx, nextWord)
+    return (bestScore, bestOrder)
+
+def RandomWordOrderProblem(rnd):
+    # a few word values drawn from a small set of byte values, so that many of them share a byte
+    byteValues = [ rnd.randrange(256) for i in range(rnd.randint(2, 4)) ]
+    wordValues = set()
+    for i in range(rnd.randint(1, 6)):
+        wordValues.add((rnd.choice(byteValues) << 8) | rnd.choice(byteValues))
+    sprite = sprite2asm.Sprite("test")
+    sprite.height = 2
+    sprite.lastWordWrite = None
+    wordWriteProb = { }
+    byteWriteProb = { }
+    for value in wordValues:
+        if rnd.random() < 0.5:
+            wordWriteProb[value] = rnd.random()
+    for value in byteValues:
+        if rnd.random() < 0.5:
+            byteWriteProb[value] = rnd.random()
+    sprite.wordWriteProbByRow = [ { }, wordWriteProb ]
+    sprite.byteWriteProbByRow = [ { }, byteWriteProb ]
+    regState = sprite2asm.AsmRegisters()
+    if rnd.random() < 0.5:
+        regState = regState.WithValue(sprite2asm.regA, rnd.choice(byteValues))
+    if rnd.random() < 0.5:
+        regState = regState.WithValue(sprite2asm.regB, rnd.choice(byteValues))
+    return (sprite, regState, sorted(wordValues))
+
+def test_word_write_order_matches_exhaustive_search():
+    rnd = random.Random(12)
+    for trial in range(3000):
+        sprite, regState, wordValues = RandomWordOrderProblem(rnd)
+        rowNum = rnd.randint(0, 1)
+        expect = ExhaustiveWordWriteOrder(sprite, rowNum, regState, list(wordValues), [ ])
+        result = sprite.PermuteWordWriteOrder(rowNum, regState, list(wordValues), [ ], 0, None)
+        assert result == expect, f"trial {trial}: words {wordValues}"
+
+def test_word_write_order_example():
+    # with no next-row probabilities for the first word, the last word's probability decides the order
+    sprite = sprite2asm.Sprite("test")
+    sprite.height = 2
+    sprite.lastWordWrite = None
+    sprite.wordWriteProbByRow = [ { }, { 8738: 0.5 } ]
+    sprite.byteWriteProbByRow = [ { }, { } ]
+    regState = sprite2asm.AsmRegisters()
+    wordValues = [ 8721, 8738, 8772 ]
+    expect = ExhaustiveWordWriteOrder(sprite, 0, regState, list(wordValues), [ ])
+    assert sprite.PermuteWordWriteOrder(0, regState, list(wordValues), [ ], 0, None) == expect
+    assert expect[1][-1] == 8738
+
+def test_instruction_costs_match_simulator():
+    # every cost in the code generator's table, for all three CPU timings, must agree with the data sheet tables
+    assert sprite2asm.CheckInstructionCosts() == [ ]
+
+def test_stack_blast_for_wide_redraw_sprite():
+    # a wide solid sprite which is erased by redrawing the background is written faster with pshu on the 6809
+    sprite2asm.SetCpu(6809, "6809")
+    sprite = sprite2asm.Sprite("wide")
+    sprite.width = 64
+    sprite.height = 4
+    sprite.matrix = [ [ 5 ] * 64 for y in range(4) ]
+    sprite.eraseRedraw = True
+    sprite.FinishDefinition()
+    (sprite, stats) = sprite2asm.CompileSpritePart((sprite, 0))
+    assert "pshu" in [ instr.op for instr in sprite.funcDraw[0].instructions ]
+    verifier = sprite2asm.SpriteVerifier()
+    verifier.VerifySprite(sprite)
+    assert verifier.errors == [ ]